@@ -1,3 +1,32 @@
 import flask
+import marshmallow
+
+import metrics
 
 app = flask.Flask(__name__)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/telegram/<secret>', methods=['POST'])
+def telegram_webhook(secret):
+    transport = app.config.get('TELEGRAM_TRANSPORT')
+    if transport is None:
+        flask.abort(404)
+    header = flask.request.headers.get('X-Telegram-Bot-Api-Secret-Token')
+    if not transport.check_secret(secret, header):
+        flask.abort(403)
+    payload = flask.request.get_json(force=True, silent=True)
+    if payload is None:
+        flask.abort(400)
+    try:
+        accepted = transport.receive(payload)
+    except (marshmallow.ValidationError, KeyError, TypeError, ValueError):
+        flask.abort(400)
+    if not accepted:
+        # Telegram redelivers the update later.
+        flask.abort(503)
+    return ''
@@ -0,0 +1,534 @@
+#!/usr/bin/env python
+"""Load test of the bot against a local stand-in for the Telegram API.
+
+Scripted players talk to a fake api.telegram.org (getUpdates/sendMessage)
+served from this process, the bot polls it like the real one and keeps
+players in mongomock (or a real database with --db-url). Each player sends
+their next message once the reply to the previous one arrives.
+
+Reported: turns per second, turn latency (from the message becoming
+available to getUpdates until the first reply), database operations per
+turn and memory allocated per turn (measured separately, without HTTP, on
+Python 3 with tracemalloc). Results are written as JSON; with --baseline a
+previous result is compared and the exit code is 1 on regressions.
+"""
+
+import argparse
+import collections
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+
+try:
+    import BaseHTTPServer as http_server
+    import SocketServer as socketserver
+except ImportError:
+    import http.server as http_server
+    import socketserver
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import mongoengine
+import pymongo.monitoring
+
+import bot
+import telegram
+import transport
+
+logger = logging.getLogger(__name__)
+
+TOKEN = 'bench'
+
+# Players start from 10 ** 6 to stay clear of ids of real players when run
+# against a real database.
+FIRST_USER_ID = 10 ** 6
+
+
+# Scripts avoid random outcomes (like junkyard finds) so runs are comparable.
+
+def win_path(name):
+    """The shortest way to win; cheats stand in for lucky junkyard finds."""
+    return [
+        '/start', "Ok, I got it. Let's play.", name, '/help', 'Take kettle',
+        'Look on the table', 'Look on the table', 'Go out',
+        'Talk to Genry', "Hi, Genry. What's up?", 'Nothing',
+        'Go to shop', 'Talk to Merchant', 'Show me your goods', 'Nothing',
+        'I want to sell something', 'Nothing', 'Nothing', 'Go back to the street',
+        'Go to junkyard', 'Go back to the street', 'Go to electric company', 'Talk to Administrator',
+        "What's a reason for the current blackout?",
+        'I want to fill an information request.', 'Nothing', 'Go back to the street',
+        'Go to hospital', 'Talk to Doctor', 'How did you get electricity for the hospital?',
+        'Nothing.', 'Go back to the street',
+        'Go to garage', 'Talk to Mechanic', 'Can you build generator?',
+        '/pleasegiveme magnet', '/pleasegiveme valve', '/pleasegiveme piston',
+        'Talk to Mechanic', 'I brought all parts for generator.', 'Nothing.',
+        'Go back to the street', 'Go back home', 'Turn off gas', 'Install generator',
+        "What's in my pockets?", 'Turn on gas', 'more', '/highscores',
+    ]
+
+
+def explore_path(name):
+    """A player looking around town without getting anywhere."""
+    return [
+        '/start', "Ok, I got it. Let's play.", name, "What's in my pockets?",
+        'Look on the table', 'Go out', 'Go to junkyard', 'Go back to the street',
+        'Go to shop',
+        'Talk to Merchant', 'Show me your goods', 'Nothing', 'Go back to the street',
+        'Go to hospital', 'Talk to Doctor', 'Nothing.', 'Go back to the street',
+        'Go back home', "What's in my pockets?", '/highscores',
+    ]
+
+
+SCRIPTS = {
+    'win': win_path,
+    'explore': explore_path,
+}
+
+
+class Player(object):
+    def __init__(self, user_id, script):
+        super(Player, self).__init__()
+        self.user_id = user_id
+        self.script = script
+        self.position = 0
+        self.waiting_since = None
+
+    @property
+    def finished(self):
+        return self.position >= len(self.script)
+
+
+def make_players(count, mix):
+    players = []
+    for i in range(count):
+        kind = mix[i % len(mix)]
+        user_id = FIRST_USER_ID + i
+        players.append(Player(user_id, SCRIPTS[kind]('Player {}'.format(i))))
+    return players
+
+
+class FakeTelegram(object):
+    """The Bot API as the players see it."""
+
+    def __init__(self, players):
+        super(FakeTelegram, self).__init__()
+        self.players = dict((player.user_id, player) for player in players)
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.latencies = []
+        self.replies = 0
+        self.active = len(players)
+        self.condition = threading.Condition()
+
+    def start(self):
+        with self.condition:
+            for player in self.players.values():
+                self.advance(player)
+
+    def advance(self, player):
+        if player.finished:
+            player.waiting_since = None
+            self.active -= 1
+            self.condition.notify_all()
+            return
+        text = player.script[player.position]
+        player.position += 1
+        player.waiting_since = time.time()
+        self.updates.append({
+            'update_id': self.next_update_id,
+            'message': self.message(player.user_id, player.user_id, text),
+        })
+        self.next_update_id += 1
+        self.condition.notify_all()
+
+    def message(self, chat_id, user_id, text):
+        self.next_message_id += 1
+        return {
+            'message_id': self.next_message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': user_id, 'first_name': 'Player', 'username': 'player'},
+            'text': text,
+        }
+
+    def get_updates(self, params):
+        offset = params.get('offset') or 0
+        deadline = time.time() + (params.get('timeout') or 0)
+        with self.condition:
+            # Updates below the offset are confirmed and gone.
+            self.updates = [update for update in self.updates if update['update_id'] >= offset]
+            while not self.updates and self.active and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return self.updates[:params.get('limit') or 100]
+
+    def send_message(self, params):
+        with self.condition:
+            self.replies += 1
+            player = self.players.get(params['chat_id'])
+            if player is not None and player.waiting_since is not None:
+                self.latencies.append(time.time() - player.waiting_since)
+                self.advance(player)
+            return self.message(params['chat_id'], 0, params['text'])
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        with self.condition:
+            while self.active and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            return not self.active
+
+
+class RequestHandler(http_server.BaseHTTPRequestHandler):
+    # Keep-alive, as with the real API.
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; don't let them wait for ACKs.
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = json.loads(self.rfile.read(length).decode('utf-8')) if length else {}
+        method = self.path.rsplit('/', 1)[-1]
+        api = self.server.api
+        if method == 'getUpdates':
+            body = {'ok': True, 'result': api.get_updates(params)}
+        elif method == 'sendMessage':
+            body = {'ok': True, 'result': api.send_message(params)}
+        else:
+            body = {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, api):
+        http_server.HTTPServer.__init__(self, ('127.0.0.1', 0), RequestHandler)
+        self.api = api
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+
+class OpCounter(pymongo.monitoring.CommandListener):
+    """Counts database operations by kind.
+
+    A real database reports them through pymongo's command monitoring;
+    mongomock has none, so its collection methods are wrapped instead.
+    """
+
+    MOCK_METHODS = (
+        'find', 'find_one', 'insert_one', 'insert_many', 'update_one', 'update_many',
+        'replace_one', 'find_one_and_update', 'find_one_and_replace', 'delete_one',
+        'delete_many', 'count_documents', 'aggregate', 'bulk_write',
+    )
+    # Commands of the driver itself rather than of the bot.
+    IGNORED_COMMANDS = frozenset((
+        'ismaster', 'isMaster', 'hello', 'ping', 'buildinfo', 'buildInfo',
+        'endSessions', 'createIndexes', 'listIndexes', 'saslStart', 'saslContinue',
+    ))
+
+    def __init__(self):
+        super(OpCounter, self).__init__()
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def started(self, event):
+        if event.command_name not in self.IGNORED_COMMANDS:
+            self.count(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def install_mock(self):
+        collection = mongomock.collection.Collection
+        for name in self.MOCK_METHODS:
+            method = getattr(collection, name, None)
+            if method is not None:
+                setattr(collection, name, self.wrap(name, method))
+
+    def wrap(self, name, method):
+        # mongomock implements some methods with others (find_one with find),
+        # only the outermost call is an operation.
+        local = self.local
+
+        def counted(*args, **kwargs):
+            if getattr(local, 'inside', False):
+                return method(*args, **kwargs)
+            self.count(name)
+            local.inside = True
+            try:
+                return method(*args, **kwargs)
+            finally:
+                local.inside = False
+        return counted
+
+
+def connect(db_url, counter):
+    if db_url:
+        pymongo.monitoring.register(counter)
+        return mongoengine.connect('default', host=db_url)
+    if mongomock is None:
+        raise SystemExit('Install mongomock or pass --db-url.')
+    counter.install_mock()
+    # Older mongoengine knows mongomock by URL, newer takes the client class.
+    if mongoengine.VERSION < (0, 27):
+        return mongoengine.connect('default', host='mongomock://localhost')
+    return mongoengine.connect('default', host='mongodb://localhost',
+                               mongo_client_class=mongomock.MongoClient)
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def run_load(args, counter):
+    players = make_players(args.players, args.mix)
+    api = FakeTelegram(players)
+    server = Server(api)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+
+    the_bot = bot.Bot(cache_size=args.cache_size, reply_mode=args.coalesce)
+    the_bot.warm_up()
+    bot_transport = telegram.Transport(
+        the_bot, TOKEN, workers=args.workers, poll_timeout=1, api_url=server.url,
+        coalesce=args.coalesce != 'off', strict=args.strict)
+
+    counter.reset()
+    api.start()
+    started = time.time()
+    stop = threading.Event()
+    poller = threading.Thread(target=poll_until, args=(bot_transport, stop))
+    poller.daemon = True
+    poller.start()
+    finished = api.wait(args.timeout)
+    duration = time.time() - started
+    ops = dict(counter.counts)
+    stop.set()
+    poller.join()
+    bot_transport.close()
+    the_bot.close()
+    server.shutdown()
+    server.server_close()
+
+    turns = len(api.latencies)
+    if not finished:
+        stuck = [player for player in players if not player.finished]
+        logger.warning('Stopped after %.0fs with %s players still playing, e.g. %s at %r.',
+                       args.timeout, len(stuck), stuck[0].user_id,
+                       stuck[0].script[stuck[0].position - 1])
+    return {
+        'finished': finished,
+        'turns': turns,
+        'replies': api.replies,
+        'duration_seconds': duration,
+        'turns_per_second': turns / duration if duration else None,
+        'latency_ms': {
+            'p50': latency_ms(percentile(api.latencies, 50)),
+            'p99': latency_ms(percentile(api.latencies, 99)),
+            'max': latency_ms(max(api.latencies) if api.latencies else None),
+        },
+        'db_ops': ops,
+        'db_ops_per_turn': float(sum(ops.values())) / turns if turns else None,
+        'wins': bot.User.objects(user_id__gte=FIRST_USER_ID, win=True).count(),
+    }
+
+
+def poll_until(bot_transport, stop):
+    while not stop.is_set():
+        bot_transport.poll()
+
+
+def latency_ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class Collector(transport.Transport):
+    """In-process transport for the allocation run."""
+
+    def __init__(self):
+        super(Collector, self).__init__(None)
+        self.sent = 0
+        self._formatter = telegram.Formatter()
+
+    def send_message(self, chat, text, keyboard=None, **kwargs):
+        self.sent += 1
+
+    def keyboard(self, *buttons):
+        return buttons
+
+    @property
+    def formatter(self):
+        return self._formatter
+
+
+def run_allocations(args):
+    """Memory allocated per turn, measured on direct Bot.on_message calls."""
+    if tracemalloc is None or not args.alloc_turns:
+        return None
+    the_bot = bot.Bot(cache_size=args.cache_size)
+    the_bot.warm_up()
+    collector = Collector()
+    # Different ids from the load run, so players start from scratch.
+    players = make_players(args.players, args.mix)
+    for player in players:
+        player.user_id += args.players
+    allocated = []
+    retained = []
+    while len(allocated) < args.alloc_turns:
+        playing = [player for player in players if not player.finished]
+        if not playing:
+            break
+        for player in playing:
+            text = player.script[player.position]
+            player.position += 1
+            chat = telegram.Chat(player.user_id, 'private')
+            user = telegram.User(id=player.user_id, first_name='Player', username='player')
+            message = transport.Message(text, user, chat)
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            the_bot.on_message(collector, message)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            allocated.append(peak - before)
+            retained.append(current - before)
+    the_bot.close()
+    return {
+        'turns': len(allocated),
+        'alloc_bytes_per_turn': float(sum(allocated)) / len(allocated) if allocated else None,
+        'retained_bytes_per_turn': float(sum(retained)) / len(retained) if retained else None,
+    }
+
+
+# Metric name, path in the result and whether higher values are better.
+COMPARED = (
+    ('turns/s', ('load', 'turns_per_second'), True),
+    ('p50 latency', ('load', 'latency_ms', 'p50'), False),
+    ('p99 latency', ('load', 'latency_ms', 'p99'), False),
+    ('db ops/turn', ('load', 'db_ops_per_turn'), False),
+    ('alloc bytes/turn', ('allocations', 'alloc_bytes_per_turn'), False),
+)
+
+
+def lookup(result, path):
+    for key in path:
+        if not isinstance(result, dict):
+            return None
+        result = result.get(key)
+    return result
+
+
+def compare(result, baseline, tolerance):
+    """Prints changes against `baseline`, returns the regressed metrics."""
+    regressions = []
+    for name, path, higher_is_better in COMPARED:
+        new, old = lookup(result, path), lookup(baseline, path)
+        if not new or not old:
+            continue
+        change = (new - old) / float(old)
+        worse = -change if higher_is_better else change
+        print('{:>18}: {:12.2f} -> {:12.2f} ({:+.1%})'.format(name, old, new, change))
+        if worse > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def run():
+    parser = argparse.ArgumentParser(description='Load test the bot.')
+    parser.add_argument('--players', type=int, default=50)
+    parser.add_argument('--mix', default='win,explore',
+                        help='Comma-separated scripts players are given in turn: '
+                             + ', '.join(sorted(SCRIPTS)) + '.')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--cache-size', type=int, default=0)
+    parser.add_argument('--coalesce', choices=('off', 'last', 'merge'), default='off')
+    parser.add_argument('--strict', action='store_true', default=False)
+    parser.add_argument('--db-url', help='Use this database instead of mongomock.')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='Give up after this many seconds.')
+    parser.add_argument('--alloc-turns', type=int, default=500,
+                        help='Turns to measure allocations on, 0 to skip.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', help='Compare with results from this JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative change counted as a regression.')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+    args.mix = args.mix.split(',')
+    unknown = [kind for kind in args.mix if kind not in SCRIPTS]
+    if unknown:
+        parser.error('unknown scripts: ' + ', '.join(unknown))
+    logging.basicConfig(level=args.log_level)
+
+    counter = OpCounter()
+    connect(args.db_url, counter)
+    result = {
+        'config': dict((key, value) for key, value in vars(args).items()
+                       if key not in ('output', 'baseline')),
+        'python': platform.python_version(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'load': run_load(args, counter),
+        'allocations': run_allocations(args),
+    }
+
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+        if regressions:
+            print('Regressed: ' + ', '.join(regressions))
+            return 1
+    return 0 if result['load']['finished'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(run())
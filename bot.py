@@ -1,310 +1,534 @@
 #!/usr/bin/env python
 
 import argparse
+import binascii
 import datetime
 import logging
 import os
+import signal
 import sys
+import threading
 import time
 
 import mongoengine
-import yaml
+import pymongo.errors
+import werkzeug.serving
 
+import app
+import content
+import engine
 import hotreload
+import metrics
+import offsets
+import persistence
+import sessions
+import shards
+import stores
+import tasks
 import telegram
 import transport
-import locations
-import npcs
+from models import Score, User
 
 logger = logging.getLogger(__name__)
 
-class Score(mongoengine.Document):
-    name = mongoengine.StringField()
-    turns = mongoengine.LongField()
-    money = mongoengine.LongField()
-    score = mongoengine.LongField()
-
-
-class User(mongoengine.Document):
-    user_id = mongoengine.LongField()
-    turn = mongoengine.LongField()
-    in_intro = mongoengine.BooleanField()
-    name = mongoengine.StringField()
-    locations = mongoengine.DictField()
-    inventory = mongoengine.ListField(mongoengine.StringField())
-    current_npc = mongoengine.StringField()
-    npcs = mongoengine.DictField()
-    current_location = mongoengine.StringField()
-    know_about_generator = mongoengine.BooleanField()
-    filled_request = mongoengine.BooleanField()
-    electrician_went_check = mongoengine.BooleanField()
-    burned = mongoengine.BooleanField()
-    money = mongoengine.IntField()
-    win = mongoengine.BooleanField()
-
-    def remove_one(self, obj_to_remove):
-        for i, obj in enumerate(self.inventory):
-            if obj == obj_to_remove:
-                del self.inventory[i]
-                break
-
-class Bot(transport.Handler):
-    def reset(self, user):
-        user.turn = 0
-        user.in_intro = True
-        user.name = None
-        user.locations =  {}
-        user.current_location = 'home_sweet_home'
-        user.inventory = []
-        user.current_npc = None
-        user.know_about_generator = False
-        user.filled_request = False
-        user.electrician_went_check = False
-        user.burned = False
-        user.win = False
-        user.money = 100
+TURN_CONFLICTS = metrics.counter(
+    'bot_turn_conflicts_total', 'Turns replayed because the player changed meanwhile.')
+
+# Long-polling timeout under hot reload: a worker asked to stop finishes
+# its poll first.
+HOTRELOAD_POLL_TIMEOUT = 2
+
+
+class Bot(engine.Game, transport.Handler):
+    MAX_TURN_ATTEMPTS = 5
+    # Seconds between loads of the leaderboard from the database, where all
+    # processes record scores. Turns only read it from memory.
+    LEADERBOARD_REFRESH_INTERVAL = 2.0
+
+    def __init__(self, content_store=None, cache_size=0, flush_interval=5.0,
+                 reply_mode='last', store=None):
+        super(Bot, self).__init__(content_store)
+        # How to answer a burst of messages handled at once: 'last' sends the
+        # replies to the last message only, 'merge' sends all in one message.
+        self.reply_mode = reply_mode
+        if store is None:
+            store = stores.MongoStore(User)
+        self.store = store
+        self.sessions = None
+        if cache_size:
+            self.sessions = sessions.SessionCache(
+                self.fetch_user, self.save_user,
+                capacity=cache_size, flush_interval=flush_interval,
+                stale=(persistence.VersionConflict,), copy=persistence.clone)
+        self._closing = threading.Event()
+        self._leaderboard_refresher = None
+
+    def warm_up(self):
+        try:
+            User.ensure_indexes()
+        except pymongo.errors.DuplicateKeyError as e:
+            raise RuntimeError(
+                'Some players are stored twice, so user ids cannot be indexed ({}). '
+                'Run the bot once with --remove-duplicate-users.'.format(e))
+        Score.ensure_indexes()
+        self.refresh_leaderboard()
+        self._leaderboard_refresher = threading.Thread(
+            target=self._refresh_leaderboard_loop, name='leaderboard')
+        self._leaderboard_refresher.daemon = True
+        self._leaderboard_refresher.start()
+
+    def refresh_leaderboard(self):
+        self.leaderboard.warm(
+            Score.objects.order_by('-score').limit(self.leaderboard.size))
+
+    def _refresh_leaderboard_loop(self):
+        while not self._closing.wait(self.LEADERBOARD_REFRESH_INTERVAL):
+            try:
+                self.refresh_leaderboard()
+            except Exception:
+                logger.exception('Unable to refresh the leaderboard')
+
+    def close(self):
+        self._closing.set()
+        if self._leaderboard_refresher is not None:
+            self._leaderboard_refresher.join()
+        if self.sessions is not None:
+            self.sessions.close()
+        tasks.close()
+        self.store.close()
+
+    def record_score(self, transport, user):
+        # Offered to the leaderboard, stored and tracked once the turn is
+        # saved: turns played again after a conflict don't repeat them.
+        score = super(Bot, self).record_score(transport, user)
+        transport.defer(lambda: tasks.send(
+            tasks.record_score, score.name, score.turns, score.money, score.score))
+        self.track(transport, 'win', user, turns=score.turns, money=score.money,
+                   score=score.score)
+        return score
+
+    def track(self, transport, name, user, **properties):
+        transport.defer(lambda: tasks.send(tasks.track, name, user.user_id, properties))
 
     def on_start(self, transport, chat, user):
-        user.turn = 0
-        user.in_intro = True
-        user.locations = {}
-        user.current_location = 'home_sweet_home'
-        user.inventory = []
-        user.current_npc = None
-        user.know_about_generator = False
-        user.filled_request = False
-        user.electrician_went_check = False
-        user.burned = False
-        user.win = False
-        user.money = 100
-        user.save()
-        transport.send_message(
-            chat, self.messages['intro'], keyboard=self.keyboards['intro'])
-
-    def handle_intro(self, transport, message, user):
-        user.in_intro = False
-        user.save()
-        if not user.name:
-            buttons = []
-            buttons.append(message.user.first_name)
-            if message.user.username:
-                buttons.append(message.user.username)
-            transport.send_message(
-                message.chat, self.messages['ask_name'],
-                keyboard=buttons)
-        else:
-            self.start(transport, message.chat, user)
-
-    def set_name(self, transport, message, user):
-        user.name = message.text
-        self.start(transport, message.chat, user)
-
-    def load_npc(self, user):
-        npc = npcs.NPCS[user.current_npc](
-            self.messages, user.npcs.get(user.current_npc))
-        user.npcs[user.current_npc] = npc.state
-        return npc
-
-    def load_location(self, user):
-        location = locations.LOCATIONS[user.current_location](
-            self.messages, user.locations.get(user.current_location))
-        user.locations[user.current_location] = location.state
-        return location
-
-    def make_location_keyboard(self, user, location):
-        buttons = []
-        buttons.append(self.messages['show_inventory'])
-        for o in location.state['objects']:
-            buttons.append(self.messages['take'].format(o))
-        buttons.extend(location.actions(user))
-        for npc_id in location.npcs(user):
-            npc = npcs.NPCS[npc_id](self.messages)
-            buttons.append(self.messages['talk'].format(npc.name))
-        return buttons
-
-    def start(self, transport, chat, user):
-        user.current_location = 'home_sweet_home'
-        location = self.load_location(user)
-        user.save()
-        transport.send_message(
-            chat,
-            self.messages['story'] + ' ' + location.description(user),
-            keyboard=self.make_location_keyboard(user, location))
-
-    def show_inventory(self, transport, user):
-        if user.inventory:
-            return self.messages['inventory'].format(
-                '\n'.join(
-                    transport.formatter.bold(self.messages['objects'][obj]) + ': ' +
-                    self.messages['objects_descriptions'][obj]
-                    for obj in user.inventory) +
-                    '\n' + transport.formatter.bold(self.messages['money']) + ': ' + str(user.money))
-        return self.messages['inventory_money'].format(user.money)
-
-    def on_turn(self, transport, chat, text, user):
-        user.turn += 1
-        action_result = None
-        if user.current_npc is not None:
-            npc = self.load_npc(user)
-            npc_phrase, phrases = npc.talk(text, user)
-            action_result = '*{}:* {}'.format(npc.name, npc_phrase)
-            if phrases is None:
-                user.current_npc = None
-                action_result += '\n\n'
-            else:
-                user.save()
-                return transport.send_message(chat,
-                    action_result,
-                    keyboard=phrases)
-        location = self.load_location(user)
-        new_location = None
-        if action_result is None and self.messages['show_inventory'] == text:
-            action_result = self.show_inventory(transport, user)
-        if action_result is None:
-            for npc_id in location.npcs(user):
-                npc = npcs.NPCS[npc_id](self.messages)
-                if self.messages['talk'].format(npc.name) == text:
-                    user.current_npc = npc.key
-                    npc = self.load_npc(user)
-                    npc_phrase, phrases = npc.greeting(user)
-                    action_result = '*{}:* {}'.format(npc.name, npc_phrase)
-                    if phrases is None:
-                        user.current_npc = None
-                        action_result += '\n\n'
-                    else:
-                        user.save()
-                        return transport.send_message(chat,
-                            action_result,
-                            keyboard=phrases)
-                    break
-        if action_result is None:
-            for i, o in enumerate(location.state['objects']):
-                if self.messages['take'].format(o) == text:
-                    action_result = self.messages['took'].format(o)
-                    user.inventory.append(o)
-                    del location.state['objects'][i]
-                    break
-        if action_result is None:
-            new_location, action_result = location.handle_action(text, user)
-        user.locations[location.key] = location.state
-        if new_location:
-            user.current_location = new_location
-            location = self.load_location(user)
-        user.save()
-        transport.send_message(
-            chat, action_result + ' ' + location.description(user),
-            keyboard=self.make_location_keyboard(user, location))
-
-    def on_help(self, transport, chat):
-        transport.send_message(
-            chat, self.messages['help'])
-
-    def on_win(self, transport, chat, user):
-        Score(name=user.name, turns=user.turn,
-              money=user.money, score=50*user.turn + user.money).save()
-        transport.send_message(
-            chat, self.messages['you_won'].format(
-                user.turn, user.money, 50*user.turn + user.money))
-        self.highscores(transport, chat)
-
-    def highscores(self, transport, chat):
-        highscores = Score.objects.order_by('-score')[:10]
-        transport.send_message(
-            chat, self.messages['highscores'].format(
-                '\n'.join(
-                    self.messages['highscore'].format(
-                        i,
-                        transport.formatter.bold(score.name.replace('*', r'\*').replace('_', r'\_')),
-                        score.turns, score.money, score.score)
-                    for i, score in enumerate(highscores))))
+        self.track(transport, 'start', user)
+        super(Bot, self).on_start(transport, chat, user)
+
+    def fetch_user(self, user_id):
+        with metrics.span('fetch'):
+            return self.store.load(user_id)
+
+    def save_user(self, user):
+        with metrics.span('save'):
+            self.store.save(user)
+
+    def play_turn(self, transport, user_id, turn):
+        """Runs `turn(transport, user)` on the player and saves them.
+
+        Returns a BufferedTransport with the replies, to be flushed once the
+        turn is saved. If the player was changed concurrently the turn is
+        replayed on a fresh copy, up to MAX_TURN_ATTEMPTS times.
+        """
+        buffered = transport.buffered()
+        if self.sessions is not None:
+            # Replays answer nobody: the player has had the replies already.
+            self.sessions.apply(
+                user_id, lambda user: turn(buffered, user),
+                replay=lambda user: turn(transport.buffered(), user))
+            return buffered
+
+        for attempt in range(1, self.MAX_TURN_ATTEMPTS + 1):
+            user = self.fetch_user(user_id)
+            turn(buffered, user)
+            try:
+                self.save_user(user)
+                return buffered
+            except persistence.VersionConflict:
+                TURN_CONFLICTS.inc()
+                if attempt == self.MAX_TURN_ATTEMPTS:
+                    raise
+                logger.warning('Player %s changed concurrently, replaying the turn.',
+                               user_id)
+                buffered.discard()
+
+    def load_content(self):
+        with metrics.span('content'):
+            super(Bot, self).load_content()
 
     def on_message(self, transport, message):
         logger.info('%s: %s', message.user.pretty(), message.text)
-        script_dir = os.path.dirname(os.path.abspath(__file__))
-        with open(os.path.join(script_dir, 'messages.yaml')) as f:
-            self.messages = yaml.load(f)
-        with open(os.path.join(script_dir, 'keyboards.yaml')) as f:
-            self.keyboards = yaml.load(f)
-
-        user = User.objects(user_id=message.user.id).first()
-        if user is None:
-            user = User(user_id=message.user.id, turn=0, in_intro=True)
-            return self.on_start(transport, message.chat, user)
-        if message.text == '/help':
-            return self.on_help(transport, message.chat)
-        if message.text == '/start':
-            return self.on_start(transport, message.chat, user)
-        if message.text == '/highscores':
-            return self.highscores(transport, message.chat)
-
-        # development cheats {
-        if message.text == '/reset':
-            self.reset(user)
-            return self.on_start(transport, message.chat, user)
-        if message.text.startswith('/pleasegiveme '):
-            good = message.text[len('/pleasegiveme '):]
-            if good in self.messages['objects']:
-                user.inventory.append(good)
-        if message.text.startswith('/drop '):
-            good = message.text[len('/drop '):]
-            user.remove_one(good)
-        if message.text.startswith('/pleasegivememoney'):
-            user.money += 100
-        # } cheats
-
-        if user.win:
+        with metrics.turn():
+            self.load_content()
+            self.play_turn(
+                transport, message.user.id,
+                lambda buffered, user: self.handle_message(buffered, message, user)).flush()
+
+    def on_messages(self, transport, messages):
+        for message in messages:
+            logger.info('%s: %s', message.user.pretty(), message.text)
+
+        def turn(buffered, user):
+            for message in messages:
+                buffered.begin()
+                self.handle_message(buffered, message, user)
+
+        try:
+            with metrics.turn():
+                self.load_content()
+                buffered = self.play_turn(transport, messages[0].user.id, turn)
+        except Exception:
+            # Nothing of the burst is saved: play it again message by message,
+            # so the ones before a bad message are saved and answered.
+            logger.exception('Unable to play %s messages at once, playing them one by one.',
+                             len(messages))
+            for message in messages:
+                try:
+                    self.on_message(transport, message)
+                except Exception:
+                    logger.exception('Failed to handle %s', message)
             return
-
-        if user.in_intro:
-            return self.handle_intro(transport, message, user)
-        if not user.name:
-            return self.set_name(transport, message, user)
-
-        self.on_turn(transport, message.chat, message.text, user)
-        if user.win:
-            self.on_win(transport, message.chat, user)
+        buffered.flush(self.reply_mode)
+
+    def is_new_update(self, user, message):
+        # Update ids only grow, so anything up to the last applied one has
+        # been delivered again (e.g. fetched again after a restart).
+        if message.update_id is None:
+            return True
+        if user.last_update_id is not None and message.update_id <= user.last_update_id:
+            return False
+        user.last_update_id = message.update_id
+        return True
+
+    def handle_message(self, transport, message, user):
+        if not self.is_new_update(user, message):
+            logger.info('Skipping update %s, already handled.', message.update_id)
+            return
+        with metrics.span('rules'):
+            super(Bot, self).handle_message(transport, message, user)
+
+
+def outbox_options(args):
+    if not args.outbox:
+        return None
+    return {
+        'global_rate': args.global_rate,
+        'chat_rate': args.chat_rate,
+    }
+
+
+# Outbox.metrics() keys exported, with their types and descriptions.
+OUTBOX_METRICS = (
+    ('depth', 'gauge', 'Messages waiting to be sent.'),
+    ('enqueued', 'counter', 'Messages queued.'),
+    ('sent', 'counter', 'Requests sent, each with one or more messages.'),
+    ('coalesced', 'counter', 'Messages merged into another one.'),
+    ('retried', 'counter', 'Sends put back after flood control.'),
+    ('failed', 'counter', 'Messages given up on.'),
+    ('wait_seconds_total', 'counter', 'Time messages spent queued.'),
+    ('wait_seconds_max', 'gauge', 'Longest time a message spent queued.'),
+)
+
+
+def export_metrics(transport):
+    outbox = transport.outbox
+    if outbox is None:
+        return
+    for key, type, help in OUTBOX_METRICS:
+        name = 'bot_outbox_' + key
+        if type == 'counter' and not name.endswith('_total'):
+            name += '_total'
+        metrics.callback(name, help, lambda key=key: outbox.metrics()[key], type)
+
+
+def serve_metrics(listen):
+    # Webhook mode serves /metrics with the webhook; polling needs the app
+    # running aside. Bound right away, so a taken port fails loudly.
+    host, _, port = listen.rpartition(':')
+    server = werkzeug.serving.make_server(host, int(port), app.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+
+
+def shard_listen(listen, number):
+    """Address shard `number` serves its metrics on: the ports after `listen`."""
+    host, _, port = listen.rpartition(':')
+    return '{}:{}'.format(host, int(port) + 1 + number)
+
+
+def make_bot(args):
+    # With hot reload the watcher tells when content changes, otherwise the
+    # store checks content files itself.
+    check_interval = None if args.hotreload_internal else 1.0
+    bot = Bot(content.ContentStore(cache_path=args.content_cache,
+                                   check_interval=check_interval),
+              cache_size=args.cache_size, flush_interval=args.flush_interval,
+              reply_mode=args.coalesce, store=make_store(args))
+    bot.warm_up()
+    tasks.configure(bot.store)
+    return bot
+
+
+def make_store(args):
+    return stores.make(args.store, User, redis_url=args.redis_url,
+                       archive_interval=args.archive_interval)
+
+
+def transport_options(args, **overrides):
+    options = {
+        'workers': args.workers,
+        'max_pending': args.max_pending,
+        'poll_timeout': args.poll_timeout,
+        'poll_limit': args.poll_limit,
+        'api_url': args.api_url,
+        'pool_size': args.http_pool,
+        'outbox_options': outbox_options(args),
+        'strict': args.strict,
+        'coalesce': args.coalesce != 'off',
+        'dedup_window': args.dedup_window,
+        'keyboard_columns': args.keyboard_columns,
+    }
+    options.update(overrides)
+    return options
+
+
+def make_checkpoint(args):
+    if not args.checkpoint:
+        return None
+    if args.checkpoint == 'mongo':
+        store = offsets.MongoStore()
+    else:
+        store = offsets.FileStore(args.checkpoint)
+    return offsets.Checkpoint(store, every=args.checkpoint_every,
+                              interval=args.checkpoint_interval)
+
+
+def run_webhook(bot, token, args, pool=None):
+    secret = args.webhook_secret or binascii.hexlify(os.urandom(16)).decode('ascii')
+    options = transport_options(args)
+    if bot is None:
+        # A sharded ingress only receives, shards send the replies.
+        options['outbox_options'] = None
+    transport = telegram.WebhookTransport(
+        bot, token, secret, queue_size=args.webhook_queue, pool=pool, **options)
+    export_metrics(transport)
+    transport.set_webhook('{}/telegram/{}'.format(args.webhook_url.rstrip('/'), secret))
+    app.app.config['TELEGRAM_TRANSPORT'] = transport
+    host, _, port = args.listen.rpartition(':')
+    try:
+        app.app.run(host=host, port=int(port), threaded=True)
+    finally:
+        # Otherwise getUpdates fails until the webhook is deleted by hand.
+        try:
+            transport.delete_webhook()
+        except Exception:
+            logger.exception('Unable to delete the webhook')
+        transport.close()
+        if bot is not None:
+            bot.close()
+
+
+def run_shard(queue, done, number, token, db_url, args):
+    # The ingress process stops shards by draining their queues.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    mongoengine.connect('default', host=db_url)
+    bot = make_bot(args)
+    transport = telegram.Transport(bot, token, **transport_options(args, workers=0))
+    # Turns are played here, so are their metrics.
+    export_metrics(transport)
+    if args.metrics_listen:
+        serve_metrics(shard_listen(args.metrics_listen, number))
+    try:
+        shards.serve(queue, done, transport.handle_batch)
+    finally:
+        transport.close()
+        bot.close()
+
+
+def run_sharded(token, db_url, args):
+    pool = shards.ShardPool(
+        run_shard, (token, db_url, args),
+        shards=args.shards, queue_size=args.max_pending)
+    if args.webhook_url:
+        return run_webhook(None, token, args, pool=pool)
+
+    # Connected only now, after the shards have forked.
+    mongoengine.connect('default', host=db_url)
+    if args.metrics_listen:
+        serve_metrics(args.metrics_listen)
+    # The ingress only polls, shards send the replies.
+    transport = telegram.Transport(
+        None, token, pool=pool, checkpoint=make_checkpoint(args),
+        **transport_options(args, outbox_options=None))
+    try:
+        while True:
+            transport.poll()
+    except KeyboardInterrupt:
+        logger.info('Stopping.')
+    finally:
+        transport.close()
 
 
-def run():
-    logging.basicConfig(level='INFO')
+def make_parser(token=None, db_url=None):
+    """Command line parser; `token` and `db_url` are arguments unless given."""
     parser = argparse.ArgumentParser()
-    token = os.environ.get('TOKEN')
-    db_url = os.environ.get('DB_URL')
     if not token:
         parser.add_argument('token')
     if not db_url:
         parser.add_argument('dburl')
     parser.add_argument('--hotreload', default=False, action='store_true')
     parser.add_argument('--hotreload-internal', default=False, action='store_true')
+    parser.add_argument('--content-cache', default=os.environ.get('CONTENT_CACHE'))
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 0)),
+                        help='Handle updates of different chats in parallel.')
+    parser.add_argument('--max-pending', type=int, default=256)
+    parser.add_argument('--poll-timeout', type=int, default=int(os.environ.get('POLL_TIMEOUT', 30)),
+                        help='getUpdates long-polling timeout, 0 polls every second.')
+    parser.add_argument('--poll-limit', type=int, default=100)
+    parser.add_argument('--webhook-url', default=os.environ.get('WEBHOOK_URL'),
+                        help='Public base URL to receive updates at instead of polling.')
+    parser.add_argument('--webhook-secret', default=os.environ.get('WEBHOOK_SECRET'))
+    parser.add_argument('--webhook-queue', type=int, default=1000)
+    parser.add_argument('--listen', default=os.environ.get('LISTEN', '0.0.0.0:8080'))
+    parser.add_argument('--checkpoint', default=os.environ.get('CHECKPOINT'),
+                        help='Keep the handled update offset in this file, or in '
+                             'the database with "mongo".')
+    parser.add_argument('--checkpoint-every', type=int, default=100,
+                        help='Save the offset after this many updates...')
+    parser.add_argument('--checkpoint-interval', type=float, default=5.0,
+                        help='...or this many seconds.')
+    parser.add_argument('--dedup-window', type=int, default=10000,
+                        help='Drop updates repeating one of this many recent ones.')
+    parser.add_argument('--store', choices=('mongo', 'memory', 'redis', 'tiered'),
+                        default=os.environ.get('STORE', 'mongo'),
+                        help='Where players live; "tiered" serves them from Redis and '
+                             'archives them to Mongo.')
+    parser.add_argument('--redis-url', default=os.environ.get('REDIS_URL', stores.REDIS_URL))
+    parser.add_argument('--archive-interval', type=float, default=5.0,
+                        help='Longest time a player change waits to be archived, in seconds.')
+    parser.add_argument('--cache-size', type=int, default=int(os.environ.get('CACHE_SIZE', 0)),
+                        help='Keep up to this many players in memory and save them in background.')
+    parser.add_argument('--flush-interval', type=float, default=5.0,
+                        help='Longest time a cached player change may stay unsaved, in seconds.')
+    parser.add_argument('--http-pool', type=int, default=10,
+                        help='Keep-alive connections to the Bot API.')
+    parser.add_argument('--outbox', default=False, action='store_true',
+                        help='Send replies in background within Telegram rate limits.')
+    parser.add_argument('--global-rate', type=float, default=30,
+                        help='Messages per second the outbox sends overall.')
+    parser.add_argument('--chat-rate', type=float, default=1,
+                        help='Messages per second the outbox sends to one chat.')
+    parser.add_argument('--strict', default=False, action='store_true',
+                        help='Validate all Bot API data with marshmallow schemas.')
+    parser.add_argument('--coalesce', default='off', choices=('off', 'last', 'merge'),
+                        help='Handle all updates of a chat in a batch at once, replying '
+                             'to the last one only or with one merged message.')
+    parser.add_argument('--shards', type=int, default=int(os.environ.get('SHARDS', 0)),
+                        help='Handle turns in this many worker processes, routed by chat.')
+    parser.add_argument('--metrics-sample', type=float, default=0.01,
+                        help='Fraction of turns to time phase by phase.')
+    parser.add_argument('--metrics-listen', default=os.environ.get('METRICS_LISTEN'),
+                        help='Serve /metrics on this address when polling; with --shards '
+                             'shard N serves its own on the port N+1 above.')
+    parser.add_argument('--remove-duplicate-users', default=False, action='store_true',
+                        help='Keep one player per user id, the one furthest in the '
+                             'game, and exit. Needed once before the first start '
+                             'that indexes user ids.')
+    parser.add_argument('--keyboard-columns', type=int, default=1,
+                        help='Buttons per keyboard row.')
+    parser.add_argument('--api-url', default=os.environ.get('API_URL'),
+                        help='Bot API base URL, e.g. a local fake Telegram server.')
+    return parser
+
+
+def run():
+    logging.basicConfig(level='INFO')
+    token = os.environ.get('TOKEN')
+    db_url = os.environ.get('DB_URL')
+    parser = make_parser(token, db_url)
     args = parser.parse_args()
     if not token:
         token = args.token
     if not db_url:
         db_url = args.dburl
+    if (args.hotreload or args.hotreload_internal) and (args.shards or args.webhook_url):
+        parser.error('--hotreload works only with polling in a single process.')
+    if args.hotreload_internal and args.poll_timeout:
+        args.poll_timeout = min(args.poll_timeout, HOTRELOAD_POLL_TIMEOUT)
 
     if args.hotreload:
-        command = [sys.executable, sys.argv[0], '--hotreload-internal', args.token, args.dburl]
+        command = [sys.executable, sys.argv[0], '--hotreload-internal'] + [
+            arg for arg in sys.argv[1:] if arg != '--hotreload']
         return hotreload.run(command)
 
+    if args.remove_duplicate_users:
+        mongoengine.connect('default', host=db_url)
+        logger.info('Removed %s duplicate players.', User.remove_duplicates())
+        return
+
+    metrics.set_sample_rate(args.metrics_sample)
+    metrics.watch_database()
+    if args.shards:
+        return run_sharded(token, db_url, args)
+
     db = mongoengine.connect('default', host=db_url)
-    bot = Bot()
-    transport = telegram.Transport(bot, token)
+    bot = make_bot(args)
+    if args.webhook_url:
+        return run_webhook(bot, token, args)
+
+    transport = telegram.Transport(
+        bot, token, checkpoint=make_checkpoint(args), **transport_options(args))
+    export_metrics(transport)
     if args.hotreload_internal:
-        reload_watcher = hotreload.ReloadWatcher()
+        return run_supervised(bot, transport, args.metrics_listen)
+    if args.metrics_listen:
+        serve_metrics(args.metrics_listen)
 
     try:
         while True:
-            transport.run()
-            if args.hotreload_internal:
-                reload_watcher.reload_if_needed()
-            time.sleep(1)
+            transport.poll()
     except KeyboardInterrupt:
         logger.exception('Stopping.')
-        if not args.hotreload_internal:
-            raise
-    except hotreload.NeedReload as e:
-        logger.info(e.message)
-        return 1
+        raise
+    finally:
+        transport.close()
+        bot.close()
+
+
+def run_supervised(bot, transport, metrics_listen=None):
+    control = hotreload.Control()
+    reload_watcher = hotreload.ReloadWatcher(on_content_change=bot.reload_content)
+    offset = control.ready()
+    if offset is not None:
+        transport.resume(offset)
+    # The previous worker has gone and freed the port.
+    if metrics_listen:
+        serve_metrics(metrics_listen)
+
+    def on_reload(e):
+        logger.info(str(e))
+        control.request_reload()
+
+    # Changes are picked up while polling waits for updates.
+    stop_watching = threading.Event()
+    watcher = threading.Thread(
+        target=reload_watcher.watch, args=(on_reload, stop_watching), name='reload-watcher')
+    watcher.daemon = True
+    watcher.start()
+    try:
+        while not control.stop_requested():
+            transport.poll()
+    except KeyboardInterrupt:
+        logger.info('Stopping.')
+    finally:
+        stop_watching.set()
+        watcher.join()
+        # Everything fetched is handled and saved before the next worker
+        # starts polling.
+        transport.close()
+        bot.close()
+    control.stopped(transport.last_update)
+
 
 if __name__ == '__main__':
     sys.exit(run())
@@ -0,0 +1,154 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_VERSION = 1
+
+
+class FrozenDict(dict):
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Content tables are read-only.')
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+class Content(object):
+    def __init__(self, messages, keyboards, digest):
+        super(Content, self).__init__()
+        self.messages = messages
+        self.keyboards = keyboards
+        self.digest = digest
+
+    def __repr__(self):
+        return '<Content digest={}>'.format(self.digest)
+
+
+class ContentStore(object):
+    """Keeps compiled messages/keyboards tables in memory.
+
+    Source files are re-read only when their mtime changes, and recompiled
+    only when their content hash changes. An optional on-disk pickle cache
+    lets cold starts skip YAML parsing entirely.
+    """
+
+    def __init__(self, directory=SCRIPT_DIR, cache_path=None, check_interval=1.0):
+        super(ContentStore, self).__init__()
+        self.paths = {
+            'messages': os.path.join(directory, 'messages.yaml'),
+            'keyboards': os.path.join(directory, 'keyboards.yaml'),
+        }
+        self.cache_path = cache_path
+        self.check_interval = check_interval
+        self.content = None
+        self._mtimes = None
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    @property
+    def messages(self):
+        return self.get().messages
+
+    @property
+    def keyboards(self):
+        return self.get().keyboards
+
+    def get(self):
+        content = self.content
+        if content is None:
+            return self.reload()
+        if (self.check_interval is not None and
+                time.time() - self._checked_at >= self.check_interval):
+            return self.reload_if_needed()
+        return content
+
+    def stat(self):
+        return tuple(
+            os.stat(path).st_mtime
+            for _, path in sorted(self.paths.items()))
+
+    def reload_if_needed(self):
+        self._checked_at = time.time()
+        if self.content is not None and self.stat() == self._mtimes:
+            return self.content
+        return self.reload()
+
+    def reload(self):
+        with self._lock:
+            mtimes = self.stat()
+            sources = {}
+            for name, path in self.paths.items():
+                with open(path, 'rb') as f:
+                    sources[name] = f.read()
+            digest = hashlib.sha1(
+                b''.join(sources[name] for name in sorted(sources))).hexdigest()
+
+            if self.content is None or self.content.digest != digest:
+                content = self.load_cache(digest)
+                if content is None:
+                    content = Content(
+                        messages=freeze(yaml.safe_load(sources['messages'])),
+                        keyboards=freeze(yaml.safe_load(sources['keyboards'])),
+                        digest=digest)
+                    self.save_cache(content)
+                if self.content is not None:
+                    logger.info('Content reloaded: %s', digest)
+                self.content = content
+
+            self._mtimes = mtimes
+            self._checked_at = time.time()
+            return self.content
+
+    def load_cache(self, digest):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, 'rb') as f:
+                version, cached_digest, messages, keyboards = pickle.load(f)
+        except Exception:
+            logger.exception('Broken content cache: %s', self.cache_path)
+            return None
+        if version != CACHE_VERSION or cached_digest != digest:
+            return None
+        return Content(messages=messages, keyboards=keyboards, digest=digest)
+
+    def save_cache(self, content):
+        if not self.cache_path:
+            return
+        tmp_path = self.cache_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(
+                    (CACHE_VERSION, content.digest, content.messages, content.keyboards),
+                    f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError):
+            logger.exception('Unable to write content cache: %s', self.cache_path)
@@ -0,0 +1,111 @@
+import collections
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher(object):
+    """Runs work items on a pool of threads, keeping per-key ordering.
+
+    Items sharing a key (a chat id) are handled strictly one after another,
+    items with different keys run in parallel on up to `workers` threads.
+    `submit` blocks once `max_pending` items are queued (backpressure).
+    """
+
+    def __init__(self, handle, workers=4, max_pending=256):
+        super(Dispatcher, self).__init__()
+        self.handle = handle
+        self.max_pending = max_pending
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._condition = threading.Condition()
+        self._queues = {}
+        self._ready = collections.deque()
+        self._pending = 0
+        self._stopping = False
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work, name='dispatcher-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def submit(self, key, item):
+        if self._stopping:
+            raise RuntimeError('Dispatcher is shut down.')
+        self._slots.acquire()
+        with self._condition:
+            self._pending += 1
+            queue = self._queues.get(key)
+            if queue is None:
+                # Key isn't owned by any worker: schedule it.
+                self._queues[key] = collections.deque([item])
+                self._ready.append(key)
+                self._condition.notify_all()
+            else:
+                queue.append(item)
+
+    def join(self):
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+
+    def shutdown(self, drain=True):
+        if drain:
+            self.join()
+        dropped = 0
+        with self._condition:
+            self._stopping = True
+            if not drain:
+                # Drop everything that isn't being handled right now.
+                for key in self._ready:
+                    dropped += len(self._queues.pop(key))
+                self._ready.clear()
+                for queue in self._queues.values():
+                    while len(queue) > 1:
+                        queue.pop()
+                        dropped += 1
+                self._pending -= dropped
+            self._condition.notify_all()
+        for _ in range(dropped):
+            self._slots.release()
+        for thread in self._threads:
+            thread.join()
+
+    def _next(self):
+        with self._condition:
+            while not self._ready:
+                if self._stopping:
+                    return None, None
+                self._condition.wait()
+            key = self._ready.popleft()
+            return key, self._queues[key][0]
+
+    def _done(self, key):
+        with self._condition:
+            queue = self._queues[key]
+            queue.popleft()
+            self._pending -= 1
+            if queue:
+                self._ready.append(key)
+            else:
+                del self._queues[key]
+            self._condition.notify_all()
+        self._slots.release()
+
+    def _work(self):
+        while True:
+            key, item = self._next()
+            if key is None:
+                return
+            try:
+                self.handle(item)
+            except Exception:
+                logger.exception('Failed to handle %s', item)
+            finally:
+                self._done(key)
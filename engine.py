@@ -0,0 +1,431 @@
+"""Game rules, independent of transports and storage.
+
+`Game` plays a message from a player against their state, sending replies
+through a transport-like object. `Engine.step` wraps it for simulations:
+plain in-memory state in, text and keyboard out.
+"""
+
+import copy
+import logging
+import threading
+
+import content
+import leaderboard
+import registry
+import transport
+
+logger = logging.getLogger(__name__)
+
+
+class State(object):
+    """In-memory player state with the same fields as bot.User."""
+
+    __slots__ = ('turn', 'in_intro', 'name', 'locations', 'inventory', 'current_npc',
+                 'npcs', 'current_location', 'know_about_generator', 'filled_request',
+                 'electrician_went_check', 'burned', 'money', 'win')
+
+    def __init__(self):
+        super(State, self).__init__()
+        # A player that has never played, like a freshly created bot.User.
+        self.turn = 0
+        self.in_intro = True
+        self.name = None
+        self.locations = {}
+        self.inventory = []
+        self.current_npc = None
+        self.npcs = {}
+        self.current_location = None
+        self.know_about_generator = None
+        self.filled_request = None
+        self.electrician_went_check = None
+        self.burned = None
+        self.money = None
+        self.win = None
+
+    def copy(self):
+        state = State()
+        for field in self.__slots__:
+            setattr(state, field, copy.deepcopy(getattr(self, field)))
+        return state
+
+    def remove_one(self, obj_to_remove):
+        for i, obj in enumerate(self.inventory):
+            if obj == obj_to_remove:
+                del self.inventory[i]
+                break
+
+
+class Content(object):
+    """One content version and what is built from it.
+
+    Reloads replace it as a whole, so a turn never mixes two versions.
+    """
+
+    def __init__(self, current):
+        super(Content, self).__init__()
+        self.digest = current.digest
+        self.messages = current.messages
+        self.keyboards = current.keyboards
+        self.registry = registry.Registry(current.messages)
+        # Location keyboards of this version, see make_location_keyboard.
+        self.location_keyboards = {}
+
+
+class Game(object):
+    MAX_LOCATION_KEYBOARDS = 10000
+
+    def __init__(self, content_store=None):
+        super(Game, self).__init__()
+        if content_store is None:
+            content_store = content.ContentStore()
+        self.content_store = content_store
+        self.leaderboard = leaderboard.Leaderboard(size=10)
+        self.content = None
+        # Content of the turn played by each thread, see handle_message.
+        self._turn = threading.local()
+        self.load_content()
+
+    def load_content(self):
+        current = self.content_store.get()
+        if self.content is not None and current.digest == self.content.digest:
+            return
+        self.content = Content(current)
+
+    @property
+    def current_content(self):
+        return getattr(self._turn, 'content', None) or self.content
+
+    @property
+    def messages(self):
+        return self.current_content.messages
+
+    @property
+    def keyboards(self):
+        return self.current_content.keyboards
+
+    @property
+    def registry(self):
+        return self.current_content.registry
+
+    @property
+    def location_keyboards(self):
+        return self.current_content.location_keyboards
+
+    @property
+    def content_digest(self):
+        return self.current_content.digest
+
+    def reload_content(self):
+        self.content_store.reload()
+        self.load_content()
+
+    def reset(self, user):
+        user.turn = 0
+        user.in_intro = True
+        user.name = None
+        user.locations =  {}
+        user.current_location = 'home_sweet_home'
+        user.inventory = []
+        user.current_npc = None
+        user.know_about_generator = False
+        user.filled_request = False
+        user.electrician_went_check = False
+        user.burned = False
+        user.win = False
+        user.money = 100
+
+    def on_start(self, transport, chat, user):
+        user.turn = 0
+        user.in_intro = True
+        user.locations = {}
+        user.current_location = 'home_sweet_home'
+        user.inventory = []
+        user.current_npc = None
+        user.know_about_generator = False
+        user.filled_request = False
+        user.electrician_went_check = False
+        user.burned = False
+        user.win = False
+        user.money = 100
+        transport.send_message(
+            chat, self.messages['intro'], keyboard=self.keyboards['intro'])
+
+    def handle_intro(self, transport, message, user):
+        user.in_intro = False
+        if not user.name:
+            buttons = []
+            buttons.append(message.user.first_name)
+            if message.user.username:
+                buttons.append(message.user.username)
+            transport.send_message(
+                message.chat, self.messages['ask_name'],
+                keyboard=buttons)
+        else:
+            self.start(transport, message.chat, user)
+
+    def set_name(self, transport, message, user):
+        user.name = message.text
+        self.start(transport, message.chat, user)
+
+    def load_npc(self, user):
+        npc = self.registry.npcs[user.current_npc]
+        state = user.npcs.get(user.current_npc)
+        if state is None:
+            state = npc.new_state()
+        user.npcs[user.current_npc] = state
+        return npc, state
+
+    def load_location(self, user):
+        location = self.registry.locations[user.current_location]
+        state = user.locations.get(user.current_location)
+        if state is None:
+            state = location.new_state()
+        user.locations[user.current_location] = state
+        return location, state
+
+    def make_location_keyboard(self, user, location, state):
+        # A keyboard depends only on what lies around and on what the
+        # location's guards and NPCs read, so players in the same situation
+        # share one tuple (and transports can cache its rendering).
+        key = (location.key, tuple(state['objects']), location.keyboard_key(state, user))
+        keyboard = self.location_keyboards.get(key)
+        if keyboard is not None:
+            return keyboard
+        buttons = []
+        buttons.append(self.messages['show_inventory'])
+        for o in state['objects']:
+            buttons.append(self.registry.take_button(o))
+        buttons.extend(location.actions(state, user))
+        for npc_id in location.npcs(user):
+            buttons.append(self.registry.talk_buttons[npc_id])
+        keyboard = tuple(buttons)
+        keyboards = self.location_keyboards
+        if len(keyboards) >= self.MAX_LOCATION_KEYBOARDS:
+            keyboards.clear()
+        keyboards[key] = keyboard
+        return keyboard
+
+    def start(self, transport, chat, user):
+        user.current_location = 'home_sweet_home'
+        location, state = self.load_location(user)
+        transport.send_message(
+            chat,
+            self.messages['story'] + ' ' + location.description(state, user),
+            keyboard=self.make_location_keyboard(user, location, state))
+
+    def show_inventory(self, transport, user):
+        if user.inventory:
+            return self.messages['inventory'].format(
+                '\n'.join(
+                    transport.formatter.bold(self.messages['objects'][obj]) + ': ' +
+                    self.messages['objects_descriptions'][obj]
+                    for obj in user.inventory) +
+                    '\n' + transport.formatter.bold(self.messages['money']) + ': ' + str(user.money))
+        return self.messages['inventory_money'].format(user.money)
+
+    def on_turn(self, transport, chat, text, user):
+        user.turn += 1
+        action_result = None
+        if user.current_npc is not None:
+            npc, npc_state = self.load_npc(user)
+            npc_phrase, phrases = npc.talk(npc_state, text, user)
+            action_result = transport.formatter.speech(npc.name, npc_phrase)
+            if phrases is None:
+                user.current_npc = None
+                action_result += '\n\n'
+            else:
+                return transport.send_message(chat,
+                    action_result,
+                    keyboard=phrases)
+        location, state = self.load_location(user)
+        new_location = None
+        if action_result is None and self.messages['show_inventory'] == text:
+            action_result = self.show_inventory(transport, user)
+        if action_result is None:
+            npc_id = self.registry.npc_by_talk_button.get(text)
+            if npc_id is not None and npc_id in location.npcs(user):
+                user.current_npc = npc_id
+                npc, npc_state = self.load_npc(user)
+                npc_phrase, phrases = npc.greeting(npc_state, user)
+                action_result = transport.formatter.speech(npc.name, npc_phrase)
+                if phrases is None:
+                    user.current_npc = None
+                    action_result += '\n\n'
+                else:
+                    return transport.send_message(chat,
+                        action_result,
+                        keyboard=phrases)
+        if action_result is None:
+            for i, o in enumerate(state['objects']):
+                if self.registry.take_button(o) == text:
+                    action_result = self.messages['took'].format(o)
+                    user.inventory.append(o)
+                    del state['objects'][i]
+                    break
+        if action_result is None:
+            new_location, action_result = location.handle_action(state, text, user)
+        user.locations[location.key] = state
+        if new_location:
+            user.current_location = new_location
+            location, state = self.load_location(user)
+        transport.send_message(
+            chat, action_result + ' ' + location.description(state, user),
+            keyboard=self.make_location_keyboard(user, location, state))
+
+    def on_help(self, transport, chat):
+        transport.send_message(
+            chat, self.messages['help'])
+
+    def record_score(self, transport, user):
+        score = leaderboard.Entry(user.name, user.turn, user.money,
+                                  50*user.turn + user.money)
+        # Once the turn is over: a turn played again records it once.
+        transport.defer(lambda: self.leaderboard.offer(score))
+        return score
+
+    def on_win(self, transport, chat, user):
+        score = self.record_score(transport, user)
+        transport.send_message(
+            chat, self.messages['you_won'].format(
+                user.turn, user.money, 50*user.turn + user.money))
+        self.highscores(transport, chat, score)
+
+    def render_highscores(self, transport, highscores):
+        return self.messages['highscores'].format(
+            '\n'.join(
+                self.messages['highscore'].format(
+                    i,
+                    transport.formatter.bold(score.name.replace('*', r'\*').replace('_', r'\_')),
+                    score.turns, score.money, score.score)
+                for i, score in enumerate(highscores)))
+
+    def highscores(self, transport, chat, new_score=None):
+        """Sends the leaderboard, with `new_score` if it's not offered yet."""
+        render = lambda highscores: self.render_highscores(transport, highscores)
+        if new_score is not None:
+            return transport.send_message(
+                chat, render(self.leaderboard.with_score(new_score)))
+        transport.send_message(
+            chat, self.leaderboard.render(
+                (self.content_digest, type(transport.formatter)), render))
+
+    def handle_message(self, transport, message, user):
+        # Content reloaded meanwhile is for the next turn.
+        self._turn.content = self.content
+        try:
+            return self.play(transport, message, user)
+        finally:
+            self._turn.content = None
+
+    def play(self, transport, message, user):
+        if user.current_location is None:
+            # Never started: on_start always sets a location.
+            return self.on_start(transport, message.chat, user)
+        if message.text == '/help':
+            return self.on_help(transport, message.chat)
+        if message.text == '/start':
+            return self.on_start(transport, message.chat, user)
+        if message.text == '/highscores':
+            return self.highscores(transport, message.chat)
+
+        # development cheats {
+        if message.text == '/reset':
+            self.reset(user)
+            return self.on_start(transport, message.chat, user)
+        if message.text.startswith('/pleasegiveme '):
+            good = message.text[len('/pleasegiveme '):]
+            if good in self.messages['objects']:
+                user.inventory.append(good)
+        if message.text.startswith('/drop '):
+            good = message.text[len('/drop '):]
+            user.remove_one(good)
+        if message.text.startswith('/pleasegivememoney'):
+            user.money += 100
+        # } cheats
+
+        if user.win:
+            return
+
+        if user.in_intro:
+            return self.handle_intro(transport, message, user)
+        if not user.name:
+            return self.set_name(transport, message, user)
+
+        self.on_turn(transport, message.chat, message.text, user)
+        if user.win:
+            self.on_win(transport, message.chat, user)
+
+
+class Formatter(transport.Formatter):
+    def bold(self, text):
+        return text.strip()
+
+    def speech(self, name, phrase):
+        return '{}: {}'.format(name, phrase)
+
+
+class Replies(object):
+    """Transport stand-in that keeps what is sent to the player.
+
+    It formats with `formatter` and keeps NPC lines apart as well, as
+    (name, phrase) pairs in `speeches`. Callbacks passed to `defer` run on
+    `flush`.
+    """
+
+    def __init__(self, formatter):
+        super(Replies, self).__init__()
+        self._formatter = formatter
+        self.texts = []
+        self.speeches = []
+        self.keyboard = None
+        self.deferred = []
+
+    @property
+    def formatter(self):
+        return self
+
+    def bold(self, text):
+        return self._formatter.bold(text)
+
+    def speech(self, name, phrase):
+        self.speeches.append((name, phrase))
+        return self._formatter.speech(name, phrase)
+
+    def send_message(self, chat, text, keyboard=None, **kwargs):
+        self.texts.append(text)
+        if keyboard:
+            self.keyboard = keyboard
+
+    def defer(self, callback):
+        self.deferred.append(callback)
+
+    def flush(self):
+        deferred, self.deferred = self.deferred, []
+        for callback in deferred:
+            callback()
+
+
+class Engine(object):
+    """Plays turns without I/O, e.g. for balance testing and simulations.
+
+    Content is read once on creation; the player is introduced as
+    `first_name` (and `username`) when the game asks their name.
+    """
+
+    def __init__(self, game=None, formatter=None, first_name='Player', username=None):
+        super(Engine, self).__init__()
+        self.game = game or Game()
+        self.formatter = formatter or Formatter()
+        self.user = transport.User(0, 'engine', first_name, username=username)
+        self.chat = transport.Chat()
+
+    def step(self, state, text):
+        """Plays `text` against `state`, which is updated in place.
+
+        Returns the state, the reply (several messages are joined by an empty
+        line, None if there's no answer) and the newest keyboard.
+        """
+        replies = Replies(self.formatter)
+        self.game.handle_message(replies, transport.Message(text, self.user, self.chat), state)
+        replies.flush()
+        return state, '\n\n'.join(replies.texts) or None, replies.keyboard
@@ -1,44 +1,297 @@
+import fnmatch
 import logging
 import os
 import subprocess
 import sys
+import threading
 import time
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
 logger = logging.getLogger(__name__)
 
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
 
 class NeedReload(Exception):
     pass
 
 
 class ReloadWatcher(object):
-    def __init__(self):
+    """Watches project sources and content for changes.
+
+    Only files matching `code_patterns` and `content_patterns` in `directory`
+    are watched, with inotify when `inotify_simple` is installed and by
+    comparing mtimes every `poll_interval` seconds otherwise. Changes are
+    acted upon once no more arrive for `debounce` seconds: content changes
+    are passed to `on_content_change`, code changes raise NeedReload.
+    """
+
+    def __init__(self, directory=PROJECT_DIR, on_content_change=None,
+                 code_patterns=('*.py',), content_patterns=('*.yaml',),
+                 debounce=0.5, poll_interval=1.0):
         super(ReloadWatcher, self).__init__()
-        self.launch_time = time.time()
+        self.directory = directory
+        self.on_content_change = on_content_change
+        self.code_patterns = code_patterns
+        self.content_patterns = content_patterns
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.changed = set()
+        self.last_change = None
+        self.last_poll = 0
+        self.mtimes = self.scan()
+        self.inotify = None
+        if inotify_simple is not None:
+            flags = inotify_simple.flags
+            self.inotify = inotify_simple.INotify()
+            self.inotify.add_watch(
+                directory,
+                flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE)
 
     def __call__(self):
         self.reload_if_needed()
 
-    def reload_if_needed(self):
-        changed_files = []
-        for module in sys.modules.values():
-            if module is None or '__file__' not in module.__dict__:
-                continue
+    def is_code(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.code_patterns)
+
+    def is_content(self, name):
+        return any(fnmatch.fnmatch(name, pattern) for pattern in self.content_patterns)
+
+    def scan(self):
+        mtimes = {}
+        for name in os.listdir(self.directory):
+            if self.is_code(name) or self.is_content(name):
+                try:
+                    mtimes[name] = os.stat(os.path.join(self.directory, name)).st_mtime
+                except OSError:
+                    continue
+        return mtimes
 
-            if os.stat(module.__file__).st_mtime > self.launch_time:
-                changed_files.append(module.__file__)
+    def collect(self):
+        now = time.time()
+        changed = set()
+        if self.inotify is not None:
+            changed.update(
+                event.name for event in self.inotify.read(timeout=0)
+                if self.is_code(event.name) or self.is_content(event.name))
+        elif now - self.last_poll >= self.poll_interval:
+            self.last_poll = now
+            mtimes = self.scan()
+            changed.update(
+                name for name in set(mtimes) | set(self.mtimes)
+                if mtimes.get(name) != self.mtimes.get(name))
+            self.mtimes = mtimes
+        if changed:
+            self.changed.update(changed)
+            self.last_change = now
+
+    def reload_if_needed(self):
+        self.collect()
+        if not self.changed or time.time() - self.last_change < self.debounce:
+            return
 
-        if changed_files:
+        changed, self.changed = sorted(self.changed), set()
+        code = [name for name in changed if self.is_code(name)]
+        if code:
             raise NeedReload('Reloading due changes in:\n' +
-                             '\n'.join(' - ' + path for path in changed_files))
+                             '\n'.join(' - ' + name for name in code))
+        logger.info('Content changed: %s', ', '.join(changed))
+        if self.on_content_change is not None:
+            self.on_content_change()
+
+    def watch(self, on_reload, stop, interval=0.1):
+        """Checks for changes every `interval` seconds until `stop` is set.
+
+        Code changes are passed to `on_reload` as NeedReload errors.
+        """
+        while not stop.wait(interval):
+            try:
+                self.reload_if_needed()
+            except NeedReload as e:
+                on_reload(e)
+            except Exception:
+                logger.exception('Unable to check for changes')
+
+
+def read_lines(stream, lines):
+    for line in iter(stream.readline, ''):
+        lines.put(line.split())
+    lines.put(None)
+
+
+class Worker(object):
+    """Supervisor's handle of a worker process.
+
+    Workers talk to the supervisor with text lines over their stdin/stdout:
+    the worker says `ready` once it can serve, waits for `start [offset]`,
+    asks for a replacement with `reload` and answers `stop` with
+    `stopped [offset]` once it has handled everything it has fetched.
+    """
+
+    def __init__(self, command):
+        super(Worker, self).__init__()
+        logger.info('Launching: %s', ' '.join(repr(part) for part in command))
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            universal_newlines=True)
+        self.lines = queue.Queue()
+        reader = threading.Thread(target=read_lines, args=(self.process.stdout, self.lines))
+        reader.daemon = True
+        reader.start()
+
+    def send(self, *words):
+        self.process.stdin.write(' '.join(str(word) for word in words) + '\n')
+        self.process.stdin.flush()
+
+    def receive(self, timeout=None):
+        """Returns the next message as a list of words, None on exit."""
+        try:
+            return self.lines.get(timeout=timeout)
+        except queue.Empty:
+            return []
+
+    def expect(self, word, timeout):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            message = self.receive(deadline - time.time())
+            if message is None:
+                return None
+            if message and message[0] == word:
+                return message[1:]
+        return None
+
+    def kill(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+
+
+class Supervisor(object):
+    """Restarts workers on code changes without a gap in polling.
+
+    A new worker is started while the old one still serves; the old one is
+    stopped only once the new one is ready, and hands over the last update
+    it has handled so the new one continues right after it.
+    """
+
+    def __init__(self, command, ready_timeout=120, stop_timeout=120):
+        super(Supervisor, self).__init__()
+        self.command = command
+        self.ready_timeout = ready_timeout
+        self.stop_timeout = stop_timeout
+
+    def spawn(self):
+        worker = Worker(self.command)
+        if worker.expect('ready', self.ready_timeout) is None:
+            logger.error('Worker failed to start.')
+            worker.kill()
+            return None
+        return worker
+
+    def handoff(self, old, new):
+        old.send('stop')
+        stopped = old.expect('stopped', self.stop_timeout)
+        if stopped is None:
+            logger.error('Worker did not stop in time, killing it.')
+            old.kill()
+            new.send('start')
+        else:
+            # Gone before the new one starts, with its ports free.
+            old.process.wait()
+            new.send('start', *stopped)
+        logger.info('Handed over to a new worker (offset: %s).',
+                    ' '.join(stopped or ()) or None)
+
+    def run(self):
+        current = None
+        try:
+            while True:
+                if current is None:
+                    current = self.spawn()
+                    if current is None:
+                        logger.info('Waiting for 1 second before relaunch...')
+                        time.sleep(1)
+                        continue
+                    current.send('start')
+
+                message = current.receive()
+                if message is None:
+                    code = current.process.wait()
+                    if not code:
+                        return 0
+                    logger.error('Worker exited with %s.', code)
+                    current = None
+                elif message == ['reload']:
+                    new = self.spawn()
+                    if new is not None:
+                        self.handoff(current, new)
+                        current = new
+        except KeyboardInterrupt:
+            logger.info('Stopping.')
+            if current is not None:
+                current.process.wait()
+
+
+class Control(object):
+    """Worker side of the supervisor protocol, see Worker."""
+
+    def __init__(self, stdin=sys.stdin, stdout=sys.stdout):
+        super(Control, self).__init__()
+        self.stdout = stdout
+        self.lines = queue.Queue()
+        # Set by the reader as soon as the supervisor asks to stop (or goes).
+        self.stopping = threading.Event()
+        reader = threading.Thread(target=self.read, args=(stdin,))
+        reader.daemon = True
+        reader.start()
+
+    def read(self, stdin):
+        for line in iter(stdin.readline, ''):
+            words = line.split()
+            if words == ['stop']:
+                self.stopping.set()
+            self.lines.put(words)
+        self.stopping.set()
+        self.lines.put(None)
+
+    def send(self, *words):
+        self.stdout.write(' '.join(str(word) for word in words) + '\n')
+        self.stdout.flush()
+
+    def ready(self):
+        """Reports readiness and blocks until told to start.
+
+        Returns the last update handled by the previous worker, if any.
+        """
+        self.send('ready')
+        while True:
+            message = self.lines.get()
+            if message is None:
+                raise KeyboardInterrupt('Supervisor has gone.')
+            if message and message[0] == 'start':
+                return int(message[1]) if message[1:] else None
+
+    def request_reload(self):
+        self.send('reload')
 
+    def stop_requested(self):
+        return self.stopping.is_set()
 
-def launch(command):
-    logger.info('Launching: %s', ' '.join(repr(part) for part in command))
-    return subprocess.call(command)
+    def stopped(self, offset):
+        if offset is None:
+            self.send('stopped')
+        else:
+            self.send('stopped', offset)
 
 
 def run(command):
-    while launch(command):
-        logger.info('Waiting for 1 second before relaunch...')
-        time.sleep(1)
+    return Supervisor(command).run()
@@ -0,0 +1,112 @@
+import bisect
+import collections
+import threading
+import time
+
+
+class Entry(object):
+    __slots__ = ('name', 'turns', 'money', 'score')
+
+    def __init__(self, name, turns, money, score):
+        self.name = name
+        self.turns = turns
+        self.money = money
+        self.score = score
+
+
+def fields(score):
+    return (score.name, score.turns, score.money, score.score)
+
+
+class Leaderboard(object):
+    """In-memory top-N scores table.
+
+    It is loaded with `warm` and kept up to date with `offer`. Scores
+    recorded by other processes show up when it's loaded again. Offered
+    scores may be stored after the next load, so they're kept on top of
+    loads that lack them for up to `pending_max_age` seconds.
+    Rendered tables are cached until the top-N changes.
+    """
+
+    def __init__(self, size=10, pending_max_age=60.0):
+        super(Leaderboard, self).__init__()
+        self.size = size
+        self.pending_max_age = pending_max_age
+        self._entries = []
+        self._keys = []
+        # (offered at, entry) of offered entries in the top-N.
+        self._pending = []
+        self._rendered = {}
+        self._lock = threading.Lock()
+
+    @property
+    def entries(self):
+        return list(self._entries)
+
+    def warm(self, scores):
+        now = time.time()
+        with self._lock:
+            old = [fields(e) for e in self._entries]
+            self._entries = []
+            self._keys = []
+            loaded = collections.Counter()
+            for score in scores:
+                self._insert(Entry(score.name, score.turns, score.money, score.score))
+                loaded[fields(score)] += 1
+            for offered_at, entry in self._pending:
+                if loaded[fields(entry)]:
+                    # Stored meanwhile.
+                    loaded[fields(entry)] -= 1
+                elif now - offered_at < self.pending_max_age:
+                    self._insert(entry)
+            self._prune_pending(now - self.pending_max_age)
+            if old != [fields(e) for e in self._entries]:
+                self._rendered = {}
+
+    def offer(self, score):
+        with self._lock:
+            entry = Entry(score.name, score.turns, score.money, score.score)
+            if self._insert(entry):
+                self._pending.append((time.time(), entry))
+                self._prune_pending()
+                self._rendered = {}
+
+    def with_score(self, score):
+        """Entries as they'd be once `score` is offered."""
+        with self._lock:
+            entries = list(self._entries)
+            index = bisect.bisect_right(self._keys, -score.score)
+        if index < self.size:
+            entries.insert(index, Entry(score.name, score.turns, score.money, score.score))
+            del entries[self.size:]
+        return entries
+
+    def _prune_pending(self, offered_after=None):
+        # Entries out of the top-N can't come back: scores are only added.
+        self._pending = [
+            (offered_at, entry) for offered_at, entry in self._pending
+            if (offered_after is None or offered_at > offered_after) and
+            any(e is entry for e in self._entries)]
+
+    def _insert(self, entry):
+        # Keys are negated so that bisect keeps the list in descending order;
+        # bisect_right places a new score after the older equal ones.
+        key = -entry.score
+        index = bisect.bisect_right(self._keys, key)
+        if index >= self.size:
+            return False
+        self._keys.insert(index, key)
+        self._entries.insert(index, entry)
+        del self._keys[self.size:]
+        del self._entries[self.size:]
+        return True
+
+    def render(self, key, render):
+        rendered = self._rendered.get(key)
+        if rendered is None:
+            with self._lock:
+                entries = list(self._entries)
+                cache = self._rendered
+            rendered = render(entries)
+            cache[key] = rendered
+        return rendered
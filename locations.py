@@ -2,15 +2,47 @@ import random
 
 import dice
 
+
+class Action(object):
+    """A player action offered by a location.
+
+    `message` is the key of the button text in the location messages,
+    `handler` the name of the method handling it (defaults to `message`) and
+    `guard` the name of a method telling whether it's available now.
+    """
+
+    def __init__(self, message, handler=None, guard=None, args=()):
+        super(Action, self).__init__()
+        self.message = message
+        self.handler = handler or message
+        self.guard = guard
+        self.args = args
+
+    def available(self, location, state, user):
+        return self.guard is None or getattr(location, self.guard)(state, user)
+
+    def __call__(self, location, state, user):
+        return getattr(location, self.handler)(state, user, *self.args)
+
+
 class Location(object):
-    def __init__(self, messages, state=None):
+    """Location behaviour, shared by all players.
+
+    One instance exists per location and content version; a player's state
+    of the location is passed to every method.
+    """
+
+    action_table = ()
+
+    def __init__(self, messages):
         super(Location, self).__init__()
         self._messages = messages
-        if state is None:
-            state = self.initial_state()
-            state['objects'] = self.objects()
+        self._compile_actions()
 
-        self.state = state
+    def new_state(self):
+        state = self.initial_state()
+        state['objects'] = self.objects()
+        return state
 
     def initial_state(self):
         return {}
@@ -26,26 +58,63 @@ class Location(object):
     def objects(self):
         return []
 
-    def actions(self, user):
-        return [
-            self.messages['go_to'][location]
+    def _compile_actions(self):
+        # Ordered (text, action) pairs for actions() and a text -> actions
+        # table for handle_action().
+        self._action_entries = [
+            (self.messages['go_to'][location], Action(None, 'go_to', args=(location,)))
             for location in self.nearby_locations()
         ]
+        self._action_entries.extend(
+            (self.messages[action.message], action)
+            for action in self.action_table)
+        self._action_table = {}
+        for text, action in self._action_entries:
+            self._action_table.setdefault(text, []).append(action)
+
+    def actions(self, state, user):
+        return [
+            text
+            for text, action in self._action_entries
+            if action.available(self, state, user)
+        ]
 
-    def handle_action(self, action, user):
-        for location in self.nearby_locations():
-            if self.messages['go_to'][location] == action:
-                return location, ''
+    def handle_action(self, state, action, user):
+        for candidate in self._action_table.get(action, ()):
+            if candidate.available(self, state, user):
+                return candidate(self, state, user)
         return None, self._messages['wrong_action']
 
+    def go_to(self, state, user, location):
+        return location, ''
+
     def nearby_locations(self):
         return []
 
     def npcs(self, user):
         return []
 
+    def keyboard_key(self, state, user):
+        """What `actions` and `npcs` depend on besides the objects around.
+
+        Locations with guarded actions or NPCs coming and going return the
+        state and player fields those read.
+        """
+        return ()
+
 
 class HomeSweetHome(Location):
+    action_table = (
+        Action('turn_off_gas', guard='is_gas_on'),
+        Action('turn_on_gas', guard='is_gas_off'),
+        Action('build_alcohol_machine', guard='is_alcohol_machine_requirements_satisfied'),
+        Action('install_generator', guard='can_install_generator'),
+        Action('install_alcohol_machine', guard='can_install_alcohol_machine'),
+        Action('make_booze', guard='is_alcohol_requirements_satisfied'),
+        Action('look_at_window'),
+        Action('inspect_table'),
+    )
+
     @property
     def key(self):
         return 'home_sweet_home'
@@ -62,98 +131,103 @@ class HomeSweetHome(Location):
     def nearby_locations(self):
         return ['street']
 
-    def actions(self, user):
-        actions = Location.actions(self, user)
-        if self.state['gas_on']:
-            actions.append(self.messages['turn_off_gas'])
-        else:
-            actions.append(self.messages['turn_on_gas'])
-        if all(good in user.inventory for good in [
-                'pipes', 'kettle', 'pot']):
-            actions.append(self.messages['build_alcohol_machine'])
-
-        if not self.state.get('generator_installed') and 'generator' in user.inventory:
-            actions.append(self.messages['install_generator'])
-        if not self.state.get('alcohol_machine_installed') and 'alcohol_machine' in user.inventory:
-            actions.append(self.messages['install_alcohol_machine'])
-        if self.is_alcohol_requirements_satisfied(user):
-            actions.append(self.messages['make_booze'])
-
-        actions.append(self.messages['look_at_window'])
-        actions.append(self.messages['inspect_table'])
-        return actions
-
-    def is_alcohol_machine_requirements_satisfied(self, user):
+    def is_gas_on(self, state, user):
+        return state['gas_on']
+
+    def is_gas_off(self, state, user):
+        return not state['gas_on']
+
+    def is_alcohol_machine_requirements_satisfied(self, state, user):
         return all(good in user.inventory for good in ('kettle', 'pot', 'pipes'))
 
-    def is_alcohol_requirements_satisfied(self, user):
+    def is_alcohol_requirements_satisfied(self, state, user):
         return (
             all(good in user.inventory for good in ('sugar', 'barm', 'bottle')) and
-            self.state.get('alcohol_machine_installed') and
-            self.state.get('gas_on'))
-
-    def handle_action(self, action, user):
-        if self.state['gas_on'] and self.messages['turn_off_gas'] == action:
-            self.state['gas_on'] = False
-            return None, self.messages['gas_turned_off']
-        if not self.state['gas_on'] and self.messages['turn_on_gas'] == action:
-            self.state['gas_on'] = True
-            if self.state.get('generator_installed'):
-                user.win = True
-            return None, self.messages['gas_turned_on']
-        if self.messages['look_at_window'] == action:
-            return None, self.messages['at_street']
-        if not self.state['table_inspected'] and self.messages['inspect_table'] == action:
-            self.state['table_inspected'] = True
-            user.inventory.append('electric_company_reciepts')
-            return None, self.messages['got_electric_company_receipts']
-        if self.state['table_inspected'] and self.messages['inspect_table'] == action:
+            state.get('alcohol_machine_installed') and
+            state.get('gas_on'))
+
+    def can_install_generator(self, state, user):
+        return not state.get('generator_installed') and 'generator' in user.inventory
+
+    def can_install_alcohol_machine(self, state, user):
+        return not state.get('alcohol_machine_installed') and 'alcohol_machine' in user.inventory
+
+    # Goods the guards above look for.
+    GUARD_GOODS = frozenset(['kettle', 'pot', 'pipes', 'sugar', 'barm', 'bottle',
+                             'generator', 'alcohol_machine'])
+
+    def keyboard_key(self, state, user):
+        return (state['gas_on'], bool(state.get('generator_installed')),
+                bool(state.get('alcohol_machine_installed')),
+                self.GUARD_GOODS.intersection(user.inventory))
+
+    def turn_off_gas(self, state, user):
+        state['gas_on'] = False
+        return None, self.messages['gas_turned_off']
+
+    def turn_on_gas(self, state, user):
+        state['gas_on'] = True
+        if state.get('generator_installed'):
+            user.win = True
+        return None, self.messages['gas_turned_on']
+
+    def look_at_window(self, state, user):
+        return None, self.messages['at_street']
+
+    def inspect_table(self, state, user):
+        if state['table_inspected']:
             return None, self.messages['nothing_found']
-        if not self.state.get('generator_installed') and 'generator' in user.inventory and action == self.messages['install_generator']:
-            if user.burned:
-                return None, self.messages['burnt'].format(self._messages['objects']['generator'])
-            if self.state['gas_on']:
-                user.burned = True
-                return None, self.messages['hot'].format(self._messages['objects']['generator'])
-            self.state['generator_installed'] = True
-            user.remove_one('generator')
-            return None, self.messages['generator_installed']
-        if self.is_alcohol_machine_requirements_satisfied(user) and action == self.messages['build_alcohol_machine']:
-            user.remove_one('alcohol_machine_parts_list')
-            user.remove_one('kettle')
-            user.remove_one('pot')
-            user.remove_one('pipes')
-            user.inventory.append('alcohol_machine')
-            return None, self.messages['alcohol_machine_built']
-        if not self.state.get('alcohol_machine_installed') and 'alcohol_machine' in user.inventory and action == self.messages['install_alcohol_machine']:
-            if user.burned:
-                return None, self.messages['burnt'].format(self._messages['objects']['alcohol_machine'])
-            if self.state['gas_on']:
-                user.burned = True
-                return None, self.messages['hot'].format(self._messages['objects']['alcohol_machine'])
-            self.state['alcohol_machine_installed'] = True
-            user.remove_one('alcohol_machine')
-            return None, self.messages['alcohol_machine_installed']
-        if self.is_alcohol_requirements_satisfied(user) and action == self.messages['make_booze']:
-            user.remove_one('sugar')
-            user.remove_one('barm')
-            user.remove_one('bottle')
-            user.inventory.append('booze')
-            return None, self.messages['made_booze']
-        return super(HomeSweetHome, self).handle_action(action, user)
-
-    def description(self, user):
+        state['table_inspected'] = True
+        user.inventory.append('electric_company_reciepts')
+        return None, self.messages['got_electric_company_receipts']
+
+    def install_generator(self, state, user):
+        if user.burned:
+            return None, self.messages['burnt'].format(self._messages['objects']['generator'])
+        if state['gas_on']:
+            user.burned = True
+            return None, self.messages['hot'].format(self._messages['objects']['generator'])
+        state['generator_installed'] = True
+        user.remove_one('generator')
+        return None, self.messages['generator_installed']
+
+    def build_alcohol_machine(self, state, user):
+        user.remove_one('alcohol_machine_parts_list')
+        user.remove_one('kettle')
+        user.remove_one('pot')
+        user.remove_one('pipes')
+        user.inventory.append('alcohol_machine')
+        return None, self.messages['alcohol_machine_built']
+
+    def install_alcohol_machine(self, state, user):
+        if user.burned:
+            return None, self.messages['burnt'].format(self._messages['objects']['alcohol_machine'])
+        if state['gas_on']:
+            user.burned = True
+            return None, self.messages['hot'].format(self._messages['objects']['alcohol_machine'])
+        state['alcohol_machine_installed'] = True
+        user.remove_one('alcohol_machine')
+        return None, self.messages['alcohol_machine_installed']
+
+    def make_booze(self, state, user):
+        user.remove_one('sugar')
+        user.remove_one('barm')
+        user.remove_one('bottle')
+        user.inventory.append('booze')
+        return None, self.messages['made_booze']
+
+    def description(self, state, user):
         text = self.messages['description']
-        if self.state.get('generator_installed'):
-            if self.state['gas_on']:
+        if state.get('generator_installed'):
+            if state['gas_on']:
                 text += ' ' + self.messages['generator_works'] + ' ' + self.messages['light']
             else:
                 text += ' ' + self.messages['generator_stopped'] + ' ' + self.messages['no_light']
         else:
             text += ' ' + self.messages['no_light']
-        if 'kettle' in self.state['objects']:
+        if 'kettle' in state['objects']:
             text += ' ' + self.messages['kettle_on_gas']
-        text += ' ' + self.messages['gas_on' if self.state['gas_on'] else 'gas_off']
+        text += ' ' + self.messages['gas_on' if state['gas_on'] else 'gas_off']
         return text
 
 
@@ -162,7 +236,7 @@ class Street(Location):
     def key(self):
         return 'street'
 
-    def description(self, user):
+    def description(self, state, user):
         return self.messages['description']
 
     def nearby_locations(self):
@@ -183,7 +257,7 @@ class ElectricCompany(Location):
     def key(self):
         return 'electry_company'
 
-    def description(self, user):
+    def description(self, state, user):
         text = self.messages['description']
         if not user.electrician_went_check:
             text += ' ' + self.messages['electrician']
@@ -200,12 +274,15 @@ class ElectricCompany(Location):
             npcs.append('electrician')
         return npcs
 
+    def keyboard_key(self, state, user):
+        return bool(user.electrician_went_check)
+
 class Hospital(Location):
     @property
     def key(self):
         return 'hospital'
 
-    def description(self, user):
+    def description(self, state, user):
         return self.messages['description']
 
     def nearby_locations(self):
@@ -220,7 +297,7 @@ class Garage(Location):
     def key(self):
         return 'garage'
 
-    def description(self, user):
+    def description(self, state, user):
         return self.messages['description']
 
     def nearby_locations(self):
@@ -235,7 +312,7 @@ class Shop(Location):
     def key(self):
         return 'shop'
 
-    def description(self, user):
+    def description(self, state, user):
         return self.messages['description']
 
     def nearby_locations(self):
@@ -246,11 +323,15 @@ class Shop(Location):
 
 
 class Junkyard(Location):
+    action_table = (
+        Action('try_find_something'),
+    )
+
     @property
     def key(self):
         return 'junkyard'
 
-    def description(self, user):
+    def description(self, state, user):
         return self.messages['description']
 
     def find_something(self):
@@ -290,23 +371,15 @@ class Junkyard(Location):
 
         return None
 
-    def actions(self, user):
-        actions = Location.actions(self, user)
-        actions.append(self.messages['try_find_something'])
-        return actions
-
-    def handle_action(self, action, user):
-        if action == self.messages['try_find_something']:
-            if self.state.get('last_lottery_turn', -11) + 10 < user.turn:
-                self.state['last_lottery_turn'] = user.turn
-                good = self.find_something()
-                if good is None:
-                    return None, self.messages['nothing_found']
-                user.inventory.append(good)
-                return None, self.messages['found'].format(good)
-            else:
-                return None, self.messages['already_searched']
-        return super(Junkyard, self).handle_action(action, user)
+    def try_find_something(self, state, user):
+        if state.get('last_lottery_turn', -11) + 10 < user.turn:
+            state['last_lottery_turn'] = user.turn
+            good = self.find_something()
+            if good is None:
+                return None, self.messages['nothing_found']
+            user.inventory.append(good)
+            return None, self.messages['found'].format(good)
+        return None, self.messages['already_searched']
 
     def nearby_locations(self):
         return ['street']
@@ -0,0 +1,257 @@
+"""In-process metrics in the Prometheus text format.
+
+Counters and histograms are cheap enough to update on every turn. The
+phases of a turn are timed with `span` only for the sampled fraction of
+turns (`set_sample_rate`); other spans cost one attribute lookup.
+"""
+
+import bisect
+import random
+import threading
+import time
+
+try:
+    import pymongo.monitoring
+except ImportError:
+    pymongo = None
+
+# Seconds; Prometheus' default buckets.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_metrics = []
+_local = threading.local()
+_sample_rate = 0.0
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for name, value in pairs) + '}'
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        super(Metric, self).__init__()
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._children = {}
+        self._lock = threading.Lock()
+        # Exported from the start, so rates work from the first scrape.
+        if not self.label_names:
+            self.labels()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+
+class _CounterValue(object):
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def _render_child(self, values, child):
+        yield '{}{} {}'.format(self.name, _format_labels(self.label_names, values), child.value)
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, help, labels)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def _render_child(self, values, child):
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            yield '{}_bucket{} {}'.format(
+                self.name, _format_labels(self.label_names, values, [('le', le)]), cumulative)
+        labels = _format_labels(self.label_names, values)
+        yield '{}_sum{} {}'.format(self.name, labels, total)
+        yield '{}_count{} {}'.format(self.name, labels, cumulative)
+
+
+class Callback(Metric):
+    """A value read from `function` when metrics are rendered."""
+
+    def __init__(self, name, help, function, type='gauge'):
+        super(Callback, self).__init__(name, help)
+        self.function = function
+        self.type = type
+
+    def _new_child(self):
+        return None
+
+    def render(self):
+        return ['# HELP {} {}'.format(self.name, self.help),
+                '# TYPE {} {}'.format(self.name, self.type),
+                '{} {}'.format(self.name, self.function())]
+
+
+def _register(metric):
+    _metrics.append(metric)
+    return metric
+
+
+def counter(name, help, labels=()):
+    return _register(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return _register(Histogram(name, help, labels, buckets))
+
+
+def callback(name, help, function, type='gauge'):
+    return _register(Callback(name, help, function, type))
+
+
+def render():
+    lines = []
+    for metric in list(_metrics):
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+TURNS = counter('bot_turns_total', 'Turns played.')
+TURN_ERRORS = counter('bot_turn_errors_total', 'Turns that failed.')
+TURN_SECONDS = histogram('bot_turn_seconds', 'Time to play a turn.')
+PHASE_SECONDS = histogram(
+    'bot_turn_phase_seconds', 'Time spent in phases of sampled turns.', ('phase',))
+DB_OPERATIONS = counter(
+    'bot_db_operations_total', 'Database commands sent.', ('operation',))
+DB_ERRORS = counter(
+    'bot_db_errors_total', 'Database commands that failed.', ('operation',))
+
+
+def set_sample_rate(rate):
+    """Sets the fraction of turns whose phases are timed."""
+    global _sample_rate
+    _sample_rate = rate
+
+
+class _Turn(object):
+    __slots__ = ('start',)
+
+    def __enter__(self):
+        _local.detailed = _sample_rate > 0 and random.random() < _sample_rate
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        TURN_SECONDS.observe(time.time() - self.start)
+        TURNS.inc()
+        if type is not None:
+            TURN_ERRORS.inc()
+        _local.detailed = False
+
+
+class _Span(object):
+    __slots__ = ('phase', 'start')
+
+    def __init__(self, phase):
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        PHASE_SECONDS.labels(self.phase).observe(time.time() - self.start)
+
+
+class _NoSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def turn():
+    """Times a turn and decides whether spans within it are timed too."""
+    return _Turn()
+
+
+def span(phase):
+    """Times a phase of a sampled turn in the current thread."""
+    if getattr(_local, 'detailed', False):
+        return _Span(phase)
+    return _NO_SPAN
+
+
+if pymongo is not None:
+    class DatabaseListener(pymongo.monitoring.CommandListener):
+        def started(self, event):
+            DB_OPERATIONS.labels(event.command_name).inc()
+
+        def succeeded(self, event):
+            pass
+
+        def failed(self, event):
+            DB_ERRORS.labels(event.command_name).inc()
+
+
+def watch_database():
+    """Counts database commands; call before connecting."""
+    if pymongo is not None:
+        pymongo.monitoring.register(DatabaseListener())
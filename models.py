@@ -0,0 +1,110 @@
+import datetime
+
+import mongoengine
+import pymongo
+
+
+class Score(mongoengine.Document):
+    name = mongoengine.StringField()
+    turns = mongoengine.LongField()
+    money = mongoengine.LongField()
+    score = mongoengine.LongField()
+
+    meta = {
+        'indexes': ['-score'],
+    }
+
+
+class User(mongoengine.Document):
+    user_id = mongoengine.LongField()
+    turn = mongoengine.LongField()
+    in_intro = mongoengine.BooleanField()
+    name = mongoengine.StringField()
+    locations = mongoengine.DictField()
+    inventory = mongoengine.ListField(mongoengine.StringField())
+    current_npc = mongoengine.StringField()
+    npcs = mongoengine.DictField()
+    current_location = mongoengine.StringField()
+    know_about_generator = mongoengine.BooleanField()
+    filled_request = mongoengine.BooleanField()
+    electrician_went_check = mongoengine.BooleanField()
+    burned = mongoengine.BooleanField()
+    money = mongoengine.IntField()
+    win = mongoengine.BooleanField()
+    # Last Telegram update applied, to skip repeated deliveries.
+    last_update_id = mongoengine.LongField()
+    # Incremented by every save, see persistence.save.
+    version = mongoengine.LongField(default=0)
+
+    meta = {
+        'indexes': [
+            {'fields': ['user_id'], 'unique': True},
+        ],
+    }
+
+    @classmethod
+    def fetch(cls, user_id):
+        son = cls._get_collection().find_one({'user_id': user_id})
+        return son and cls._from_son(son)
+
+    @classmethod
+    def initial_state(cls, user_id):
+        """Stored fields of a player who has never played."""
+        return {'user_id': user_id, 'turn': 0, 'in_intro': True}
+
+    @classmethod
+    def fetch_or_create(cls, user_id):
+        user = cls.fetch(user_id)
+        if user is not None:
+            return user
+        try:
+            son = cls._get_collection().find_one_and_update(
+                {'user_id': user_id},
+                {'$setOnInsert': cls.initial_state(user_id)},
+                upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+        except pymongo.errors.DuplicateKeyError:
+            # Lost an upsert race: the other insert is there now.
+            return cls.fetch(user_id)
+        return cls._from_son(son)
+
+    @classmethod
+    def remove_duplicates(cls):
+        """Keeps one player per user id, the one furthest in the game.
+
+        Players used to be created twice by racing first messages, which
+        stops user ids from being indexed as unique: run it once before.
+        Returns how many players were removed.
+        """
+        # Not _get_collection, which creates the index.
+        collection = cls._get_db()[cls._get_collection_name()]
+        groups = collection.aggregate([
+            {'$group': {'_id': '$user_id', 'count': {'$sum': 1}}},
+            {'$match': {'count': {'$gt': 1}}},
+        ])
+        removed = 0
+        for group in groups:
+            players = collection.find({'user_id': group['_id']}).sort('_id', 1)
+            # The oldest of equals, the one fetched so far.
+            keep = max(players, key=lambda player: (player.get('turn') or 0,
+                                                    player.get('version') or 0))
+            removed += collection.delete_many(
+                {'user_id': group['_id'], '_id': {'$ne': keep['_id']}}).deleted_count
+        return removed
+
+    def remove_one(self, obj_to_remove):
+        for i, obj in enumerate(self.inventory):
+            if obj == obj_to_remove:
+                del self.inventory[i]
+                break
+
+
+class Event(mongoengine.Document):
+    """Analytics event, see tasks.track."""
+    name = mongoengine.StringField()
+    user_id = mongoengine.LongField()
+    created = mongoengine.DateTimeField(default=datetime.datetime.utcnow)
+    properties = mongoengine.DictField()
+
+    meta = {
+        'indexes': ['name', 'created'],
+    }
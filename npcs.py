@@ -2,12 +2,19 @@ import dice
 
 
 class NPC(object):
-    def __init__(self, messages, state=None):
+    """NPC behaviour, shared by all players.
+
+    One instance exists per NPC and content version; a player's state of the
+    conversation is passed to every method.
+    """
+
+    def __init__(self, messages):
         super(NPC, self).__init__()
         self._messages = messages
-        if state is None:
-            state = self.initial_state()
-        self.state = state
+        self.name = self.messages['name']
+
+    def new_state(self):
+        return self.initial_state()
 
     def initial_state(self):
         return {}
@@ -16,18 +23,14 @@ class NPC(object):
     def key(self):
         return None
 
-    @property
-    def name(self):
-        return self.messages['name']
-
     @property
     def messages(self):
         return self._messages['npcs'][self.key]
 
-    def greeting(self, user):
+    def greeting(self, state, user):
         return 'What?', None
 
-    def talk(self, text, user):
+    def talk(self, state, text, user):
         return 'What have you said?', None
 
 class Electrician(NPC):
@@ -40,7 +43,7 @@ class Electrician(NPC):
             'sleeping': True,
         }
 
-    def make_phrases(self, user):
+    def make_phrases(self, state, user):
         if not user.filled_request:
             return None
 
@@ -50,19 +53,19 @@ class Electrician(NPC):
         phrases.append(self.messages['nothing'])
         return phrases
 
-    def greeting(self, user):
-        return self.messages['greeting'], self.make_phrases(user)
+    def greeting(self, state, user):
+        return self.messages['greeting'], self.make_phrases(state, user)
 
-    def talk(self, text, user):
+    def talk(self, state, text, user):
         if 'booze' not in user.inventory and text == self.messages['check_blackout']:
-            return self.messages['check_requirements'], self.make_phrases(user)
+            return self.messages['check_requirements'], self.make_phrases(state, user)
         if 'booze' in user.inventory and text == self.messages['check_blackout']:
             user.remove_one('booze')
             user.electrician_went_check = True
             return self.messages['will_check'], None
         if text == self.messages['nothing']:
             return 'Ouh-mn-mn...', None
-        return super(Electrician, self).talk(text, user)
+        return super(Electrician, self).talk(state, text, user)
 
 
 class ElectricCompanyAdministrator(NPC):
@@ -76,40 +79,40 @@ class ElectricCompanyAdministrator(NPC):
             'request_accepted': False,
         }
 
-    def make_phrases(self):
+    def make_phrases(self, state):
         phrases = []
         phrases.append(self.messages['ask_whats_a_reason'])
-        if self.state['asked']:
+        if state['asked']:
             phrases.append(self.messages['try_fill_request'])
         phrases.append(self.messages['nothing'])
         return phrases
 
-    def greeting(self, user):
-        return self.messages['greeting'], self.make_phrases()
+    def greeting(self, state, user):
+        return self.messages['greeting'], self.make_phrases(state)
 
-    def talk(self, text, user):
+    def talk(self, state, text, user):
         if text == self.messages['ask_whats_a_reason']:
-            self.state['asked'] = True
-            return self.messages['no_info'], self.make_phrases()
+            state['asked'] = True
+            return self.messages['no_info'], self.make_phrases(state)
         if ('electric_company_reciepts' not in user.inventory and
                 text == self.messages['try_fill_request']):
-            return self.messages['request_prerequesties'], self.make_phrases()
+            return self.messages['request_prerequesties'], self.make_phrases(state)
         if ('electric_company_reciepts' in user.inventory and
                 text == self.messages['try_fill_request']):
-            self.state['request_accepted'] = True
+            state['request_accepted'] = True
             user.remove_one('electric_company_reciepts')
             user.filled_request = True
-            return self.messages['request_accepted'], self.make_phrases()
+            return self.messages['request_accepted'], self.make_phrases(state)
         if text == self.messages['nothing']:
             return self.messages['go_out'], None
-        return super(ElectricCompanyAdministrator, self).talk(text, user)
+        return super(ElectricCompanyAdministrator, self).talk(state, text, user)
 
 class Doctor(NPC):
     @property
     def key(self):
         return 'doctor'
 
-    def make_phrases(self, user):
+    def make_phrases(self, state, user):
         phrases = []
         phrases.append(self.messages['ask_about_light'])
         if user.burned:
@@ -117,19 +120,19 @@ class Doctor(NPC):
         phrases.append(self.messages['nothing'])
         return phrases
 
-    def greeting(self, user):
-        return self.messages['greeting'], self.make_phrases(user)
+    def greeting(self, state, user):
+        return self.messages['greeting'], self.make_phrases(state, user)
 
-    def talk(self, text, user):
+    def talk(self, state, text, user):
         if text == self.messages['ask_about_light']:
             user.know_about_generator = True
-            return self.messages['backup_generator'], self.make_phrases(user)
+            return self.messages['backup_generator'], self.make_phrases(state, user)
         if text == self.messages['nothing']:
             return self.messages['be_careful'], None
         if user.burned and text == self.messages['heal_me']:
             user.burned = False
-            return self.messages['healed'], self.make_phrases(user)
-        return super(Doctor, self).talk(text, user)
+            return self.messages['healed'], self.make_phrases(state, user)
+        return super(Doctor, self).talk(state, text, user)
 
 
 class Mechanic(NPC):
@@ -137,17 +140,17 @@ class Mechanic(NPC):
     def key(self):
         return 'mechanic'
 
-    def make_phrases(self, user):
+    def make_phrases(self, state, user):
         phrases = []
-        if user.know_about_generator and not self.state.get('generator_builded'):
+        if user.know_about_generator and not state.get('generator_builded'):
             phrases.append(self.messages['can_you_build_generator'])
             if self.is_generator_requirements_satisfied(user):
                 phrases.append(self.messages['build_generator'])
         phrases.append(self.messages['nothing'])
         return phrases
 
-    def greeting(self, user):
-        return self.messages['greeting'], self.make_phrases(user)
+    def greeting(self, state, user):
+        return self.messages['greeting'], self.make_phrases(state, user)
 
     def is_generator_requirements_satisfied(self, user):
         return (all(good in user.inventory
@@ -159,12 +162,12 @@ class Mechanic(NPC):
                     'kettle']
                 ) and user.money >= 50)
 
-    def talk(self, text, user):
-        if user.know_about_generator and not self.state.get('generator_builded'):
+    def talk(self, state, text, user):
+        if user.know_about_generator and not state.get('generator_builded'):
             if text == self.messages['can_you_build_generator']:
                 if 'generator_requirments_list' not in user.inventory:
                     user.inventory.append('generator_requirments_list')
-                return self.messages['generator'], self.make_phrases(user)
+                return self.messages['generator'], self.make_phrases(state, user)
             if (text == self.messages['build_generator'] and
                     self.is_generator_requirements_satisfied(user)):
                 user.remove_one('magnet')
@@ -174,11 +177,11 @@ class Mechanic(NPC):
                 user.remove_one('generator_requirments_list')
                 user.money -= 50
                 user.inventory.append('generator')
-                self.state['generator_builded'] = True
-                return self.messages['generator_builded'], self.make_phrases(user)
+                state['generator_builded'] = True
+                return self.messages['generator_builded'], self.make_phrases(state, user)
         if text == self.messages['nothing']:
             return self.messages['bye'], None
-        return super(Mechanic, self).talk(text, user)
+        return super(Mechanic, self).talk(state, text, user)
 
 
 class Genry(NPC):
@@ -186,23 +189,23 @@ class Genry(NPC):
     def key(self):
         return 'genry'
 
-    def make_phrases(self, user):
+    def make_phrases(self, state, user):
         phrases = []
         phrases.append(self.messages['ask_about_machine'])
         phrases.append(self.messages['nothing'])
         return phrases
 
-    def greeting(self, user):
-        return self.messages['greeting'].format(user.name.replace('*', r'\*').replace('_', '\_')), self.make_phrases(user)
+    def greeting(self, state, user):
+        return self.messages['greeting'].format(user.name.replace('*', r'\*').replace('_', '\_')), self.make_phrases(state, user)
 
-    def talk(self, text, user):
+    def talk(self, state, text, user):
         if text == self.messages['ask_about_machine']:
             if 'alcohol_machine_parts_list' not in user.inventory:
                 user.inventory.append('alcohol_machine_parts_list')
-            return self.messages['machine'], self.make_phrases(user)
+            return self.messages['machine'], self.make_phrases(state, user)
         if text == self.messages['nothing']:
             return self.messages['bye'], None
-        return super(Genry, self).talk(text, user)
+        return super(Genry, self).talk(state, text, user)
 
 
 class Merchant(NPC):
@@ -224,30 +227,30 @@ class Merchant(NPC):
     def key(self):
         return 'merchant'
 
-    def sell_price(self, good):
-        d = self.state['goods'][good]
+    def sell_price(self, state, good):
+        d = state['goods'][good]
         if d < 7: # Nothing to sell
             return None
 
         return int(11 * self.baseline[good] / d)
 
-    def buy_price(self, good):
+    def buy_price(self, state, good):
         if good not in self.baseline:
             # Merchant will not buy/sell this.
             return None
 
-        d = self.state['goods'][good]
+        d = state['goods'][good]
         if d < 7: # Use x1.5 as a limit
             return int(self.baseline[good] * 1.2)
 
         # Get a 0.8 of sell price.
-        return int(self.sell_price(good) * 0.8)
+        return int(self.sell_price(state, good) * 0.8)
 
-    def make_phrases(self, user):
+    def make_phrases(self, state, user):
         phrases = []
-        if self.state.get('buying'):
+        if state.get('buying'):
             for good in self.baseline:
-                price = self.sell_price(good)
+                price = self.sell_price(state, good)
                 if price is None:
                     continue
 
@@ -255,9 +258,9 @@ class Merchant(NPC):
                     self.messages['buy'].format(
                         self._messages['objects'][good], price))
 
-        elif self.state.get('selling'):
+        elif state.get('selling'):
             for good in user.inventory:
-                price = self.buy_price(good)
+                price = self.buy_price(state, good)
                 if price is None:
                     continue
 
@@ -278,21 +281,21 @@ class Merchant(NPC):
 
         return goods
 
-    def greeting(self, user):
-        if self.state.get('goods_changed_turn', -50) + 50 < user.turn:
-            self.state['goods_changed_turn'] = user.turn
-            self.state['goods'] = self.make_goods()
+    def greeting(self, state, user):
+        if state.get('goods_changed_turn', -50) + 50 < user.turn:
+            state['goods_changed_turn'] = user.turn
+            state['goods'] = self.make_goods()
 
-        return self.messages['greeting'], self.make_phrases(user)
+        return self.messages['greeting'], self.make_phrases(state, user)
 
-    def talk(self, text, user):
-        if self.state.get('buying'):
+    def talk(self, state, text, user):
+        if state.get('buying'):
             if text == self.messages['nothing']:
-                self.state['buying'] = False
-                return self.messages['something_more'], self.make_phrases(user)
+                state['buying'] = False
+                return self.messages['something_more'], self.make_phrases(state, user)
 
             for good in self.baseline:
-                price = self.sell_price(good)
+                price = self.sell_price(state, good)
                 if good is None:
                     continue
 
@@ -303,20 +306,20 @@ class Merchant(NPC):
                 if user.money >= price:
                     user.money -= price
                     user.inventory.append(good)
-                    self.state['goods'][good] -= 1
-                    self.state['goods_changed_turn'] = user.turn
+                    state['goods'][good] -= 1
+                    state['goods_changed_turn'] = user.turn
                     return self.messages['bought'].format(
-                        self._messages['objects'][good], price), self.make_phrases(user)
+                        self._messages['objects'][good], price), self.make_phrases(state, user)
                 else:
                     return self.messages['not_enought_money'].format(
-                        self._messages['objects'][good], price), self.make_phrases(user)
-        elif self.state.get('selling'):
+                        self._messages['objects'][good], price), self.make_phrases(state, user)
+        elif state.get('selling'):
             if text == self.messages['nothing']:
-                self.state['selling'] = False
-                return self.messages['something_more'], self.make_phrases(user)
+                state['selling'] = False
+                return self.messages['something_more'], self.make_phrases(state, user)
 
             for good in user.inventory:
-                price = self.buy_price(good)
+                price = self.buy_price(state, good)
                 if price is None:
                     continue
 
@@ -325,23 +328,23 @@ class Merchant(NPC):
 
                 user.remove_one(good)
                 user.money += price
-                self.state['goods'][good] += 1
-                self.state['goods_changed_turn'] = user.turn
-                return self.messages['sold'].format(self._messages['objects'][good], price), self.make_phrases(user)
+                state['goods'][good] += 1
+                state['goods_changed_turn'] = user.turn
+                return self.messages['sold'].format(self._messages['objects'][good], price), self.make_phrases(state, user)
         else:
             if text == self.messages['wanna_buy']:
-                self.state['buying'] = True
-                return self.messages['what'], self.make_phrases(user)
+                state['buying'] = True
+                return self.messages['what'], self.make_phrases(state, user)
 
             if text == self.messages['wanna_sell']:
-                self.state['selling'] = True
-                return self.messages['what'], self.make_phrases(user)
+                state['selling'] = True
+                return self.messages['what'], self.make_phrases(state, user)
 
             if text == self.messages['nothing']:
-                del self.state['goods']
+                del state['goods']
                 return self.messages['come_again'], None
 
-        return super(Merchant, self).talk(text, user)
+        return super(Merchant, self).talk(state, text, user)
 
 NPCS = {
     'electrician': Electrician,
@@ -0,0 +1,126 @@
+"""Durable Telegram update offsets.
+
+A Checkpoint remembers the last update that has been handled, so that after
+a restart polling continues right after it instead of from whatever
+Telegram still holds unconfirmed.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+import mongoengine
+
+logger = logging.getLogger(__name__)
+
+
+class FileStore(object):
+    def __init__(self, path):
+        super(FileStore, self).__init__()
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, update_id):
+        # Written aside and renamed, so a crash never leaves half a number.
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write('{}\n'.format(update_id))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.path)
+
+
+class MongoStore(object):
+    def __init__(self, name='telegram', collection='offsets'):
+        super(MongoStore, self).__init__()
+        self.name = name
+        self.collection = collection
+
+    def _collection(self):
+        return mongoengine.connection.get_db()[self.collection]
+
+    def load(self):
+        document = self._collection().find_one({'_id': self.name})
+        return document and document.get('update_id')
+
+    def save(self, update_id):
+        self._collection().update_one(
+            {'_id': self.name}, {'$max': {'update_id': update_id}}, upsert=True)
+
+
+class Checkpoint(object):
+    """Writes the handled update offset to `store` in batches.
+
+    A write happens once `every` updates or `interval` seconds have passed
+    since the previous one, and on `flush`. Updates handled after the last
+    write may be fetched again after a crash, so handlers must tolerate
+    redeliveries.
+    """
+
+    def __init__(self, store, every=100, interval=5.0):
+        super(Checkpoint, self).__init__()
+        self.store = store
+        self.every = every
+        self.interval = interval
+        self.saved = None
+        self.current = None
+        self.saved_at = time.time()
+        self._lock = threading.Lock()
+
+    def load(self):
+        self.saved = self.current = self.store.load()
+        return self.saved
+
+    def update(self, update_id):
+        with self._lock:
+            if update_id is None or (self.current is not None and update_id <= self.current):
+                return
+            self.current = update_id
+            if (self.saved is not None and update_id - self.saved < self.every and
+                    time.time() - self.saved_at < self.interval):
+                return
+            self._save()
+
+    def _save(self):
+        try:
+            self.store.save(self.current)
+        except Exception:
+            logger.exception('Unable to save update offset %s', self.current)
+            return
+        self.saved = self.current
+        self.saved_at = time.time()
+
+    def flush(self):
+        with self._lock:
+            if self.current != self.saved:
+                self._save()
+
+
+class RecentUpdates(object):
+    """Remembers the last `size` update ids to drop repeated deliveries."""
+
+    def __init__(self, size=10000):
+        super(RecentUpdates, self).__init__()
+        self.size = size
+        self._order = collections.deque()
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    def add(self, update_id):
+        """Returns False if `update_id` has been seen already."""
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            self._seen.add(update_id)
+            self._order.append(update_id)
+            if len(self._order) > self.size:
+                self._seen.discard(self._order.popleft())
+            return True
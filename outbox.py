@@ -0,0 +1,245 @@
+import collections
+import heapq
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Telegram's text message length limit.
+MAX_TEXT_LENGTH = 4096
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = self.capacity
+        self.updated = time.time()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self.refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self.refill(now)
+        return self.tokens >= self.capacity
+
+
+class Stats(object):
+    def __init__(self):
+        super(Stats, self).__init__()
+        self.enqueued = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.retried = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class Outbox(object):
+    """Sends messages in background within Telegram's rate limits.
+
+    At most `global_rate` messages per second are sent overall and
+    `chat_rate` per chat. Messages queued for a chat while it waits for its
+    turn are sent as one when `coalesce` is on. Flood control answers (429)
+    put the message back until `retry_after` passes.
+    """
+
+    MAX_IDLE_CHATS = 10000
+
+    def __init__(self, send, senders=4, global_rate=30, chat_rate=1, chat_burst=1,
+                 coalesce=True, max_retries=5):
+        super(Outbox, self).__init__()
+        self.send = send
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.coalesce = coalesce
+        self.max_retries = max_retries
+        self.stats = Stats()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._queues = {}
+        self._ready = []
+        self._in_flight = set()
+        self._sequence = 0
+        self._pending = 0
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._threads = []
+        for i in range(senders):
+            thread = threading.Thread(target=self._work, name='outbox-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def depth(self):
+        return self._pending
+
+    def metrics(self):
+        stats = self.stats
+        return {
+            'depth': self._pending,
+            'enqueued': stats.enqueued,
+            'sent': stats.sent,
+            'coalesced': stats.coalesced,
+            'retried': stats.retried,
+            'failed': stats.failed,
+            'wait_seconds_total': stats.wait_total,
+            'wait_seconds_max': stats.wait_max,
+        }
+
+    def put(self, chat_id, params):
+        with self._condition:
+            if self._stopping:
+                raise RuntimeError('Outbox is closed.')
+            self.stats.enqueued += 1
+            self._pending += 1
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                queue = self._queues[chat_id] = collections.deque()
+            queue.append((time.time(), 0, params))
+            if chat_id not in self._in_flight and len(queue) == 1:
+                self._schedule(chat_id, time.time())
+
+    def _schedule(self, chat_id, not_before):
+        self._sequence += 1
+        heapq.heappush(self._ready, (not_before, self._sequence, chat_id))
+        self._condition.notify()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self):
+        with self._condition:
+            while True:
+                now = time.time()
+                if self._ready:
+                    not_before, _, chat_id = self._ready[0]
+                    wait = max(not_before - now, self._global.wait_time(now))
+                    if wait <= 0:
+                        heapq.heappop(self._ready)
+                        wait = self._chat_bucket(chat_id).wait_time(now)
+                        if wait > 0:
+                            self._schedule(chat_id, now + wait)
+                            continue
+                        return chat_id, self._take(chat_id, now)
+                elif self._stopping:
+                    return None, None
+                else:
+                    wait = None
+                self._condition.wait(wait)
+
+    def _take(self, chat_id, now):
+        self._global.take(now)
+        self._chat_bucket(chat_id).take(now)
+        self._in_flight.add(chat_id)
+        queue = self._queues[chat_id]
+        batch = [queue.popleft()]
+        while self.coalesce and queue and self._mergeable(batch, queue[0][2]):
+            batch.append(queue.popleft())
+        return batch
+
+    def _mergeable(self, batch, params):
+        first = batch[0][2]
+        if (params.get('parse_mode') != first.get('parse_mode') or
+                params.get('disable_notification') != first.get('disable_notification')):
+            return False
+        length = sum(len(item[2]['text']) + 2 for item in batch) + len(params['text'])
+        return length <= MAX_TEXT_LENGTH
+
+    def merge(self, batch):
+        params = dict(batch[0][2])
+        if len(batch) == 1:
+            return params
+        params['text'] = '\n\n'.join(item[2]['text'] for item in batch)
+        # Only the newest keyboard is still relevant.
+        for item in reversed(batch):
+            if 'reply_markup' in item[2]:
+                params['reply_markup'] = item[2]['reply_markup']
+                break
+        return params
+
+    def _finish(self, chat_id, batch, sent, retry_after=None):
+        now = time.time()
+        with self._condition:
+            self._in_flight.discard(chat_id)
+            queue = self._queues[chat_id]
+            if retry_after is not None:
+                self.stats.retried += 1
+                queue.extendleft(
+                    (enqueued, attempts + 1, params)
+                    for enqueued, attempts, params in reversed(batch))
+                self._schedule(chat_id, now + retry_after)
+                return
+            self._pending -= len(batch)
+            if sent:
+                self.stats.sent += 1
+                self.stats.coalesced += len(batch) - 1
+            else:
+                self.stats.failed += len(batch)
+            for enqueued, _, _ in batch:
+                wait = now - enqueued
+                self.stats.wait_total += wait
+                self.stats.wait_max = max(self.stats.wait_max, wait)
+            if queue:
+                self._schedule(chat_id, now)
+            else:
+                del self._queues[chat_id]
+            if len(self._chats) > len(self._queues) + self.MAX_IDLE_CHATS:
+                self._prune(now)
+            self._condition.notify_all()
+
+    def _prune(self, now):
+        # Buckets of idle chats that have refilled carry no state.
+        for chat_id, bucket in list(self._chats.items()):
+            if chat_id not in self._queues and bucket.full(now):
+                del self._chats[chat_id]
+
+    def _work(self):
+        while True:
+            chat_id, batch = self._next()
+            if chat_id is None:
+                return
+            sent = False
+            retry_after = None
+            try:
+                response = self.send(self.merge(batch))
+                sent = response.ok
+                if not sent:
+                    retry_after = response.parameters.get('retry_after')
+                    if retry_after is None or batch[0][1] >= self.max_retries:
+                        logger.error('Unable to send message to %s: %s',
+                                     chat_id, response.description)
+                        retry_after = None
+            except Exception:
+                logger.exception('Unable to send message to %s', chat_id)
+            self._finish(chat_id, batch, sent, retry_after)
+
+    def close(self, drain=True):
+        with self._condition:
+            while drain and self._pending:
+                self._condition.wait()
+            if not drain:
+                self._ready = []
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
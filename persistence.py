@@ -0,0 +1,109 @@
+"""Field-level delta saves for mongoengine documents.
+
+`track` remembers what a document looked like in the database, `save` then
+writes only what changed since: `$set`/`$unset` for changed nested keys,
+`$push` for items appended to a list and `$pull` for removed ones.
+
+Saves of versioned documents are compare-and-swap: they only apply if the
+stored version is still the one that was loaded.
+"""
+
+import copy
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class VersionConflict(Exception):
+    """The document was changed in the database since it was loaded."""
+
+
+def _state(document):
+    state = document.to_mongo().to_dict()
+    state.pop('_id', None)
+    return state
+
+
+def track(document):
+    document._persisted_state = copy.deepcopy(_state(document))
+    return document
+
+
+def clone(document):
+    """Deep copy of `document`, tracked like it."""
+    copied = copy.deepcopy(document)
+    persisted = getattr(document, '_persisted_state', None)
+    if persisted is not None:
+        # Replaced, never changed in place, so it can be shared.
+        copied._persisted_state = persisted
+    return copied
+
+
+def _diff_list(path, old, new, ops):
+    if old == new:
+        return
+    if len(new) > len(old) and new[:len(old)] == old:
+        ops.setdefault('$push', {})[path] = {'$each': new[len(old):]}
+        return
+    removed = []
+    for item in old:
+        if item not in new and item not in removed:
+            removed.append(item)
+    # $pull drops every occurrence of a value, so it only fits when the
+    # removed values don't remain in the list at all.
+    if removed and [item for item in old if item in new] == new:
+        ops.setdefault('$pull', {})[path] = {'$in': removed}
+        return
+    ops.setdefault('$set', {})[path] = new
+
+
+def diff(old, new, prefix='', ops=None):
+    if ops is None:
+        ops = {}
+    for key, value in new.items():
+        path = prefix + key
+        if key not in old:
+            ops.setdefault('$set', {})[path] = value
+        elif isinstance(value, dict) and isinstance(old[key], dict):
+            diff(old[key], value, path + '.', ops)
+        elif isinstance(value, list) and isinstance(old[key], list):
+            _diff_list(path, old[key], value, ops)
+        elif value != old[key]:
+            ops.setdefault('$set', {})[path] = value
+    for key in old:
+        if key not in new:
+            ops.setdefault('$unset', {})[prefix + key] = ''
+    return ops
+
+
+def save(document, version_field=None):
+    """Saves `document`, sending only changes made since `track`.
+
+    With `version_field` the write increments the version and raises
+    VersionConflict, leaving the database as it is, if someone else has
+    incremented it since `track`.
+    """
+    persisted = getattr(document, '_persisted_state', None)
+    if document.pk is None or persisted is None:
+        document.save()
+        return track(document)
+
+    state = _state(document)
+    ops = diff(persisted, state)
+    if ops:
+        query = {'_id': document.pk}
+        if version_field is not None:
+            version = persisted.get(version_field) or 0
+            # Documents saved before versioning have no version stored.
+            query[version_field] = version or {'$in': [None, 0]}
+            ops.setdefault('$set', {})[version_field] = version + 1
+        result = document._get_collection().update_one(query, ops)
+        if version_field is not None:
+            if not result.matched_count:
+                raise VersionConflict('{} {} has changed since it was loaded'.format(
+                    type(document).__name__, document.pk))
+            setattr(document, version_field, version + 1)
+            state[version_field] = version + 1
+    document._clear_changed_fields()
+    document._persisted_state = copy.deepcopy(state)
+    return document
@@ -0,0 +1,40 @@
+import locations
+import npcs
+
+
+class Registry(object):
+    """Shared NPC and location instances for one content version.
+
+    Also keeps the button texts built from content, so turns don't format
+    them again.
+    """
+
+    def __init__(self, messages):
+        super(Registry, self).__init__()
+        self.messages = messages
+        self.locations = {
+            key: cls(messages)
+            for key, cls in locations.LOCATIONS.items()
+        }
+        self.npcs = {
+            key: cls(messages)
+            for key, cls in npcs.NPCS.items()
+        }
+        self.talk_buttons = {
+            key: messages['talk'].format(npc.name)
+            for key, npc in self.npcs.items()
+        }
+        self.npc_by_talk_button = {
+            text: key
+            for key, text in self.talk_buttons.items()
+        }
+        self.take_buttons = {
+            obj: messages['take'].format(obj)
+            for obj in messages['objects']
+        }
+
+    def take_button(self, obj):
+        text = self.take_buttons.get(obj)
+        if text is None:
+            text = self.messages['take'].format(obj)
+        return text
@@ -0,0 +1,204 @@
+import collections
+import copy
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Entry(object):
+    def __init__(self, value):
+        super(Entry, self).__init__()
+        self.value = value
+        self.lock = threading.Lock()
+        self.dirty_since = None
+        # Turns played since the last save, to replay on a fresh copy.
+        self.turns = []
+        # Set once evicted and written, a session has to load afresh then.
+        self.evicted = False
+
+
+class SessionCache(object):
+    """In-process LRU cache of player documents with write-behind.
+
+    Changed documents are only marked dirty; they're written with `save` by
+    a background thread at most `flush_interval` seconds after the first
+    unsaved change (the durability bound), when they're evicted, when more
+    than `max_dirty` documents are waiting and on `close`.
+
+    If `save` raises one of the `stale` exceptions the cached copy is out of
+    date: the turns played on it since the last save are replayed on a
+    freshly loaded copy, which is saved instead.
+
+    Turns run on a copy made with `copy`, which replaces the cached document
+    only if the turn succeeds.
+    """
+
+    MAX_REPLAYS = 5
+
+    def __init__(self, load, save, capacity=10000, flush_interval=5.0, max_dirty=1000,
+                 stale=(), copy=copy.deepcopy):
+        super(SessionCache, self).__init__()
+        self.load = load
+        self.save = save
+        self.copy = copy
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.max_dirty = max_dirty
+        self.stale = tuple(stale)
+        self._entries = collections.OrderedDict()
+        # Evicted entries being written; they're taken back if asked for
+        # meanwhile, so nobody loads what's about to be overwritten.
+        self._evicting = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._flusher = threading.Thread(target=self._flush_loop, name='session-flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def apply(self, key, turn, replay=None):
+        """Runs `turn(document)` on the cached document, loading it on a miss.
+
+        The turn gets a copy, which becomes the cached document and is marked
+        dirty if the turn succeeds. If it raises, the cached document stays as
+        it was, changes of earlier turns included. `replay(document)` plays
+        the turn again if the document has to be reloaded before it's saved;
+        it defaults to `turn`.
+        """
+        while True:
+            entry = self._get(key)
+            with entry.lock:
+                if entry.evicted:
+                    continue
+                value = self.copy(entry.value)
+                result = turn(value)
+                entry.value = value
+                entry.turns.append(replay or turn)
+                self._mark_dirty(key, entry)
+                return result
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None) or self._evicting.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return entry
+
+        value = self.load(key)
+        evicted = []
+        with self._lock:
+            # Another thread may have loaded it meanwhile.
+            entry = (self._entries.pop(key, None) or self._evicting.pop(key, None) or
+                     Entry(value))
+            self._entries[key] = entry
+            while len(self._entries) > self.capacity:
+                evicted_key, evicted_entry = self._entries.popitem(last=False)
+                self._evicting[evicted_key] = evicted_entry
+                evicted.append((evicted_key, evicted_entry))
+        for evicted_key, evicted_entry in evicted:
+            self._evict(evicted_key, evicted_entry)
+        return entry
+
+    def _evict(self, key, entry):
+        with entry.lock:
+            saved = self._write(key, entry)
+            with self._lock:
+                if self._evicting.get(key) is not entry:
+                    # Taken back meanwhile.
+                    return
+                del self._evicting[key]
+                if saved:
+                    entry.evicted = True
+                else:
+                    # Kept until it can be saved.
+                    self._entries[key] = entry
+                    self._dirty.add(key)
+
+    def _mark_dirty(self, key, entry):
+        if entry.dirty_since is None:
+            entry.dirty_since = time.time()
+        with self._lock:
+            self._dirty.add(key)
+            if len(self._dirty) >= self.max_dirty:
+                self._wakeup.set()
+
+    def _write(self, key, entry):
+        """Saves `entry` if dirty; returns False if it's still to be saved.
+
+        The caller holds the entry's lock.
+        """
+        if entry.dirty_since is None:
+            return True
+        value = entry.value
+        for attempt in range(self.MAX_REPLAYS + 1):
+            if attempt:
+                value = self._replay(key, entry)
+            try:
+                self.save(value)
+                break
+            except self.stale as e:
+                logger.warning('Session %s changed meanwhile, replaying its turns: %s', key, e)
+            except Exception:
+                logger.exception('Unable to save session %s', key)
+                entry.value = value
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._dirty.add(key)
+                return False
+        else:
+            logger.error('Dropping session %s, changed concurrently %s times.',
+                         key, self.MAX_REPLAYS + 1)
+            with self._lock:
+                if self._entries.get(key) is entry:
+                    del self._entries[key]
+            entry.evicted = True
+        entry.value = value
+        entry.turns = []
+        entry.dirty_since = None
+        return True
+
+    def _replay(self, key, entry):
+        value = self.load(key)
+        for turn in entry.turns:
+            replayed = self.copy(value)
+            try:
+                turn(replayed)
+            except Exception:
+                logger.exception('Unable to replay a turn of session %s', key)
+                continue
+            value = replayed
+        return value
+
+    def flush(self):
+        with self._lock:
+            dirty = [
+                (key, self._entries[key])
+                for key in self._dirty
+                if key in self._entries
+            ]
+            self._dirty.clear()
+        for key, entry in dirty:
+            with entry.lock:
+                self._write(key, entry)
+        return len(dirty)
+
+    def _flush_loop(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Session flush failed')
+
+    def close(self):
+        self._stopping = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.flush()
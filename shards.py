@@ -0,0 +1,200 @@
+import itertools
+import logging
+import multiprocessing
+import threading
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+logger = logging.getLogger(__name__)
+
+
+class ShardPool(object):
+    """Runs handlers in worker processes, one queue per process.
+
+    Work is routed by key (a chat id), so all work of a key is handled in
+    order by the same process. `submit` blocks when the shard's queue holds
+    `queue_size` items. It has the Dispatcher interface, so a transport can
+    use it in place of a thread pool; `on_done(item)` is called in this
+    process once an item has been handled.
+
+    Process number N (from 0) runs `target(queue, done, N, *args)`, which
+    must `serve` the queues. A process that dies is started again within
+    `check_interval` seconds, and given again the items it had not
+    reported. An item being handled when its shard died `max_item_retries`
+    times is given up and reported done.
+    """
+
+    def __init__(self, target, args=(), shards=2, queue_size=256, on_done=None,
+                 check_interval=1.0, max_item_retries=1):
+        super(ShardPool, self).__init__()
+        self.target = target
+        self.args = tuple(args)
+        self.queue_size = queue_size
+        self.on_done = on_done
+        self.check_interval = check_interval
+        self.max_item_retries = max_item_retries
+        # Every shard has its own queues: a process dying while it reads or
+        # writes one leaves it locked for good.
+        self.queues = []
+        self.dones = []
+        self.processes = []
+        self._collectors = []
+        # Ticket -> (shard number, item, times its shard died handling it).
+        self._items = {}
+        self._tickets = itertools.count()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._exited = threading.Event()
+        for i in range(shards):
+            self.queues.append(multiprocessing.Queue(queue_size))
+            self.dones.append(multiprocessing.Queue())
+            self.processes.append(self._start(i))
+        # Started after forking: processes don't inherit threads.
+        for i in range(shards):
+            self._collectors.append(self._start_collector(i))
+        self._monitor = threading.Thread(target=self._watch, name='shard-monitor')
+        self._monitor.daemon = True
+        self._monitor.start()
+
+    def _start(self, number):
+        process = multiprocessing.Process(
+            target=self.target,
+            args=(self.queues[number], self.dones[number], number) + self.args,
+            name='shard-{}'.format(number))
+        process.daemon = True
+        process.start()
+        return process
+
+    def _start_collector(self, number):
+        collector = threading.Thread(
+            target=self._collect, args=(number, self.dones[number]),
+            name='shard-collector-{}'.format(number))
+        collector.daemon = True
+        collector.start()
+        return collector
+
+    def shard(self, key):
+        return hash(key) % len(self.queues)
+
+    def submit(self, key, item):
+        number = self.shard(key)
+        with self._lock:
+            ticket = next(self._tickets)
+            self._items[ticket] = (number, item, 0)
+            queue = self.queues[number]
+        while True:
+            try:
+                queue.put((ticket, item), timeout=self.check_interval)
+                return
+            except Queue.Full:
+                # A restarted shard has been given the item already.
+                if self.queues[number] is not queue:
+                    return
+
+    def _collect(self, number, done):
+        while True:
+            try:
+                ticket = done.get(timeout=self.check_interval)
+            except Queue.Empty:
+                # Everything its shard reported before exiting is in.
+                if self.dones[number] is not done or self._exited.is_set():
+                    return
+                continue
+            with self._lock:
+                entry = self._items.pop(ticket, None)
+            # Reported by a shard that died and had it submitted again.
+            if entry is not None:
+                self._finish(entry[1])
+
+    def _finish(self, item):
+        if self.on_done is not None:
+            try:
+                self.on_done(item)
+            except Exception:
+                logger.exception('Failed to finish %s', item)
+
+    def _watch(self):
+        while not self._stopping.wait(self.check_interval):
+            self.check()
+
+    def check(self):
+        """Starts again the shards that have died."""
+        for number, process in enumerate(self.processes):
+            if not process.is_alive():
+                self._restart(number)
+
+    def _restart(self, number):
+        logger.error('%s died with %s, starting it again',
+                     self.processes[number].name, self.processes[number].exitcode)
+        # Nothing waits on the old queues when this process exits.
+        self.queues[number].cancel_join_thread()
+        queue = multiprocessing.Queue(self.queue_size)
+        given_up = []
+        with self._lock:
+            self.queues[number] = queue
+            self.dones[number] = multiprocessing.Queue()
+            self.processes[number] = self._start(number)
+            self._collectors[number] = self._start_collector(number)
+            # In ticket order, so items of a key stay in order. Shards take
+            # items in that order too: the first one was being handled.
+            tickets = sorted(t for t, entry in self._items.items() if entry[0] == number)
+            for i, ticket in enumerate(tickets):
+                _, item, retries = self._items.pop(ticket)
+                if i == 0:
+                    if retries >= self.max_item_retries:
+                        given_up.append(item)
+                        continue
+                    retries += 1
+                ticket = next(self._tickets)
+                self._items[ticket] = (number, item, retries)
+                queue.put((ticket, item))
+        for item in given_up:
+            logger.error('Giving up %s, its shard died with it', item)
+            self._finish(item)
+
+    def shutdown(self, drain=True):
+        self._stopping.set()
+        self._monitor.join()
+        if drain:
+            # Whatever dead shards had is handled too.
+            self.check()
+        for queue, process in zip(self.queues, self.processes):
+            if not drain:
+                process.terminate()
+                queue.cancel_join_thread()
+                continue
+            queue.put(None)
+        for process in self.processes:
+            process.join()
+            if process.exitcode:
+                logger.error('%s exited with %s', process.name, process.exitcode)
+        self._exited.set()
+        for collector in self._collectors:
+            collector.join()
+        with self._lock:
+            lost = [self._items[ticket][1] for ticket in sorted(self._items)]
+            self._items.clear()
+        for item in lost:
+            logger.error('Giving up %s, its shard is gone', item)
+            self._finish(item)
+
+
+def serve(queue, done, handle):
+    """Worker loop: handles items from `queue` until it gets None.
+
+    Every item is reported to `done` once handled, even if it failed.
+    """
+    while True:
+        entry = queue.get()
+        if entry is None:
+            return
+        ticket, item = entry
+        try:
+            handle(item)
+        except Exception:
+            logger.exception('Failed to handle %s', item)
+        finally:
+            done.put(ticket)
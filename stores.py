@@ -0,0 +1,279 @@
+"""Where player documents live between turns.
+
+Every store loads a player by user id (a new one if they've never played)
+and saves them compare-and-swap on their `version`, raising
+persistence.VersionConflict if someone else has saved them meanwhile.
+
+MongoStore keeps players in Mongo, MemoryStore in this process and
+RedisStore in Redis as one compact blob per player, so a turn reads its
+player with a single HGET. TieredStore serves players from a hot store and
+copies changed ones to a cold one (Mongo) in background.
+"""
+
+import json
+import logging
+import threading
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+import persistence
+
+logger = logging.getLogger(__name__)
+
+REDIS_URL = 'redis://localhost:6379/0'
+
+
+def encode(state):
+    if msgpack is not None:
+        return msgpack.packb(state, use_bin_type=True)
+    return json.dumps(state, separators=(',', ':')).encode('utf-8')
+
+
+def decode(data):
+    # JSON objects start with '{', msgpack maps never do, so blobs written
+    # without msgpack installed stay readable with it and the other way round.
+    if data[:1] == b'{':
+        return json.loads(data.decode('utf-8'))
+    return msgpack.unpackb(data, raw=False)
+
+
+def player_state(player):
+    state = player.to_mongo().to_dict()
+    state.pop('_id', None)
+    return state
+
+
+class MongoStore(object):
+    def __init__(self, document):
+        super(MongoStore, self).__init__()
+        self.document = document
+
+    def get(self, user_id):
+        """Returns the stored player or None."""
+        return self.document.fetch(user_id)
+
+    def load(self, user_id):
+        return persistence.track(self.document.fetch_or_create(user_id))
+
+    def save(self, player):
+        persistence.save(player, version_field='version')
+
+    def user_ids(self):
+        return self.document.objects.scalar('user_id')
+
+    def archive(self, player):
+        """Writes `player` as it is, whatever is stored."""
+        self.document._get_collection().replace_one(
+            {'user_id': player.user_id}, player_state(player), upsert=True)
+
+    def close(self):
+        pass
+
+
+class BlobStore(object):
+    """Base of stores keeping each player as one encoded blob."""
+
+    def __init__(self, document):
+        super(BlobStore, self).__init__()
+        self.document = document
+
+    def player(self, data):
+        return self.document._from_son(decode(data))
+
+    def get(self, user_id):
+        """Returns the stored player or None."""
+        data = self.read(user_id)
+        return None if data is None else self.player(data)
+
+    def new(self, user_id):
+        """A player who has never played, not stored yet."""
+        return self.document._from_son(self.document.initial_state(user_id))
+
+    def load(self, user_id):
+        player = self.get(user_id)
+        if player is None:
+            player = self.new(user_id)
+        return player
+
+    def save(self, player):
+        state = player_state(player)
+        version = state.get('version') or 0
+        state['version'] = version + 1
+        if not self.swap(player.user_id, version, encode(state)):
+            raise persistence.VersionConflict(
+                'Player {} has changed since it was loaded'.format(player.user_id))
+        player.version = version + 1
+
+    def put_if_absent(self, player):
+        self.add(player.user_id, player.version or 0, encode(player_state(player)))
+
+    def close(self):
+        pass
+
+
+class MemoryStore(BlobStore):
+    def __init__(self, document):
+        super(MemoryStore, self).__init__(document)
+        # User id -> (version, blob).
+        self._blobs = {}
+        self._lock = threading.Lock()
+
+    def read(self, user_id):
+        stored = self._blobs.get(user_id)
+        return stored and stored[1]
+
+    def user_ids(self):
+        with self._lock:
+            return list(self._blobs)
+
+    def swap(self, user_id, version, data):
+        with self._lock:
+            stored = self._blobs.get(user_id)
+            if (stored[0] if stored else 0) != version:
+                return False
+            self._blobs[user_id] = (version + 1, data)
+            return True
+
+    def add(self, user_id, version, data):
+        with self._lock:
+            if user_id not in self._blobs:
+                self._blobs[user_id] = (version, data)
+
+
+# Players are hashes holding the encoded `state` and, beside it, its
+# `version`, so scripts compare versions without decoding states.
+SWAP_SCRIPT = """
+local version = tonumber(redis.call('HGET', KEYS[1], 'version')) or 0
+if version ~= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HMSET', KEYS[1], 'version', version + 1, 'state', ARGV[2])
+return 1
+"""
+
+ADD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+redis.call('HMSET', KEYS[1], 'version', ARGV[1], 'state', ARGV[2])
+return 1
+"""
+
+
+class RedisStore(BlobStore):
+    def __init__(self, document, url=REDIS_URL, prefix='player:',
+                 client=None):
+        super(RedisStore, self).__init__(document)
+        if client is None:
+            if redis is None:
+                raise RuntimeError('RedisStore needs the redis package.')
+            client = redis.StrictRedis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._swap = client.register_script(SWAP_SCRIPT)
+        self._add = client.register_script(ADD_SCRIPT)
+
+    def key(self, user_id):
+        return '{}{}'.format(self.prefix, user_id)
+
+    def read(self, user_id):
+        return self.client.hget(self.key(user_id), 'state')
+
+    def user_ids(self):
+        for key in self.client.scan_iter(match=self.key('*')):
+            yield int(key[len(self.prefix):])
+
+    def swap(self, user_id, version, data):
+        return bool(self._swap(keys=[self.key(user_id)], args=[version, data]))
+
+    def add(self, user_id, version, data):
+        self._add(keys=[self.key(user_id)], args=[version, data])
+
+
+class TieredStore(object):
+    """Players are served by `hot` and archived to `cold` in background.
+
+    Saved players are copied to `cold` at most `archive_interval` seconds
+    later, and on `close`. A player missing from `hot` is read from `cold`,
+    a new one is only created in `hot`.
+    """
+
+    def __init__(self, hot, cold, archive_interval=5.0):
+        super(TieredStore, self).__init__()
+        self.hot = hot
+        self.cold = cold
+        self.archive_interval = archive_interval
+        self._changed = set()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._archiver = threading.Thread(target=self._archive_loop, name='store-archiver')
+        self._archiver.daemon = True
+        self._archiver.start()
+
+    def load(self, user_id):
+        player = self.hot.get(user_id)
+        if player is not None:
+            return player
+        player = self.cold.get(user_id)
+        if player is None:
+            player = self.hot.new(user_id)
+        self.hot.put_if_absent(player)
+        # Whoever filled it first wins.
+        return self.hot.get(user_id)
+
+    def save(self, player):
+        self.hot.save(player)
+        with self._lock:
+            self._changed.add(player.user_id)
+
+    def user_ids(self):
+        # New players may not be archived yet, archived ones may have left hot.
+        return sorted(set(self.hot.user_ids()) | set(self.cold.user_ids()))
+
+    def archive(self):
+        with self._lock:
+            changed, self._changed = self._changed, set()
+        for user_id in changed:
+            try:
+                player = self.hot.get(user_id)
+                if player is not None:
+                    self.cold.archive(player)
+            except Exception:
+                logger.exception('Unable to archive player %s', user_id)
+                with self._lock:
+                    self._changed.add(user_id)
+        return len(changed)
+
+    def _archive_loop(self):
+        while not self._stopping:
+            self._wakeup.wait(self.archive_interval)
+            self.archive()
+
+    def close(self):
+        self._stopping = True
+        self._wakeup.set()
+        self._archiver.join()
+        self.archive()
+        self.hot.close()
+        self.cold.close()
+
+
+def make(kind, document, redis_url=REDIS_URL, archive_interval=5.0):
+    """The store called `kind`: mongo, memory, redis or tiered."""
+    if kind == 'memory':
+        return MemoryStore(document)
+    if kind == 'redis':
+        return RedisStore(document, redis_url)
+    if kind == 'tiered':
+        return TieredStore(RedisStore(document, redis_url), MongoStore(document),
+                           archive_interval=archive_interval)
+    return MongoStore(document)
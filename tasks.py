@@ -0,0 +1,109 @@
+"""Bookkeeping done by Celery workers, off the turn path.
+
+Workers run with `celery -A tasks worker` and find the broker in
+CELERY_BROKER_URL, the database in DB_URL, players as the bot does (STORE
+and REDIS_URL) and the bot token in TOKEN. Without a broker, tasks `send`
+runs on a thread of the sending process. CELERY_ALWAYS_EAGER=1 runs them
+right where they're sent from, for tests.
+"""
+
+import logging
+import os
+import threading
+
+import celery
+import celery.signals
+import mongoengine
+
+import dispatcher
+import models
+import stores
+import telegram
+
+logger = logging.getLogger(__name__)
+
+# Tasks waiting for the background thread before `send` blocks.
+BACKGROUND_QUEUE = 10000
+
+app = celery.Celery('bot')
+app.conf.update(
+    broker_url=os.environ.get('CELERY_BROKER_URL'),
+    task_always_eager=os.environ.get('CELERY_ALWAYS_EAGER') == '1',
+    task_ignore_result=True,
+    task_serializer='json',
+    accept_content=['json'],
+)
+
+
+# Where players live, see configure.
+store = None
+
+_background = None
+_background_lock = threading.Lock()
+
+
+def configure(player_store):
+    """Makes tasks find players in `player_store`."""
+    global store
+    store = player_store
+
+
+def send(task, *args, **kwargs):
+    """Runs `task` on a worker, or on a background thread without a broker."""
+    if app.conf.broker_url or app.conf.task_always_eager:
+        task.delay(*args, **kwargs)
+        return
+    global _background
+    with _background_lock:
+        if _background is None:
+            _background = dispatcher.Dispatcher(
+                lambda call: call(), workers=1, max_pending=BACKGROUND_QUEUE)
+    _background.submit(task.name, lambda: task(*args, **kwargs))
+
+
+def close():
+    """Waits for tasks sent to the background thread."""
+    global _background
+    with _background_lock:
+        background, _background = _background, None
+    if background is not None:
+        background.shutdown()
+
+
+@celery.signals.worker_process_init.connect
+def connect_database(**kwargs):
+    mongoengine.connect('default', host=os.environ.get('DB_URL'))
+    configure(stores.make(os.environ.get('STORE', 'mongo'), models.User,
+                          redis_url=os.environ.get('REDIS_URL', stores.REDIS_URL)))
+
+
+@app.task
+def record_score(name, turns, money, score):
+    models.Score(name=name, turns=turns, money=money, score=score).save()
+
+
+@app.task
+def track(name, user_id=None, properties=None):
+    """Stores an analytics event."""
+    models.Event(name=name, user_id=user_id, properties=properties or {}).save()
+
+
+@app.task
+def broadcast(text, user_ids=None):
+    """Sends `text` to the given players, to everyone in the store by default.
+
+    Messages go through an outbox, so a broadcast stays within Telegram's
+    rate limits as long as one runs at a time.
+    """
+    if user_ids is None:
+        user_ids = (store or stores.MongoStore(models.User)).user_ids()
+    transport = telegram.Transport(None, os.environ.get('TOKEN'), outbox_options={})
+    sent = 0
+    try:
+        for user_id in user_ids:
+            # Players talk to the bot in private chats, whose ids are theirs.
+            transport.send_message(telegram.Chat(user_id, 'private'), text)
+            sent += 1
+    finally:
+        transport.close()
+    logger.info('Broadcast to %s players.', sent)
@@ -1,20 +1,55 @@
+import collections
 import datetime
+import hmac
+import json
 import logging
+import random
+import threading
+import time
 
 import marshmallow
 import requests
+import requests.adapters
+import urllib3.exceptions
+
+import dispatcher
+import metrics
+import offsets
+import outbox
 import transport
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 
 logger = logging.getLogger(__name__)
 
+UPDATES = metrics.counter('bot_updates_total', 'Updates received.')
+DUPLICATE_UPDATES = metrics.counter(
+    'bot_duplicate_updates_total', 'Updates dropped as repeated deliveries.')
+API_REQUESTS = metrics.counter('bot_api_requests_total', 'Bot API requests.', ('method',))
+API_ERRORS = metrics.counter(
+    'bot_api_errors_total', 'Bot API requests that failed.', ('method',))
+
 
 class Response(object):
-    def __init__(self, ok, result=None, description=None):
+    __slots__ = ('ok', 'result', 'description', 'error_code', 'parameters')
+
+    def __init__(self, ok, result=None, description=None, error_code=None, parameters=None):
         super(Response, self).__init__()
         self.ok = ok
         self.result = result
         self.description = description
+        self.error_code = error_code
+        self.parameters = parameters or {}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            data['ok'], data.get('result'), data.get('description'),
+            data.get('error_code'), data.get('parameters'))
 
     def __repr__(self):
         return '<Response ok={} description={} result={}>'.format(
@@ -25,6 +60,8 @@ class ResponseSchema(marshmallow.Schema):
     ok = marshmallow.fields.Boolean(required=True)
     result = marshmallow.fields.Raw()
     description = marshmallow.fields.String()
+    error_code = marshmallow.fields.Integer()
+    parameters = marshmallow.fields.Dict()
 
     @marshmallow.post_load
     def make_response(self, data):
@@ -32,10 +69,19 @@ class ResponseSchema(marshmallow.Schema):
 
 
 class User(transport.User):
+    __slots__ = ('language_code',)
+
     def __init__(self, language_code=None, **kwargs):
         super(User, self).__init__(transport='telegram', **kwargs)
         self.language_code = language_code
 
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            id=data['id'], first_name=data['first_name'],
+            last_name=data.get('last_name'), username=data.get('username'),
+            language_code=data.get('language_code'))
+
     def __repr__(self):
         return '<User id={} first_name={} last_name={} username={} language_code={}'.format(
             self.id, self.first_name, self.last_name, self.username, self.language_code)
@@ -54,11 +100,17 @@ class UserSchema(marshmallow.Schema):
 
 
 class Chat(transport.Chat):
+    __slots__ = ('id', 'type')
+
     def __init__(self, id, type):
         super(Chat, self).__init__()
         self.id = id
         self.type = type
 
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data['type'])
+
     def __repr__(self):
         return '<Chat id={} type={}>'.format(
             self.id, self.type)
@@ -76,11 +128,23 @@ class ChatSchema(marshmallow.Schema):
 
 
 class Message(transport.Message):
+    __slots__ = ('message_id', 'date')
+
     def __init__(self, message_id, date, **kwargs):
         super(Message, self).__init__(**kwargs)
         self.message_id = message_id
         self.date = date
 
+    @classmethod
+    def from_dict(cls, data):
+        user = data.get('from')
+        return cls(
+            message_id=data['message_id'],
+            date=datetime.datetime.utcfromtimestamp(data['date']),
+            chat=Chat.from_dict(data['chat']),
+            user=user and User.from_dict(user),
+            text=data.get('text'))
+
     def __repr__(self):
         return '<Message message_id={} date={} chat={} user={} text={}>'.format(
             self.message_id, self.date, self.chat, self.user, self.text)
@@ -89,11 +153,10 @@ class Message(transport.Message):
 class TimestampField(marshmallow.fields.Integer):
     def _serialize(self, value, attr, data):
         value = (value - datetime.datetime.utcfromtimestamp(0)).total_seconds()
-        value = time.mktime(value.timetuple())
         return super(TimestampField, self)._serialize(value, attr, data)
 
     def _deserialize(self, value, attr, data):
-        value = super(TimestampField, self)._serialize(value, attr, data)
+        value = super(TimestampField, self)._deserialize(value, attr, data)
         return datetime.datetime.utcfromtimestamp(value)
 
 
@@ -107,14 +170,26 @@ class MessageSchema(marshmallow.Schema):
 
     @marshmallow.post_load
     def make_message(self, data):
+        # Channel posts and service messages come without a sender or text.
+        data.setdefault('user', None)
+        data.setdefault('text', None)
         return Message(**data)
 
 
 class Update(object):
+    __slots__ = ('update_id', 'message')
+
     def __init__(self, update_id, message=None):
         super(Update, self).__init__()
         self.update_id = update_id
         self.message = message
+        if message is not None:
+            message.update_id = update_id
+
+    @classmethod
+    def from_dict(cls, data):
+        message = data.get('message')
+        return cls(data['update_id'], message and Message.from_dict(message))
 
     def __repr__(self):
         return '<Update update_id={} message={}>'.format(
@@ -134,44 +209,242 @@ class UpdateSchema(marshmallow.Schema):
 class Error(Exception):
     pass
 
+
+def never_sent(error):
+    """Whether a failed request surely never reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def sender(message):
+    return message.user and message.user.id
+
+
+def to_bytes(text):
+    # compare_digest only takes ASCII text, any bytes.
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8')
+
+
+class Backoff(object):
+    def __init__(self, initial=0.5, maximum=60.0, factor=2.0):
+        super(Backoff, self).__init__()
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = 0
+
+    def failure(self):
+        if self.delay:
+            self.delay = min(self.delay * self.factor, self.maximum)
+        else:
+            self.delay = self.initial
+        return self.delay * random.uniform(0.5, 1.0)
+
+    def reset(self):
+        self.delay = 0
+
+
 class Formatter(transport.Formatter):
     def bold(self, text):
         return '*' + text.strip() + '*'
 
+    def speech(self, name, phrase):
+        return '*{}:* {}'.format(name, phrase)
+
 
 class Transport(transport.Transport):
-    def __init__(self, handler, token):
+    # Extra time to wait for a getUpdates response on top of its long-polling
+    # timeout.
+    POLL_READ_MARGIN = 10
+
+    API_URL = 'https://api.telegram.org'
+
+    # Methods that do no harm when Telegram gets them twice. Others are
+    # repeated after a connection error only if they never left.
+    IDEMPOTENT_METHODS = frozenset([
+        'getUpdates', 'getMe', 'getWebhookInfo', 'setWebhook', 'deleteWebhook'])
+
+    MAX_REPLY_MARKUPS = 10000
+
+    def __init__(self, handler, token, workers=0, max_pending=256,
+                 poll_timeout=0, poll_limit=100, poll_interval=1, api_url=None,
+                 pool_size=10, connect_timeout=5, read_timeout=30, max_retries=3,
+                 max_response_size=1024 * 1024, outbox_options=None, strict=False,
+                 coalesce=False, pool=None, checkpoint=None, dedup_window=0,
+                 keyboard_columns=1):
         super(Transport, self).__init__(handler)
         self.session = requests.Session()
+        # Automatic retries are off: request() retries itself, knowing which
+        # failures are safe to repeat.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.max_response_size = max_response_size
+        # Anything with the Dispatcher interface may handle updates, e.g. a
+        # shards.ShardPool, which tells when it's done through on_done.
+        self.dispatcher = pool
+        if pool is not None:
+            pool.on_done = self.finished
+        if workers and pool is None:
+            self.dispatcher = dispatcher.Dispatcher(
+                self.handle_tracked, workers=workers, max_pending=max_pending)
         self.token = token
+        self.api_url = (api_url or self.API_URL).rstrip('/')
+        # Strict mode validates everything with marshmallow schemas, the
+        # default builds objects straight from the decoded JSON.
+        self.strict = strict
+        # Hand all updates of a chat in one batch to the handler at once.
+        self.coalesce = coalesce
         self.response_schema = ResponseSchema(strict=True)
         self.update_schema = UpdateSchema(strict=True)
         self.message_schema = MessageSchema(strict=True)
+        # Newest update handled with all before it: the checkpoint, where a
+        # restarted or handed over process carries on.
         self.last_update = None
+        # Buttons per keyboard row; more than one makes replies smaller.
+        self.keyboard_columns = keyboard_columns
+        self.reply_markups = {}
+        # Newest update fetched, where polling carries on, and the fetched
+        # ones not handled yet.
+        self.fetched_update = None
+        self.unfinished = set()
+        self.unfinished_lock = threading.Lock()
+        self.checkpoint = checkpoint
+        if checkpoint is not None:
+            self.resume(checkpoint.load())
+        self.recent = None
+        if dedup_window:
+            self.recent = offsets.RecentUpdates(dedup_window)
+        self.poll_timeout = poll_timeout
+        self.poll_limit = poll_limit
+        self.poll_interval = poll_interval
+        self.backoff = Backoff()
+        self.outbox = None
+        if outbox_options is not None:
+            self.outbox = outbox.Outbox(self.post_message, **outbox_options)
 
     def keyboard_as_dict(self, keyboard):
+        columns = self.keyboard_columns
         return [
-            [ button ]
-            for button in keyboard
+            list(keyboard[i:i + columns])
+            for i in range(0, len(keyboard), columns)
         ]
 
-    def request(self, endpoint, params=None):
-        url = 'https://api.telegram.org/bot{}/{}'.format(self.token, endpoint)
+    def reply_markup(self, keyboard):
+        """Reply markup of `keyboard`, cached per keyboard: don't change it."""
+        key = tuple(keyboard)
+        markup = self.reply_markups.get(key)
+        if markup is None:
+            markup = {
+                'one_time_keyboard': True,
+                'keyboard': self.keyboard_as_dict(key),
+            }
+            if len(self.reply_markups) >= self.MAX_REPLY_MARKUPS:
+                self.reply_markups = {}
+            self.reply_markups[key] = markup
+        return markup
+
+    def request(self, endpoint, params=None, timeout=None, retry_flood=True):
+        url = '{}/bot{}/{}'.format(self.api_url, self.token, endpoint)
         method = 'POST' if params else 'GET'
-        logger.info('%s %s', method, url)
-        return self.response_schema.load(
-            self.session.request(
-                method, url, json=params)
-            .json()).data
+        # The URL contains the token, so only the endpoint is logged.
+        logger.info('%s %s', method, endpoint)
+        attempt = 0
+        while True:
+            API_REQUESTS.labels(endpoint).inc()
+            try:
+                response = self.decode_response(
+                    self.fetch(method, url, params, timeout))
+            except requests.ConnectionError as e:
+                API_ERRORS.labels(endpoint).inc()
+                # A connection reset after the request was written may come
+                # after Telegram has acted on it.
+                if attempt >= self.max_retries or not (
+                        endpoint in self.IDEMPOTENT_METHODS or never_sent(e)):
+                    raise
+                response = None
+            if response is not None:
+                if not response.ok:
+                    API_ERRORS.labels(endpoint).inc()
+                if response.ok or attempt >= self.max_retries:
+                    return response
+                if response.error_code == 429 and not retry_flood:
+                    return response
+                if response.error_code != 429 and (response.error_code or 0) < 500:
+                    return response
+            delay = self.retry_delay(attempt, response)
+            logger.warning('%s failed (%s), retrying in %.1fs',
+                           endpoint, response and response.description, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def decode_response(self, data):
+        if self.strict:
+            return self.response_schema.load(data).data
+        return Response.from_dict(data)
+
+    def decode_updates(self, data):
+        if self.strict:
+            return self.update_schema.load(data, many=True).data
+        return [Update.from_dict(update) for update in data]
+
+    def retry_delay(self, attempt, response=None):
+        retry_after = response and response.parameters.get('retry_after')
+        if retry_after:
+            return retry_after + random.uniform(0, 1)
+        return 0.5 * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    def fetch(self, method, url, params=None, timeout=None):
+        response = self.session.request(
+            method, url, json=params, stream=True,
+            timeout=(self.connect_timeout, timeout or self.read_timeout))
+        try:
+            length = response.headers.get('Content-Length')
+            if length and int(length) > self.max_response_size:
+                raise Error('Response is too large: {} bytes'.format(length))
+            chunks = []
+            size = 0
+            for chunk in response.iter_content(64 * 1024):
+                size += len(chunk)
+                if size > self.max_response_size:
+                    raise Error('Response is larger than {} bytes'.format(
+                        self.max_response_size))
+                chunks.append(chunk)
+        finally:
+            response.close()
+        try:
+            return json.loads(b''.join(chunks).decode('utf-8'))
+        except ValueError:
+            if response.status_code == 429 or response.status_code >= 500:
+                # Proxies in front of the API answer errors with HTML.
+                return {
+                    'ok': False,
+                    'error_code': response.status_code,
+                    'description': response.reason,
+                }
+            raise
 
     def get_updates(self):
-        params = None
-        if self.last_update:
-            params = { 'offset': self.last_update + 1 }
-        response = self.request('getUpdates', params=params)
+        params = {}
+        timeout = None
+        if self.fetched_update:
+            params['offset'] = self.fetched_update + 1
+        if self.poll_timeout:
+            params['timeout'] = self.poll_timeout
+            params['limit'] = self.poll_limit
+            timeout = self.poll_timeout + self.POLL_READ_MARGIN
+        response = self.request('getUpdates', params=params or None, timeout=timeout)
         if not response.ok:
             raise Error(response.description)
-        return self.update_schema.load(response.result, many=True).data
+        return self.decode_updates(response.result)
 
     def send_message(self, chat, text, disable_notification=True, keyboard=None):
         params = {
@@ -181,27 +454,203 @@ class Transport(transport.Transport):
             'parse_mode': 'Markdown',
         }
         if keyboard:
-            params['reply_markup'] = {
-                'one_time_keyboard': True,
-                'keyboard': self.keyboard_as_dict(keyboard),
-            }
-        response = self.request('sendMessage', params=params)
+            params['reply_markup'] = self.reply_markup(keyboard)
+        with metrics.span('send'):
+            if self.outbox is not None:
+                return self.outbox.put(chat.id, params)
+            response = self.request('sendMessage', params=params)
         if not response.ok:
             raise Error(response.description)
 
-        return self.message_schema.load(response.result).data
+        if self.strict:
+            return self.message_schema.load(response.result).data
+        return response.result
+
+    def post_message(self, params):
+        # The outbox waits out flood control itself.
+        return self.request('sendMessage', params=params, retry_flood=False)
 
     def run(self):
-        for update in self.get_updates():
-            self.handle(update)
-            self.last_update = update.update_id
+        self.dispatch(self.get_updates())
+
+    def poll(self):
+        try:
+            updates = self.get_updates()
+        except (requests.RequestException, ValueError, KeyError, TypeError,
+                marshmallow.ValidationError, Error):
+            delay = self.backoff.failure()
+            logger.exception('getUpdates failed, retrying in %.1fs', delay)
+            time.sleep(delay)
+            return
+        self.backoff.reset()
+        self.dispatch(updates)
+        if not self.poll_timeout:
+            time.sleep(self.poll_interval)
+
+    def resume(self, update_id):
+        """Continues after `update_id`, handled by someone else."""
+        self.last_update = self.fetched_update = update_id
+
+    def dispatch(self, updates):
+        UPDATES.inc(len(updates))
+        received = updates
+        if self.recent is not None:
+            updates = [update for update in updates if self.recent.add(update.update_id)]
+            DUPLICATE_UPDATES.inc(len(received) - len(updates))
+        if self.coalesce:
+            batches = collections.OrderedDict()
+            for update in updates:
+                batches.setdefault(self.chat_key(update), []).append(update)
+            batches = batches.items()
+        else:
+            batches = [(self.chat_key(update), [update]) for update in updates]
+
+        with self.unfinished_lock:
+            for update in updates:
+                self.unfinished.add(update.update_id)
+            # Repeated ones too, or they're fetched again.
+            for update in received:
+                self.fetched_update = max(self.fetched_update or 0, update.update_id)
+        for key, batch in batches:
+            if self.dispatcher:
+                self.dispatcher.submit(key, batch)
+            else:
+                self.handle_tracked(batch)
+
+    def finished(self, updates):
+        """Marks `updates` handled and moves the checkpoint past them."""
+        with self.unfinished_lock:
+            self.unfinished.difference_update(update.update_id for update in updates)
+            if self.unfinished:
+                handled = min(self.unfinished) - 1
+            else:
+                handled = self.fetched_update
+            if handled is not None and handled > (self.last_update or 0):
+                self.last_update = handled
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        if self.checkpoint is not None:
+            self.checkpoint.update(self.last_update)
+
+    def handle_tracked(self, updates):
+        try:
+            self.handle_batch(updates)
+        finally:
+            self.finished(updates)
+
+    def chat_key(self, update):
+        if update.message:
+            return update.message.chat.id
+        return update.update_id
+
+    def close(self):
+        if self.dispatcher:
+            self.dispatcher.shutdown()
+        if self.outbox is not None:
+            self.outbox.close()
+        if self.checkpoint is not None:
+            self.checkpoint.update(self.last_update)
+            self.checkpoint.flush()
 
     @property
     def formatter(self):
         return Formatter()
 
+    def handle_batch(self, updates):
+        if len(updates) == 1:
+            return self.handle(updates[0])
+        # Updates are handled in order. Consecutive messages of a user (a
+        # group chat holds several) are handed over at once.
+        messages = []
+        for update in sorted(updates, key=lambda update: update.update_id):
+            message = update.message
+            if messages and (message is None or sender(message) != sender(messages[-1])):
+                self.handle_messages(messages)
+                messages = []
+            if message is None:
+                self.handle(update)
+            else:
+                messages.append(message)
+        if messages:
+            self.handle_messages(messages)
+
+    def handle_messages(self, messages):
+        if len(messages) == 1:
+            self.handler.on_message(self, messages[0])
+        else:
+            self.handler.on_messages(self, messages)
+
     def handle(self, update):
         if update.message:
             self.handler.on_message(self, update.message)
         else:
             logger.info('Unhandled update: %s', update)
+
+
+class WebhookTransport(Transport):
+    """Receives updates pushed by Telegram instead of polling for them.
+
+    The HTTP handler only validates and enqueues an update; consumer threads
+    take it from the bounded queue and hand it to the handler.
+    """
+
+    def __init__(self, handler, token, secret, queue_size=1000, consumers=1, **kwargs):
+        super(WebhookTransport, self).__init__(handler, token, **kwargs)
+        self.secret = secret
+        self.queue = queue.Queue(queue_size)
+        self.consumers = []
+        for i in range(consumers):
+            thread = threading.Thread(
+                target=self.consume, name='webhook-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.consumers.append(thread)
+
+    def set_webhook(self, url):
+        response = self.request('setWebhook', params={
+            'url': url,
+            'secret_token': self.secret,
+        })
+        if not response.ok:
+            raise Error(response.description)
+
+    def delete_webhook(self):
+        response = self.request('deleteWebhook')
+        if not response.ok:
+            raise Error(response.description)
+
+    def check_secret(self, path_secret, header_secret=None):
+        secret = to_bytes(self.secret)
+        if not hmac.compare_digest(to_bytes(path_secret), secret):
+            return False
+        if header_secret is not None:
+            return hmac.compare_digest(to_bytes(header_secret), secret)
+        return True
+
+    def receive(self, payload):
+        update = self.decode_updates([payload])[0]
+        try:
+            self.queue.put_nowait(update)
+        except queue.Full:
+            logger.warning('Webhook queue is full, rejecting update %s',
+                           update.update_id)
+            return False
+        return True
+
+    def consume(self):
+        while True:
+            update = self.queue.get()
+            if update is None:
+                return
+            try:
+                self.dispatch([update])
+            except Exception:
+                logger.exception('Failed to handle %s', update)
+
+    def close(self):
+        for _ in self.consumers:
+            self.queue.put(None)
+        for thread in self.consumers:
+            thread.join()
+        super(WebhookTransport, self).close()
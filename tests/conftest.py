@@ -0,0 +1,28 @@
+import os
+import sys
+
+import mongoengine
+import pytest
+
+# Modules live at the top of the project.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import models
+
+
+@pytest.fixture
+def db():
+    """A fresh mongomock database behind mongoengine's default connection."""
+    mongomock = pytest.importorskip('mongomock')
+    mongoengine.disconnect()
+    # Older mongoengine knows mongomock by URL, newer takes the client class.
+    if mongoengine.VERSION < (0, 27):
+        connection = mongoengine.connect('default', host='mongomock://localhost')
+    else:
+        connection = mongoengine.connect('default', host='mongodb://localhost',
+                                         mongo_client_class=mongomock.MongoClient)
+    yield connection
+    connection.drop_database('default')
+    mongoengine.disconnect()
+    for document in (models.User, models.Score, models.Event):
+        document._collection = None
@@ -0,0 +1,171 @@
+import time
+
+import bot
+import models
+import persistence
+import telegram
+import transport
+
+
+class Chat(transport.Chat):
+    __slots__ = ('id',)
+
+    def __init__(self, id):
+        self.id = id
+
+
+class Transport(transport.Transport):
+    def __init__(self):
+        super(Transport, self).__init__(None)
+        self.sent = []
+
+    def send_message(self, chat, text, keyboard=None, **kwargs):
+        self.sent.append(text)
+
+    @property
+    def formatter(self):
+        return telegram.Formatter()
+
+    def keyboard(self, *buttons):
+        return buttons
+
+
+def message(text, update_id=None, user_id=1):
+    user = transport.User(user_id, 'test', 'Ann')
+    return transport.Message(text, user, Chat(user_id), update_id=update_id)
+
+
+def test_burst_with_a_bad_message_keeps_the_others(db):
+    game = bot.Bot()
+    sent = Transport()
+    try:
+        game.on_message(sent, message('/start', 1))
+        # A message without text (a sticker, say) fails its turn.
+        game.on_messages(sent, [
+            message("Ok, I got it. Let's play.", 2), message(None, 3), message('Ann', 4)])
+    finally:
+        game.close()
+    user = bot.User.fetch(1)
+    assert not user.in_intro
+    assert user.name == 'Ann'
+    assert user.last_update_id == 4
+    # Intro, the name question and the story.
+    assert len(sent.sent) == 3
+
+
+def test_cached_turns_survive_a_conflict(db):
+    game = bot.Bot(cache_size=10, flush_interval=60)
+    sent = Transport()
+    try:
+        game.on_message(sent, message('/start', 1))
+        game.sessions.flush()
+        game.on_message(sent, message("Ok, I got it. Let's play.", 2))
+        game.on_message(sent, message('Ann', 3))
+        # Another process saves the player before the cache does.
+        bot.User._get_collection().update_one(
+            {'user_id': 1}, {'$inc': {'version': 1}, '$set': {'money': 777}})
+    finally:
+        game.close()
+    user = bot.User.fetch(1)
+    assert user.money == 777
+    assert user.name == 'Ann'
+    assert user.last_update_id == 3
+    assert user.version == 3
+    assert len(sent.sent) == 3
+
+
+def test_skips_redelivered_updates(db):
+    game = bot.Bot()
+    sent = Transport()
+    try:
+        game.on_message(sent, message('/start', 1))
+        game.on_message(sent, message("Ok, I got it. Let's play.", 2))
+        game.on_message(sent, message("Ok, I got it. Let's play.", 2))
+        game.on_message(sent, message('/start', 1))
+    finally:
+        game.close()
+    assert len(sent.sent) == 2
+    assert bot.User.fetch(1).last_update_id == 2
+
+
+def test_highscores_are_served_from_memory(db, monkeypatch):
+    bot.Score(name='Bob', turns=10, money=5, score=505).save()
+    game = bot.Bot()
+    sent = Transport()
+    try:
+        game.warm_up()
+
+        def query(*args, **kwargs):
+            raise AssertionError('The database was queried on the turn path.')
+        monkeypatch.setattr(bot.Score, 'objects', property(query))
+        game.on_message(sent, message('/start', 1))
+        game.on_message(sent, message('/highscores', 2))
+    finally:
+        monkeypatch.undo()
+        game.close()
+    assert 'Bob' in sent.sent[-1]
+
+
+def test_leaderboard_is_refreshed_in_background(db, monkeypatch):
+    monkeypatch.setattr(bot.Bot, 'LEADERBOARD_REFRESH_INTERVAL', 0.01)
+    game = bot.Bot()
+    try:
+        game.warm_up()
+        bot.Score(name='Bob', turns=10, money=5, score=505).save()
+        deadline = time.time() + 5
+        while not game.leaderboard.entries and time.time() < deadline:
+            time.sleep(0.01)
+    finally:
+        game.close()
+    assert [e.name for e in game.leaderboard.entries] == ['Bob']
+
+
+def win(game):
+    def turn(buffered, user):
+        user.name = 'Ann'
+        user.turn = 10
+        user.money = 5
+        game.on_win(buffered, Chat(1), user)
+    return turn
+
+
+def test_conflicting_win_records_its_score_once(db, monkeypatch):
+    game = bot.Bot()
+    sent = Transport()
+    try:
+        game.on_message(sent, message('/start', 1))
+        save = game.store.save
+        conflicts = []
+
+        def conflict_once(user):
+            if not conflicts:
+                conflicts.append(user)
+                raise persistence.VersionConflict('Changed meanwhile')
+            save(user)
+        monkeypatch.setattr(game.store, 'save', conflict_once)
+        game.play_turn(sent, 1, win(game)).flush()
+    finally:
+        game.close()
+    assert conflicts
+    assert [e.name for e in game.leaderboard.entries] == ['Ann']
+    # The winner sees their score right away.
+    assert 'Ann' in sent.sent[-1]
+    assert bot.Score.objects.count() == 1
+    assert models.Event.objects(name='win').count() == 1
+
+
+def test_replayed_win_records_its_score_once(db):
+    game = bot.Bot(cache_size=10, flush_interval=60)
+    sent = Transport()
+    try:
+        game.on_message(sent, message('/start', 1))
+        game.sessions.flush()
+        game.play_turn(sent, 1, win(game)).flush()
+        # Another process saves the player before the cache does.
+        bot.User._get_collection().update_one({'user_id': 1}, {'$inc': {'version': 1}})
+        game.sessions.flush()
+    finally:
+        game.close()
+    assert bot.User.fetch(1).name == 'Ann'
+    assert [e.name for e in game.leaderboard.entries] == ['Ann']
+    assert bot.Score.objects.count() == 1
@@ -0,0 +1,97 @@
+import os
+import pickle
+
+import pytest
+
+import content
+
+
+def write(directory, messages='greeting: Hi\n', keyboards='intro: [Go]\n', mtime=None):
+    for name, text in (('messages', messages), ('keyboards', keyboards)):
+        path = directory.join(name + '.yaml')
+        path.write(text)
+        if mtime is not None:
+            os.utime(str(path), (mtime, mtime))
+
+
+def test_content_tables_are_frozen():
+    tables = content.freeze({'a': {'b': [1, {'c': 2}]}})
+    with pytest.raises(TypeError):
+        tables['a'] = 1
+    with pytest.raises(TypeError):
+        tables['a'].update(b=1)
+    with pytest.raises(TypeError):
+        tables['a']['b'][1]['c'] = 3
+    with pytest.raises(TypeError):
+        del tables['a']
+    assert tables['a']['b'] == (1, {'c': 2})
+    # Still frozen once pickled, as in the content cache.
+    with pytest.raises(TypeError):
+        pickle.loads(pickle.dumps(tables))['a'].pop('b')
+
+
+def test_reloads_when_files_change(tmpdir):
+    write(tmpdir, mtime=1000)
+    store = content.ContentStore(str(tmpdir), check_interval=0)
+    first = store.get()
+    assert first.messages['greeting'] == 'Hi'
+    assert store.get() is first
+    write(tmpdir, messages='greeting: Hello\n', mtime=2000)
+    second = store.get()
+    assert second.messages['greeting'] == 'Hello'
+    assert second.digest != first.digest
+
+
+def test_touched_files_with_the_same_text_keep_the_content(tmpdir):
+    write(tmpdir, mtime=1000)
+    store = content.ContentStore(str(tmpdir), check_interval=0)
+    first = store.get()
+    write(tmpdir, mtime=2000)
+    assert store.get() is first
+
+
+def test_checks_files_every_check_interval(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(content.time, 'time', lambda: now[0])
+    write(tmpdir, mtime=1000)
+    store = content.ContentStore(str(tmpdir), check_interval=1.0)
+    store.get()
+    write(tmpdir, messages='greeting: Hello\n', mtime=2000)
+    assert store.get().messages['greeting'] == 'Hi'
+    now[0] += 1
+    assert store.get().messages['greeting'] == 'Hello'
+
+
+def test_cache_skips_parsing(tmpdir, monkeypatch):
+    write(tmpdir)
+    cache = str(tmpdir.join('content.cache'))
+    cached = content.ContentStore(str(tmpdir), cache_path=cache).get()
+    assert os.path.exists(cache)
+
+    def parse(*args):
+        raise AssertionError('YAML parsed despite the cache')
+    monkeypatch.setattr(content.yaml, 'safe_load', parse)
+    loaded = content.ContentStore(str(tmpdir), cache_path=cache).get()
+    assert loaded.digest == cached.digest
+    assert loaded.messages == cached.messages
+    assert isinstance(loaded.messages, content.FrozenDict)
+
+
+def test_cache_of_other_files_is_ignored(tmpdir):
+    write(tmpdir, mtime=1000)
+    cache = str(tmpdir.join('content.cache'))
+    content.ContentStore(str(tmpdir), cache_path=cache).get()
+    write(tmpdir, messages='greeting: Hello\n', mtime=2000)
+    store = content.ContentStore(str(tmpdir), cache_path=cache)
+    assert store.get().messages['greeting'] == 'Hello'
+    # The cache now has the new files.
+    with open(cache, 'rb') as f:
+        assert pickle.load(f)[1] == store.get().digest
+
+
+def test_broken_cache_is_ignored(tmpdir):
+    write(tmpdir)
+    cache = tmpdir.join('content.cache')
+    cache.write('garbage')
+    store = content.ContentStore(str(tmpdir), cache_path=str(cache))
+    assert store.get().messages['greeting'] == 'Hi'
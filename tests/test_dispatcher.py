@@ -0,0 +1,37 @@
+import threading
+
+import dispatcher
+
+
+def test_keeps_order_per_key():
+    handled = []
+    pool = dispatcher.Dispatcher(handled.append, workers=4)
+    for i in range(100):
+        pool.submit(i % 3, (i % 3, i))
+    pool.shutdown()
+    for key in range(3):
+        items = [i for k, i in handled if k == key]
+        assert items == sorted(items)
+    assert len(handled) == 100
+
+
+def test_shutdown_without_draining_releases_slots():
+    started = threading.Event()
+    release = threading.Event()
+
+    def handle(item):
+        started.set()
+        release.wait()
+
+    pool = dispatcher.Dispatcher(handle, workers=1, max_pending=3)
+    pool.submit('a', 1)
+    started.wait()
+    pool.submit('a', 2)
+    pool.submit('b', 3)
+    # Let the item being handled finish only once the rest are dropped.
+    threading.Timer(0.1, release.set).start()
+    pool.shutdown(drain=False)
+    assert pool.pending == 0
+    # Every slot is free again.
+    for _ in range(3):
+        assert pool._slots.acquire(False)
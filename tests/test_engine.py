@@ -0,0 +1,163 @@
+import json
+import random
+
+import pytest
+
+import bot
+import engine
+import telegram
+import transport
+
+
+def play(game, texts, formatter=None):
+    player = engine.Engine(game, formatter, first_name='Ann')
+    state = engine.State()
+    replies = []
+    for text in texts:
+        state, reply, keyboard = player.step(state, text)
+        replies.append(reply)
+    return state, replies
+
+
+GREET_GENRY = ['/start', "Ok, I got it. Let's play.", 'Ann', 'Go out', 'Talk to Genry']
+
+
+def test_steps_through_the_intro():
+    state, replies = play(engine.Game(), GREET_GENRY[:3])
+    assert state.name == 'Ann'
+    assert not state.in_intro
+    assert all(replies)
+
+
+def test_npc_lines_are_plain_text():
+    state, replies = play(engine.Game(), GREET_GENRY)
+    assert state.current_npc is not None
+    assert replies[-1].startswith('Genry: ')
+    assert '*' not in replies[-1]
+
+
+def test_replies_keep_npc_lines_apart():
+    game = engine.Game()
+    state = engine.State()
+    user = transport.User(0, 'engine', 'Ann')
+    for text in GREET_GENRY:
+        replies = engine.Replies(engine.Formatter())
+        game.handle_message(replies, transport.Message(text, user, transport.Chat()), state)
+    assert len(replies.speeches) == 1
+    name, phrase = replies.speeches[0]
+    assert name == 'Genry'
+    assert replies.texts == ['Genry: ' + phrase]
+
+
+def test_telegram_formats_npc_lines_in_markdown():
+    assert telegram.Formatter().speech('Genry', 'Hi.') == '*Genry:* Hi.'
+
+
+def fresh_keyboard(game, state):
+    keyboards = game.location_keyboards
+    cached = dict(keyboards)
+    keyboards.clear()
+    try:
+        location, location_state = game.load_location(state)
+        return game.make_location_keyboard(state, location, location_state)
+    finally:
+        keyboards.clear()
+        keyboards.update(cached)
+
+
+def test_memoized_keyboards_match_fresh_ones():
+    game = engine.Game()
+    player = engine.Engine(game, first_name='Ann')
+    rng = random.Random(1)
+    state, _, keyboard = player.step(engine.State(), '/start')
+    for text in ["Ok, I got it. Let's play.", 'Ann']:
+        state, _, keyboard = player.step(state, text)
+    goods = sorted(game.messages['objects'])
+    # Walks around without talking, guards and NPCs around are what matters.
+    # Junkyard finds use dict.iteritems, Python 2 only.
+    skip = set(game.registry.talk_buttons.values())
+    skip.add(game.messages['locations']['junkyard']['try_find_something'])
+    for i in range(600):
+        if i % 25 == 0:
+            # Goods the guards look for turn up now and then.
+            text = '/pleasegiveme ' + rng.choice(goods)
+        else:
+            text = rng.choice([button for button in keyboard if button not in skip])
+        state, _, keyboard = player.step(state, text)
+        if state.win:
+            break
+        assert keyboard == fresh_keyboard(game, state)
+
+
+def test_players_in_the_same_situation_share_keyboards():
+    game = engine.Game()
+    keyboards = []
+    for name in ('Ann', 'Bob'):
+        state, replies = play(game, GREET_GENRY[:3])
+        keyboards.append(fresh_keyboard(game, state))
+        location, location_state = game.load_location(state)
+        keyboards.append(game.make_location_keyboard(state, location, location_state))
+    assert keyboards[0] == keyboards[1]
+    assert keyboards[1] is keyboards[3]
+
+
+def test_keyboard_memo_does_not_evaluate_guards(monkeypatch):
+    game = engine.Game()
+    state, replies = play(game, GREET_GENRY[:3])
+    location, location_state = game.load_location(state)
+    game.make_location_keyboard(state, location, location_state)
+    monkeypatch.setattr(type(location), 'actions', lambda *args: pytest.fail('guards evaluated'))
+    game.make_location_keyboard(state, location, location_state)
+
+
+class Sent(telegram.Transport):
+    def __init__(self, **kwargs):
+        super(Sent, self).__init__(None, 'token', **kwargs)
+        self.sent = []
+
+    def fetch(self, method, url, params=None, timeout=None):
+        self.sent.append(params)
+        return {'ok': True, 'result': {}}
+
+
+def test_reply_markup_is_cached_and_sent_as_json():
+    sender = Sent()
+    chat = telegram.Chat(1, 'private')
+    sender.send_message(chat, 'a', keyboard=('x', 'y'))
+    sender.send_message(chat, 'b', keyboard=['x', 'y'])
+    first, second = [params['reply_markup'] for params in sender.sent]
+    assert first is second
+    assert first == {'one_time_keyboard': True, 'keyboard': [['x'], ['y']]}
+    # Encoded once, with the request.
+    assert '\\"' not in json.dumps(sender.sent[0])
+
+
+def test_keyboard_columns():
+    sender = Sent(keyboard_columns=2)
+    assert sender.reply_markup(('a', 'b', 'c'))['keyboard'] == [['a', 'b'], ['c']]
+    args = bot.make_parser('token', 'db').parse_args(['--keyboard-columns', '3'])
+    assert bot.transport_options(args)['keyboard_columns'] == 3
+
+
+class Version(object):
+    def __init__(self, digest, messages, keyboards):
+        self.digest = digest
+        self.messages = messages
+        self.keyboards = keyboards
+
+
+def test_turns_keep_the_content_they_started_with(monkeypatch):
+    game = engine.Game()
+    old = game.content
+    messages = dict(old.messages, story='Another story.')
+    seen = []
+
+    def play(transport, message, user):
+        # Reloaded by the watcher thread in the middle of the turn.
+        game.content = engine.Content(Version('new', messages, old.keyboards))
+        seen.append((game.messages, game.registry, game.location_keyboards))
+    monkeypatch.setattr(game, 'play', play)
+    game.handle_message(None, None, None)
+    assert seen == [(old.messages, old.registry, old.location_keyboards)]
+    assert game.messages['story'] == 'Another story.'
+    assert game.content_digest == 'new'
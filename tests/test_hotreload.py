@@ -0,0 +1,66 @@
+import os
+import threading
+import time
+
+import hotreload
+
+
+def touch(path, content='x'):
+    with open(path, 'w') as f:
+        f.write(content)
+    # Coarse file systems keep mtimes in seconds.
+    mtime = int(time.time()) + len(content) * 10
+    os.utime(path, (mtime, mtime))
+
+
+def wait_for(event):
+    assert event.wait(5), 'Timed out'
+
+
+def test_watch_reports_changes_in_background(tmpdir):
+    directory = str(tmpdir)
+    touch(os.path.join(directory, 'messages.yaml'))
+    touch(os.path.join(directory, 'bot.py'))
+    content_changed = threading.Event()
+    code_changed = []
+    reload_requested = threading.Event()
+
+    def on_reload(error):
+        code_changed.append(str(error))
+        reload_requested.set()
+
+    watcher = hotreload.ReloadWatcher(
+        directory, on_content_change=content_changed.set, debounce=0, poll_interval=0)
+    stop = threading.Event()
+    thread = threading.Thread(target=watcher.watch, args=(on_reload, stop, 0.01))
+    thread.start()
+    try:
+        touch(os.path.join(directory, 'messages.yaml'), 'changed')
+        wait_for(content_changed)
+        assert not code_changed
+        touch(os.path.join(directory, 'bot.py'), 'changed')
+        wait_for(reload_requested)
+        assert 'bot.py' in code_changed[0]
+    finally:
+        stop.set()
+        thread.join()
+
+
+def test_control_sees_stop_at_once():
+    read_end, write_end = os.pipe()
+    stdin = os.fdopen(read_end)
+    supervisor = os.fdopen(write_end, 'w')
+    stdout = open(os.devnull, 'w')
+    try:
+        control = hotreload.Control(stdin, stdout)
+        supervisor.write('start 42\n')
+        supervisor.flush()
+        assert control.ready() == 42
+        assert not control.stop_requested()
+        supervisor.write('stop\n')
+        supervisor.flush()
+        wait_for(control.stopping)
+        assert control.stop_requested()
+    finally:
+        supervisor.close()
+        stdout.close()
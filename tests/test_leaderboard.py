@@ -0,0 +1,69 @@
+import leaderboard
+
+
+def entry(name, score):
+    return leaderboard.Entry(name, 1, 100, score)
+
+
+def names(board):
+    return [e.name for e in board.entries]
+
+
+def test_keeps_top_scores_in_order():
+    board = leaderboard.Leaderboard(size=3)
+    board.warm([entry('a', 30), entry('b', 20)])
+    board.offer(entry('c', 25))
+    board.offer(entry('d', 20))
+    board.offer(entry('e', 1))
+    assert names(board) == ['a', 'c', 'b']
+
+
+def test_loads_keep_offers_not_stored_yet(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(leaderboard.time, 'time', lambda: now[0])
+    board = leaderboard.Leaderboard(size=3, pending_max_age=60)
+    board.warm([entry('a', 30)])
+    board.offer(entry('b', 20))
+    # Stored by another process, b's task hasn't run yet.
+    board.warm([entry('a', 30), entry('c', 10)])
+    assert names(board) == ['a', 'b', 'c']
+    # Stored now: not counted twice.
+    board.warm([entry('a', 30), entry('b', 20), entry('c', 10)])
+    assert names(board) == ['a', 'b', 'c']
+    board.warm([entry('a', 30), entry('c', 10)])
+    assert names(board) == ['a', 'c']
+
+
+def test_unstored_offers_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(leaderboard.time, 'time', lambda: now[0])
+    board = leaderboard.Leaderboard(pending_max_age=60)
+    board.offer(entry('a', 30))
+    now[0] += 30
+    board.warm([])
+    assert names(board) == ['a']
+    now[0] += 30
+    board.warm([])
+    assert names(board) == []
+
+
+def test_offers_out_of_the_top_are_not_kept():
+    board = leaderboard.Leaderboard(size=1)
+    board.offer(entry('a', 10))
+    board.offer(entry('b', 20))
+    board.warm([entry('c', 15)])
+    assert names(board) == ['b']
+    board.warm([entry('b', 20)])
+    board.warm([entry('c', 15)])
+    assert names(board) == ['c']
+
+
+def test_reloading_refreshes_rendered_tables_on_change():
+    board = leaderboard.Leaderboard()
+    render = lambda entries: ','.join(e.name for e in entries)
+    board.warm([entry('a', 30)])
+    assert board.render('key', render) == 'a'
+    board.warm([entry('a', 30)])
+    assert board.render('key', lambda entries: 'not rendered again') == 'a'
+    board.warm([entry('a', 30), entry('b', 40)])
+    assert board.render('key', render) == 'b,a'
@@ -0,0 +1,53 @@
+import socket
+
+import pytest
+
+import bot
+import metrics
+
+
+def sample(name, text):
+    for line in text.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split()[1])
+    return None
+
+
+def test_unused_metrics_are_zero():
+    counter = metrics.Counter('test_unused_total', 'Never incremented.')
+    histogram = metrics.Histogram('test_unused_seconds', 'Never observed.')
+    text = '\n'.join(counter.render() + histogram.render())
+    assert sample('test_unused_total', text) == 0
+    assert sample('test_unused_seconds_count', text) == 0
+
+
+def test_counts_and_observes():
+    counter = metrics.Counter('test_total', 'Counted.', ('kind',))
+    counter.labels('a').inc()
+    counter.labels('a').inc(2)
+    histogram = metrics.Histogram('test_seconds', 'Timed.', buckets=(0.1, 1.0))
+    histogram.observe(0.5)
+    histogram.observe(5)
+    text = '\n'.join(counter.render() + histogram.render())
+    assert sample('test_total{kind="a"}', text) == 3
+    assert sample('test_seconds_bucket{le="0.1"}', text) == 0
+    assert sample('test_seconds_bucket{le="1.0"}', text) == 1
+    assert sample('test_seconds_bucket{le="+Inf"}', text) == 2
+    assert sample('test_seconds_sum', text) == 5.5
+
+
+def test_shards_serve_on_the_following_ports():
+    assert bot.shard_listen('0.0.0.0:9100', 0) == '0.0.0.0:9101'
+    assert bot.shard_listen('0.0.0.0:9100', 3) == '0.0.0.0:9104'
+
+
+def test_serving_on_a_taken_port_fails():
+    taken = socket.socket()
+    taken.bind(('127.0.0.1', 0))
+    taken.listen(1)
+    try:
+        # Newer werkzeug exits after printing the error.
+        with pytest.raises((socket.error, SystemExit)):
+            bot.serve_metrics('127.0.0.1:{}'.format(taken.getsockname()[1]))
+    finally:
+        taken.close()
@@ -0,0 +1,80 @@
+import threading
+
+import pymongo.errors
+import pytest
+
+import bot
+import models
+
+
+def raw_users():
+    # Bypasses _get_collection, which creates the unique index.
+    return models.User._get_db()[models.User._get_collection_name()]
+
+
+def test_fetch_or_create_sets_initial_state(db):
+    user = models.User.fetch_or_create(1)
+    assert (user.user_id, user.turn, user.in_intro, user.version) == (1, 0, True, 0)
+    assert user.current_location is None
+    stored = raw_users().find_one({'user_id': 1})
+    assert stored['turn'] == 0 and stored['in_intro'] is True
+
+
+def test_fetch_or_create_keeps_existing_players(db):
+    user = models.User.fetch_or_create(1)
+    user.turn = 5
+    user.save()
+    assert models.User.fetch_or_create(1).turn == 5
+    assert models.User.objects(user_id=1).count() == 1
+
+
+def test_concurrent_first_messages_create_one_player(db):
+    models.User.ensure_indexes()
+    start = threading.Event()
+    users = []
+
+    def first_message():
+        start.wait()
+        users.append(models.User.fetch_or_create(1))
+    threads = [threading.Thread(target=first_message) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    assert models.User.objects(user_id=1).count() == 1
+    assert len(set(user.id for user in users)) == 1
+
+
+def test_fetch_or_create_after_losing_the_upsert_race(db, monkeypatch):
+    models.User.ensure_indexes()
+    other = models.User.fetch_or_create(1)
+    collection = models.User._get_collection()
+    # Both missed the player; the other insert lands first.
+    fetch = models.User.fetch
+    fetched = []
+
+    def missed_first(cls, user_id):
+        fetched.append(user_id)
+        return fetch(user_id) if len(fetched) > 1 else None
+    monkeypatch.setattr(models.User, 'fetch', classmethod(missed_first))
+
+    def upsert(*args, **kwargs):
+        raise pymongo.errors.DuplicateKeyError('E11000')
+    monkeypatch.setattr(collection, 'find_one_and_update', upsert)
+    assert models.User.fetch_or_create(1).id == other.id
+
+
+def test_remove_duplicates_keeps_the_furthest_player(db):
+    users = raw_users()
+    users.insert_many([
+        {'user_id': 1, 'turn': 0}, {'user_id': 1, 'turn': 7, 'name': 'Ann'},
+        {'user_id': 1, 'turn': 7}, {'user_id': 2, 'turn': 3},
+    ])
+    with pytest.raises(RuntimeError):
+        bot.Bot().warm_up()
+    assert models.User.remove_duplicates() == 2
+    assert [user['name'] for user in users.find({'user_id': 1})] == ['Ann']
+    assert len(list(users.find({'user_id': 2}))) == 1
+    models.User.ensure_indexes()
+    assert models.User.remove_duplicates() == 0
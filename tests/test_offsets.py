@@ -0,0 +1,86 @@
+import offsets
+
+
+class MemoryStore(object):
+    def __init__(self, update_id=None):
+        self.update_id = update_id
+        self.saves = []
+
+    def load(self):
+        return self.update_id
+
+    def save(self, update_id):
+        self.saves.append(update_id)
+        self.update_id = update_id
+
+
+def test_file_store(tmpdir):
+    store = offsets.FileStore(str(tmpdir.join('offset')))
+    assert store.load() is None
+    store.save(42)
+    assert offsets.FileStore(store.path).load() == 42
+    tmpdir.join('offset').write('garbage')
+    assert store.load() is None
+
+
+def test_mongo_store_never_goes_back(db):
+    store = offsets.MongoStore()
+    assert store.load() is None
+    store.save(5)
+    store.save(3)
+    assert store.load() == 5
+
+
+def test_checkpoint_saves_in_batches(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(offsets.time, 'time', lambda: now[0])
+    store = MemoryStore(10)
+    checkpoint = offsets.Checkpoint(store, every=3, interval=5.0)
+    assert checkpoint.load() == 10
+    checkpoint.update(11)
+    checkpoint.update(12)
+    assert store.saves == []
+    checkpoint.update(13)
+    assert store.saves == [13]
+    checkpoint.update(14)
+    now[0] += 5
+    checkpoint.update(15)
+    assert store.saves == [13, 15]
+    checkpoint.update(16)
+    checkpoint.flush()
+    assert store.saves == [13, 15, 16]
+    checkpoint.flush()
+    assert store.saves == [13, 15, 16]
+
+
+def test_checkpoint_ignores_older_offsets():
+    store = MemoryStore()
+    checkpoint = offsets.Checkpoint(store, every=1)
+    checkpoint.load()
+    checkpoint.update(5)
+    checkpoint.update(4)
+    checkpoint.update(None)
+    checkpoint.flush()
+    assert store.saves == [5]
+
+
+def test_checkpoint_survives_store_errors():
+    class Broken(MemoryStore):
+        def save(self, update_id):
+            raise IOError('disk full')
+
+    checkpoint = offsets.Checkpoint(Broken(), every=1)
+    checkpoint.load()
+    checkpoint.update(1)
+    assert checkpoint.saved is None
+
+
+def test_recent_updates():
+    recent = offsets.RecentUpdates(size=2)
+    assert recent.add(1)
+    assert not recent.add(1)
+    assert recent.add(2)
+    assert recent.add(3)
+    # 1 has been forgotten.
+    assert recent.add(1)
+    assert not recent.add(3)
@@ -0,0 +1,111 @@
+import threading
+import time
+
+import outbox
+
+
+class Response(object):
+    def __init__(self, ok=True, retry_after=None):
+        self.ok = ok
+        self.description = None if ok else 'Too Many Requests'
+        self.parameters = {'retry_after': retry_after} if retry_after is not None else {}
+
+
+class Recorder(object):
+    def __init__(self, responses=()):
+        self.sent = []
+        self.responses = list(responses)
+        self.lock = threading.Lock()
+
+    def __call__(self, params):
+        with self.lock:
+            self.sent.append((time.time(), params))
+            if self.responses:
+                return self.responses.pop(0)
+        return Response()
+
+
+def message(chat_id, text, **params):
+    params.update({'chat_id': chat_id, 'text': text, 'parse_mode': 'Markdown'})
+    return params
+
+
+def test_token_bucket_refills_at_rate():
+    bucket = outbox.TokenBucket(rate=2, capacity=2)
+    now = bucket.updated
+    assert bucket.wait_time(now) == 0
+    bucket.take(now)
+    bucket.take(now)
+    assert bucket.wait_time(now) == 0.5
+    assert bucket.wait_time(now + 0.25) == 0.25
+    assert bucket.wait_time(now + 0.5) == 0
+    assert not bucket.full(now + 0.5)
+    assert bucket.full(now + 10)
+    # Never more than the capacity.
+    assert bucket.tokens == 2
+
+
+def test_sends_everything_on_close():
+    send = Recorder()
+    box = outbox.Outbox(send, global_rate=1000, chat_rate=1000, coalesce=False)
+    for i in range(10):
+        box.put(i % 2, message(i % 2, str(i)))
+    box.close()
+    assert sorted(params['text'] for _, params in send.sent) == [str(i) for i in range(10)]
+    assert box.metrics()['sent'] == 10
+    assert box.depth == 0
+
+
+def test_keeps_order_within_a_chat():
+    send = Recorder()
+    box = outbox.Outbox(send, global_rate=1000, chat_rate=1000, coalesce=False)
+    for i in range(20):
+        box.put(1, message(1, str(i)))
+    box.close()
+    assert [params['text'] for _, params in send.sent] == [str(i) for i in range(20)]
+
+
+def test_limits_the_chat_rate():
+    send = Recorder()
+    box = outbox.Outbox(send, global_rate=1000, chat_rate=20, coalesce=False)
+    for i in range(5):
+        box.put(1, message(1, str(i)))
+    box.close()
+    times = [sent_at for sent_at, _ in send.sent]
+    # The first goes at once, the others at 20 per second.
+    assert times[-1] - times[0] >= 4 / 20.0 * 0.9
+
+
+def test_coalesces_queued_messages_of_a_chat():
+    send = Recorder()
+    box = outbox.Outbox(send, senders=1, global_rate=1000, chat_rate=5)
+    box.put(1, message(1, 'a', reply_markup='first'))
+    while not send.sent:
+        time.sleep(0.01)
+    # Queued while the chat waits for its next turn.
+    box.put(1, message(1, 'b', reply_markup='second'))
+    box.put(1, message(1, 'c'))
+    box.close()
+    assert [params['text'] for _, params in send.sent] == ['a', 'b\n\nc']
+    assert send.sent[1][1]['reply_markup'] == 'second'
+    assert box.metrics()['coalesced'] == 1
+
+
+def test_waits_out_flood_control():
+    send = Recorder([Response(ok=False, retry_after=0.1)])
+    box = outbox.Outbox(send, global_rate=1000, chat_rate=1000)
+    box.put(1, message(1, 'a'))
+    box.close()
+    assert len(send.sent) == 2
+    assert send.sent[1][0] - send.sent[0][0] >= 0.1
+    assert box.metrics()['retried'] == 1
+    assert box.metrics()['failed'] == 0
+
+
+def test_gives_up_on_other_errors():
+    send = Recorder([Response(ok=False)])
+    box = outbox.Outbox(send, global_rate=1000, chat_rate=1000)
+    box.put(1, message(1, 'a'))
+    box.close()
+    assert len(send.sent) == 1
+    assert box.metrics()['failed'] == 1
@@ -0,0 +1,99 @@
+import pytest
+
+import models
+import persistence
+
+
+def test_diff_sets_and_unsets_nested_keys():
+    old = {'turn': 1, 'locations': {'street': {'gas_on': True, 'seen': 1}}}
+    new = {'turn': 2, 'locations': {'street': {'gas_on': False}}, 'name': 'Ann'}
+    assert persistence.diff(old, new) == {
+        '$set': {'turn': 2, 'locations.street.gas_on': False, 'name': 'Ann'},
+        '$unset': {'locations.street.seen': ''},
+    }
+
+
+def test_diff_unchanged():
+    state = {'turn': 1, 'inventory': ['kettle'], 'locations': {'street': {}}}
+    assert persistence.diff(state, dict(state)) == {}
+
+
+def test_diff_pushes_appended_items():
+    assert persistence.diff({'inventory': ['kettle']}, {'inventory': ['kettle', 'pot', 'pot']}) == {
+        '$push': {'inventory': {'$each': ['pot', 'pot']}},
+    }
+
+
+def test_diff_pulls_removed_items():
+    assert persistence.diff(
+        {'inventory': ['kettle', 'pot', 'pipes', 'pot']}, {'inventory': ['kettle', 'pipes']}) == {
+        '$pull': {'inventory': {'$in': ['pot']}},
+    }
+
+
+def test_diff_sets_lists_pull_cannot_express():
+    # One of two pots taken: $pull would remove both.
+    assert persistence.diff({'inventory': ['pot', 'kettle', 'pot']}, {'inventory': ['pot', 'kettle']}) == {
+        '$set': {'inventory': ['pot', 'kettle']},
+    }
+    # Reordered.
+    assert persistence.diff({'inventory': ['pot', 'kettle']}, {'inventory': ['kettle', 'pot']}) == {
+        '$set': {'inventory': ['kettle', 'pot']},
+    }
+
+
+def fetch(user_id):
+    return persistence.track(models.User.fetch_or_create(user_id))
+
+
+def stored(user_id):
+    son = models.User._get_collection().find_one({'user_id': user_id})
+    son.pop('_id')
+    return son
+
+
+def test_save_round_trips(db):
+    user = fetch(1)
+    user.name = 'Ann'
+    user.inventory = ['kettle', 'pot']
+    user.locations = {'home_sweet_home': {'gas_on': True}}
+    persistence.save(user)
+
+    user = fetch(1)
+    user.inventory.remove('pot')
+    user.inventory.append('pipes')
+    user.locations['home_sweet_home']['gas_on'] = False
+    user.locations['street'] = {}
+    persistence.save(user)
+
+    state = persistence._state(user)
+    assert persistence._state(models.User.fetch(1)) == state
+    assert state['inventory'] == ['kettle', 'pipes']
+    assert state['locations'] == {'home_sweet_home': {'gas_on': False}, 'street': {}}
+
+
+def test_save_is_compare_and_swap(db):
+    first = fetch(1)
+    second = fetch(1)
+    first.turn = 1
+    persistence.save(first, version_field='version')
+    assert stored(1)['version'] == 1
+
+    second.turn = 2
+    with pytest.raises(persistence.VersionConflict):
+        persistence.save(second, version_field='version')
+    assert stored(1)['turn'] == 1
+
+    first.turn = 3
+    persistence.save(first, version_field='version')
+    assert stored(1)['version'] == 2
+
+
+def test_clone_keeps_tracking(db):
+    user = fetch(1)
+    copied = persistence.clone(user)
+    copied.inventory.append('kettle')
+    assert user.inventory == []
+    persistence.save(copied, version_field='version')
+    assert stored(1)['inventory'] == ['kettle']
+    assert stored(1)['version'] == 1
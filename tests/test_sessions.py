@@ -0,0 +1,160 @@
+import threading
+
+import pytest
+
+import sessions
+
+
+class Store(object):
+    def __init__(self):
+        self.documents = {}
+        self.loads = []
+        self.saves = []
+
+    def load(self, key):
+        self.loads.append(key)
+        return dict(self.documents.get(key, {'key': key, 'inventory': []}))
+
+    def save(self, document):
+        self.saves.append(document['key'])
+        self.documents[document['key']] = document
+
+
+def make_cache(store, **kwargs):
+    kwargs.setdefault('flush_interval', 60)
+    return sessions.SessionCache(store.load, store.save, **kwargs)
+
+
+def take(item):
+    def turn(document):
+        document['inventory'] = document['inventory'] + [item]
+    return turn
+
+
+def fail(document):
+    document['inventory'].append('lost')
+    raise ValueError('Bad turn')
+
+
+def test_writes_behind():
+    store = Store()
+    cache = make_cache(store)
+    cache.apply(1, take('kettle'))
+    cache.apply(1, take('pot'))
+    assert store.saves == []
+    cache.close()
+    assert store.saves == [1]
+    assert store.documents[1]['inventory'] == ['kettle', 'pot']
+    assert store.loads == [1]
+
+
+def test_failed_turn_keeps_earlier_changes():
+    store = Store()
+    cache = make_cache(store)
+    cache.apply(1, take('kettle'))
+    with pytest.raises(ValueError):
+        cache.apply(1, fail)
+    cache.apply(1, take('pot'))
+    cache.close()
+    assert store.documents[1]['inventory'] == ['kettle', 'pot']
+
+
+def test_failed_turn_alone_is_not_saved():
+    store = Store()
+    cache = make_cache(store)
+    with pytest.raises(ValueError):
+        cache.apply(1, fail)
+    cache.close()
+    assert store.saves == []
+
+
+def test_evicts_least_recently_used():
+    store = Store()
+    cache = make_cache(store, capacity=2)
+    cache.apply(1, take('kettle'))
+    cache.apply(2, take('pot'))
+    cache.apply(1, take('pipes'))
+    cache.apply(3, take('sugar'))
+    assert store.saves == [2]
+    assert len(cache) == 2
+    cache.close()
+    assert store.documents[1]['inventory'] == ['kettle', 'pipes']
+
+
+def test_evicted_entry_is_taken_back_while_written():
+    store = Store()
+    saving = threading.Event()
+    release = threading.Event()
+
+    def slow_save(document):
+        saving.set()
+        release.wait()
+        store.save(document)
+
+    cache = sessions.SessionCache(store.load, slow_save, capacity=1, flush_interval=60)
+    cache.apply(1, take('kettle'))
+    # Playing player 2 evicts player 1, whose save then hangs.
+    evictor = threading.Thread(target=cache.apply, args=(2, take('pot')))
+    evictor.start()
+    saving.wait()
+    threading.Timer(0.1, release.set).start()
+    cache.apply(1, take('pipes'))
+    evictor.join()
+    cache.close()
+    assert store.loads.count(1) == 1
+    assert store.documents[1]['inventory'] == ['kettle', 'pipes']
+
+
+class Conflict(Exception):
+    pass
+
+
+class VersionedStore(Store):
+    def load(self, key):
+        self.loads.append(key)
+        document = self.documents.get(key, {'key': key, 'inventory': [], 'version': 0})
+        return dict(document, inventory=list(document['inventory']))
+
+    def save(self, document):
+        stored = self.documents.get(document['key'], {'version': 0})
+        if stored['version'] != document['version']:
+            raise Conflict(document['key'])
+        self.saves.append(document['key'])
+        self.documents[document['key']] = dict(document, version=document['version'] + 1)
+        document['version'] += 1
+
+
+def test_conflict_replays_buffered_turns():
+    store = VersionedStore()
+    cache = make_cache(store, stale=(Conflict,))
+    cache.apply(1, take('kettle'))
+    cache.apply(1, take('pot'))
+    # Another process plays the same player meanwhile.
+    other = store.load(1)
+    other['inventory'].append('pipes')
+    store.save(other)
+    cache.close()
+    assert store.documents[1]['inventory'] == ['pipes', 'kettle', 'pot']
+    assert store.documents[1]['version'] == 2
+
+
+def test_conflict_replays_with_replay_function():
+    store = VersionedStore()
+    cache = make_cache(store, stale=(Conflict,))
+    replayed = []
+
+    def replay(document):
+        replayed.append(list(document['inventory']))
+        take('kettle')(document)
+
+    cache.apply(1, take('kettle'), replay=replay)
+    store.save(store.load(1))
+    cache.flush()
+    assert replayed == [[]]
+    assert store.documents[1]['inventory'] == ['kettle']
+    # Saved turns aren't replayed again.
+    store.save(store.load(1))
+    cache.apply(1, take('pot'))
+    cache.close()
+    assert replayed == [[]]
+    assert store.documents[1]['inventory'] == ['kettle', 'pot']
@@ -0,0 +1,96 @@
+import os
+import time
+
+import shards
+import telegram
+
+
+def echo_shard(queue, done, number, delay):
+    def handle(item):
+        time.sleep(delay)
+        if item == 'bad':
+            raise ValueError(item)
+    shards.serve(queue, done, handle)
+
+
+def test_reports_handled_items():
+    handled = []
+    pool = shards.ShardPool(echo_shard, (0,), shards=2, on_done=handled.append)
+    for i in range(10):
+        pool.submit(i % 3, (i % 3, i))
+    pool.submit(0, 'bad')
+    pool.shutdown()
+    assert 'bad' in handled
+    items = [item for item in handled if item != 'bad']
+    assert sorted(items) == sorted((i % 3, i) for i in range(10))
+    for key in range(3):
+        numbers = [i for k, i in items if k == key]
+        assert numbers == sorted(numbers)
+
+
+def update(update_id, chat_id):
+    return telegram.Update.from_dict({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': 'hi',
+        'chat': {'id': chat_id, 'type': 'private'},
+        'from': {'id': chat_id, 'first_name': 'A'}}})
+
+
+def test_transport_confirms_updates_once_shards_handle_them():
+    pool = shards.ShardPool(echo_shard, (0.2,), shards=2)
+    transport = telegram.Transport(None, 'token', pool=pool)
+    transport.dispatch([update(1, 1), update(2, 2)])
+    assert transport.last_update is None
+    transport.close()
+    assert transport.last_update == 2
+
+
+def crashing_shard(queue, done, number, marker):
+    def handle(item):
+        # Dies on 'crash' the first time only: a restarted shard finds it.
+        if item == 'crash' and not os.path.exists(marker):
+            open(marker, 'w').close()
+            os._exit(1)
+        if item == 'poison':
+            os._exit(1)
+    shards.serve(queue, done, handle)
+
+
+def test_restarts_dead_shards_and_hands_their_items_again(tmpdir):
+    handled = []
+    pool = shards.ShardPool(crashing_shard, (str(tmpdir.join('crashed')),), shards=1,
+                            on_done=handled.append, check_interval=0.05)
+    first = pool.processes[0]
+    for item in ['a', 'crash', 'b', 'c']:
+        pool.submit(0, item)
+    deadline = time.time() + 10
+    while len(handled) < 4 and time.time() < deadline:
+        time.sleep(0.05)
+    pool.submit(0, 'd')
+    pool.shutdown()
+    assert pool.processes[0] is not first
+    assert handled == ['a', 'crash', 'b', 'c', 'd']
+
+
+def test_gives_up_items_that_kill_their_shard(tmpdir):
+    handled = []
+    pool = shards.ShardPool(crashing_shard, (str(tmpdir.join('crashed')),), shards=1,
+                            on_done=handled.append, check_interval=0.05,
+                            max_item_retries=1)
+    for item in ['poison', 'a']:
+        pool.submit(0, item)
+    deadline = time.time() + 10
+    while len(handled) < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    pool.shutdown()
+    assert handled == ['poison', 'a']
+
+
+def test_transport_moves_on_when_a_shard_dies(tmpdir):
+    pool = shards.ShardPool(crashing_shard, (str(tmpdir.join('crashed')),), shards=1,
+                            check_interval=0.05, max_item_retries=0)
+    transport = telegram.Transport(None, 'token', pool=pool)
+    transport.dispatch([update(1, 1)])
+    pool.processes[0].terminate()
+    transport.dispatch([update(2, 1)])
+    transport.close()
+    assert transport.last_update == 2
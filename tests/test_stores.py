@@ -0,0 +1,130 @@
+import pytest
+
+import models
+import persistence
+import stores
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def store(request):
+    if request.param == 'memory':
+        return stores.MemoryStore(models.User)
+    fakeredis = pytest.importorskip('fakeredis')
+    # fakeredis runs scripts with lupa.
+    pytest.importorskip('lupa')
+    return stores.RedisStore(models.User, client=fakeredis.FakeStrictRedis(
+        server=fakeredis.FakeServer()))
+
+
+@pytest.fixture(params=[True, False], ids=['msgpack', 'json'])
+def encoding(request, monkeypatch):
+    if request.param:
+        pytest.importorskip('msgpack')
+    else:
+        monkeypatch.setattr(stores, 'msgpack', None)
+    return request.param
+
+
+def test_new_player_is_not_stored(store):
+    player = store.load(1)
+    assert player.turn == 0 and player.in_intro
+    assert store.get(1) is None
+
+
+def test_save_and_load(store, encoding):
+    player = store.load(1)
+    player.name = 'Ann'
+    player.inventory = ['kettle']
+    store.save(player)
+    assert player.version == 1
+    loaded = store.load(1)
+    assert (loaded.name, loaded.inventory, loaded.version) == ('Ann', ['kettle'], 1)
+    loaded.money = 5
+    store.save(loaded)
+    assert store.load(1).version == 2
+
+
+def test_stale_save_conflicts(store, encoding):
+    store.save(store.load(1))
+    first, second = store.load(1), store.load(1)
+    first.money = 5
+    store.save(first)
+    second.money = 6
+    with pytest.raises(persistence.VersionConflict):
+        store.save(second)
+    assert store.load(1).money == 5
+
+
+def test_put_if_absent_keeps_the_stored_player(store, encoding):
+    player = store.load(1)
+    player.name = 'Ann'
+    store.save(player)
+    other = store.new(1)
+    other.name = 'Bob'
+    store.put_if_absent(other)
+    assert store.get(1).name == 'Ann'
+    store.put_if_absent(store.new(2))
+    assert store.get(2).turn == 0
+    # Added players save like loaded ones.
+    added = store.load(2)
+    store.save(added)
+    assert store.load(2).version == 1
+
+
+def test_blobs_stay_readable_across_encodings(store, monkeypatch):
+    pytest.importorskip('msgpack')
+    player = store.load(1)
+    player.name = 'Ann'
+    monkeypatch.setattr(stores, 'msgpack', None)
+    store.save(player)
+    monkeypatch.undo()
+    loaded = store.load(1)
+    assert loaded.name == 'Ann'
+    store.save(loaded)
+    assert store.load(1).version == 2
+
+
+def test_tiered_creates_new_players_in_the_hot_store(db):
+    store = stores.TieredStore(stores.MemoryStore(models.User), stores.MongoStore(models.User),
+                               archive_interval=3600)
+    try:
+        player = store.load(1)
+        assert player.turn == 0
+        assert models.User.objects(user_id=1).count() == 0
+        player.name = 'Ann'
+        store.save(player)
+        assert models.User.objects(user_id=1).count() == 0
+        assert store.archive() == 1
+        assert models.User.fetch(1).name == 'Ann'
+    finally:
+        store.close()
+
+
+def test_tiered_reads_players_missing_from_hot_from_cold(db):
+    user = models.User.fetch_or_create(1)
+    user.name = 'Ann'
+    user.save()
+    store = stores.TieredStore(stores.MemoryStore(models.User), stores.MongoStore(models.User),
+                               archive_interval=3600)
+    player = store.load(1)
+    assert player.name == 'Ann'
+    player.money = 5
+    store.save(player)
+    store.close()
+    assert models.User.fetch(1).money == 5
+
+
+def test_user_ids(store):
+    store.put_if_absent(store.new(3))
+    store.save(store.load(5))
+    assert sorted(store.user_ids()) == [3, 5]
+
+
+def test_tiered_user_ids_span_both_stores(db):
+    models.User.fetch_or_create(1)
+    store = stores.TieredStore(stores.MemoryStore(models.User), stores.MongoStore(models.User),
+                               archive_interval=3600)
+    store.save(store.load(2))
+    assert store.user_ids() == [1, 2]
+    store.close()
+    assert store.user_ids() == [1, 2]
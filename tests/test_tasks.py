@@ -0,0 +1,51 @@
+import threading
+
+import pytest
+
+pytest.importorskip('celery')
+
+import models
+import stores
+import tasks
+import telegram
+
+
+@pytest.fixture
+def no_broker(monkeypatch):
+    monkeypatch.setattr(tasks.app.conf, 'broker_url', None)
+    monkeypatch.setattr(tasks.app.conf, 'task_always_eager', False)
+    yield
+    tasks.close()
+    tasks.configure(None)
+
+
+def test_send_runs_tasks_in_background_without_broker(no_broker, monkeypatch):
+    ran = []
+    release = threading.Event()
+
+    def run(*args):
+        release.wait(5)
+        ran.append((args, threading.current_thread().name))
+    monkeypatch.setattr(tasks.track, 'run', run)
+
+    tasks.send(tasks.track, 'start', 1)
+    tasks.send(tasks.track, 'win', 1)
+    # Sending doesn't wait for the task.
+    assert ran == []
+    release.set()
+    tasks.close()
+    assert [args for args, thread in ran] == [('start', 1), ('win', 1)]
+    assert all(thread != threading.current_thread().name for args, thread in ran)
+
+
+def test_broadcast_goes_to_players_of_the_configured_store(no_broker, monkeypatch):
+    sent = []
+    monkeypatch.setattr(telegram.Transport, 'post_message', lambda self, params: sent.append(
+        params['chat_id']) or telegram.Response(True, {}))
+    store = stores.MemoryStore(models.User)
+    for user_id in (3, 5):
+        store.put_if_absent(store.new(user_id))
+    tasks.configure(store)
+    tasks.send(tasks.broadcast, 'Hello')
+    tasks.close()
+    assert sorted(sent) == [3, 5]
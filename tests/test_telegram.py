@@ -0,0 +1,344 @@
+import datetime
+import json
+import threading
+import time
+
+import marshmallow
+import pytest
+import requests
+import urllib3.exceptions
+
+import offsets
+import telegram
+
+
+def refused():
+    reason = urllib3.exceptions.NewConnectionError(None, 'Connection refused')
+    return requests.ConnectionError(
+        urllib3.exceptions.MaxRetryError(None, 'http://localhost', reason))
+
+
+def reset():
+    return requests.ConnectionError(
+        urllib3.exceptions.ProtocolError('Connection aborted.', IOError('reset')))
+
+
+class Transport(telegram.Transport):
+    def __init__(self, failures, **kwargs):
+        super(Transport, self).__init__(None, 'token', **kwargs)
+        self.failures = list(failures)
+        self.fetched = 0
+
+    def fetch(self, method, url, params=None, timeout=None):
+        self.fetched += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        return {'ok': True, 'result': []}
+
+    def retry_delay(self, attempt, response=None):
+        return 0
+
+
+@pytest.mark.parametrize('error', [refused, lambda: requests.ConnectTimeout()])
+def test_retries_messages_that_never_left(error):
+    transport = Transport([error()])
+    assert transport.request('sendMessage', {'chat_id': 1, 'text': 'hi'}).ok
+    assert transport.fetched == 2
+
+
+def test_does_not_repeat_messages_after_a_reset():
+    transport = Transport([reset()])
+    with pytest.raises(requests.ConnectionError):
+        transport.request('sendMessage', {'chat_id': 1, 'text': 'hi'})
+    assert transport.fetched == 1
+
+
+def test_repeats_get_updates_after_a_reset():
+    transport = Transport([reset(), reset()])
+    assert transport.get_updates() == []
+    assert transport.fetched == 3
+
+
+def test_gives_up_after_max_retries():
+    transport = Transport([refused()] * 3, max_retries=2)
+    with pytest.raises(requests.ConnectionError):
+        transport.request('getUpdates')
+    assert transport.fetched == 3
+
+
+class Recorder(object):
+    def __init__(self):
+        self.calls = []
+
+    def on_message(self, transport, message):
+        self.calls.append([message.text])
+
+    def on_messages(self, transport, messages):
+        self.calls.append([message.text for message in messages])
+
+
+def update(update_id, user_id=1, text=None):
+    data = {'update_id': update_id}
+    if text is not None:
+        data['message'] = {
+            'message_id': update_id, 'date': 0, 'text': text,
+            'chat': {'id': 1, 'type': 'group'},
+            'from': {'id': user_id, 'first_name': 'A'},
+        }
+    return telegram.Update.from_dict(data)
+
+
+def test_handles_batch_in_update_order():
+    handler = Recorder()
+    transport = telegram.Transport(handler, 'token')
+    transport.handle_batch([
+        update(5, 1, 'e'), update(1, 1, 'a'), update(2, 1, 'b'), update(3, 2, 'c'),
+        update(4, 1, 'd'),
+    ])
+    assert handler.calls == [['a', 'b'], ['c'], ['d', 'e']]
+
+
+def test_drops_repeated_updates():
+    handler = Recorder()
+    transport = telegram.Transport(handler, 'token', dedup_window=10)
+    transport.dispatch([update(1, 1, 'a'), update(2, 1, 'b')])
+    transport.dispatch([update(2, 1, 'b'), update(3, 1, 'c')])
+    assert handler.calls == [['a'], ['b'], ['c']]
+    assert transport.last_update == 3
+
+
+def test_checkpoints_handled_updates(tmpdir):
+    path = str(tmpdir.join('offset'))
+    checkpoint = offsets.Checkpoint(offsets.FileStore(path))
+    transport = telegram.Transport(Recorder(), 'token', workers=2, checkpoint=checkpoint)
+    transport.dispatch([update(7, 1, 'a'), update(8, 2, 'b')])
+    transport.close()
+    assert offsets.FileStore(path).load() == 8
+    assert telegram.Transport(None, 'token', checkpoint=offsets.Checkpoint(
+        offsets.FileStore(path))).last_update == 8
+
+
+class Poller(telegram.Transport):
+    """Serves `batches` to getUpdates, recording its parameters."""
+
+    def __init__(self, handler, batches, **kwargs):
+        super(Poller, self).__init__(handler, 'token', **kwargs)
+        self.batches = list(batches)
+        self.polls = []
+
+    def fetch(self, method, url, params=None, timeout=None):
+        self.polls.append(params)
+        batch = self.batches.pop(0) if self.batches else []
+        return {'ok': True, 'result': batch}
+
+
+def raw_update(update_id, user_id=1, text='hi'):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': text,
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'first_name': 'A'},
+    }}
+
+
+class Blocking(Recorder):
+    def __init__(self):
+        super(Blocking, self).__init__()
+        self.release = threading.Event()
+
+    def on_message(self, transport, message):
+        if message.text == 'slow':
+            self.release.wait(5)
+        super(Blocking, self).on_message(transport, message)
+
+
+def test_polls_past_updates_in_flight():
+    handler = Blocking()
+    transport = Poller(handler, [[raw_update(1, 1, 'slow')], [raw_update(2, 2)]],
+                       workers=2, poll_timeout=30)
+    try:
+        transport.poll()
+        transport.poll()
+        # The slow update keeps the checkpoint, not the poll, behind.
+        assert transport.polls[1]['offset'] == 2
+        transport.poll()
+        assert transport.polls[2]['offset'] == 3
+        deadline = time.time() + 5
+        while not handler.calls and time.time() < deadline:
+            time.sleep(0.01)
+        assert handler.calls == [['hi']]
+        assert transport.last_update is None
+        handler.release.set()
+    finally:
+        transport.close()
+    assert transport.last_update == 2
+
+
+class HTTPResponse(object):
+    def __init__(self, data, status_code=200):
+        self.body = json.dumps(data).encode('utf-8')
+        self.status_code = status_code
+        self.reason = 'OK'
+        self.headers = {'Content-Length': str(len(self.body))}
+
+    def iter_content(self, size):
+        return [self.body]
+
+    def close(self):
+        pass
+
+
+class Session(object):
+    """Stands in for requests.Session, answering from `responses`."""
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.calls = []
+
+    def request(self, method, url, json=None, stream=False, timeout=None):
+        self.calls.append((method, url.rsplit('/', 1)[-1], json, timeout))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def updates(*update_ids):
+    return HTTPResponse({'ok': True, 'result': [raw_update(i, i) for i in update_ids]})
+
+
+def test_backoff_grows_to_its_maximum_and_resets(monkeypatch):
+    monkeypatch.setattr(telegram.random, 'uniform', lambda low, high: high)
+    backoff = telegram.Backoff(initial=0.5, maximum=3.0, factor=2.0)
+    assert [backoff.failure() for _ in range(5)] == [0.5, 1.0, 2.0, 3.0, 3.0]
+    backoff.reset()
+    assert backoff.failure() == 0.5
+
+
+def test_backoff_jitters_down_to_half(monkeypatch):
+    monkeypatch.setattr(telegram.random, 'uniform', lambda low, high: low)
+    backoff = telegram.Backoff(initial=1.0)
+    assert backoff.failure() == 0.5
+
+
+def test_long_polls_with_timeout_limit_and_offset():
+    transport = telegram.Transport(Recorder(), 'token', poll_timeout=25, poll_limit=50,
+                                   connect_timeout=5)
+    transport.session = Session([updates(1, 2), updates()])
+    transport.poll()
+    transport.poll()
+    first, second = transport.session.calls
+    assert first == ('POST', 'getUpdates', {'timeout': 25, 'limit': 50},
+                     (5, 25 + telegram.Transport.POLL_READ_MARGIN))
+    assert second[2] == {'timeout': 25, 'limit': 50, 'offset': 3}
+    assert transport.handler.calls == [['hi'], ['hi']]
+
+
+def test_short_polls_sleep_between_polls(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(telegram.time, 'sleep', sleeps.append)
+    transport = telegram.Transport(Recorder(), 'token', poll_timeout=0, poll_interval=2,
+                                   read_timeout=30)
+    transport.session = Session([updates()])
+    transport.poll()
+    method, endpoint, params, timeout = transport.session.calls[0]
+    assert (method, params, timeout) == ('GET', None, (5, 30))
+    assert sleeps == [2]
+
+
+def test_failed_polls_back_off_until_one_succeeds(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(telegram.time, 'sleep', sleeps.append)
+    monkeypatch.setattr(telegram.random, 'uniform', lambda low, high: high)
+    transport = telegram.Transport(Recorder(), 'token', poll_timeout=25, max_retries=0)
+    transport.session = Session([reset(), reset(), updates(1), reset()])
+    for _ in range(4):
+        transport.poll()
+    assert sleeps == [0.5, 1.0, 0.5]
+    assert transport.handler.calls == [['hi']]
+
+
+def sample_update():
+    """An update as the Bot API sends it, fields the bot ignores included."""
+    return {
+        'update_id': 7,
+        'message': {
+            'message_id': 3, 'date': 1500000000, 'text': 'Go north',
+            'chat': {'id': 42, 'type': 'private', 'first_name': 'Ann'},
+            'from': {'id': 42, 'is_bot': False, 'first_name': 'Ann', 'last_name': 'Lee',
+                     'username': 'ann', 'language_code': 'en'},
+            'entities': [{'type': 'bold', 'offset': 0, 'length': 2}],
+        },
+    }
+
+
+@pytest.fixture(params=[False, True], ids=['slots', 'schema'])
+def strict(request):
+    return request.param
+
+
+def test_decodes_updates(strict):
+    transport = telegram.Transport(None, 'token', strict=strict)
+    update, = transport.decode_updates([sample_update()])
+    message = update.message
+    assert (update.update_id, message.update_id, message.message_id) == (7, 7, 3)
+    assert message.date == datetime.datetime(2017, 7, 14, 2, 40)
+    assert message.text == 'Go north'
+    assert (message.chat.id, message.chat.type) == (42, 'private')
+    user = message.user
+    assert (user.id, user.first_name, user.last_name, user.username, user.language_code) == \
+        (42, 'Ann', 'Lee', 'ann', 'en')
+    assert not hasattr(message, 'entities')
+
+
+def test_decodes_sparse_updates(strict):
+    transport = telegram.Transport(None, 'token', strict=strict)
+    channel_post = {'update_id': 8, 'message': {
+        'message_id': 4, 'date': 0, 'chat': {'id': -1, 'type': 'channel'}}}
+    edit = {'update_id': 9, 'edited_message': sample_update()['message']}
+    post, edited = transport.decode_updates([channel_post, edit])
+    assert (post.message.user, post.message.text) == (None, None)
+    assert edited.update_id == 9 and edited.message is None
+
+
+@pytest.mark.parametrize('change', [
+    lambda data: data['message'].pop('chat'),
+    lambda data: data['message']['chat'].update(type='secret'),
+    lambda data: data['message'].update(date='yesterday'),
+    lambda data: data['message']['from'].pop('first_name'),
+])
+def test_strict_decoding_rejects_malformed_updates(change):
+    transport = telegram.Transport(None, 'token', strict=True)
+    data = sample_update()
+    change(data)
+    with pytest.raises(marshmallow.ValidationError):
+        transport.decode_updates([data])
+
+
+def test_schema_round_trips_updates():
+    schema = telegram.UpdateSchema(strict=True)
+    data = sample_update()
+    dumped = schema.dump(schema.load(data).data).data
+    message = data['message']
+    del message['entities'], message['from']['is_bot'], message['chat']['first_name']
+    assert dumped == data
+    assert schema.dump(telegram.Update.from_dict(data)).data == data
+
+
+def test_decodes_sent_messages(strict):
+    transport = telegram.Transport(None, 'token', strict=strict)
+    result = dict(sample_update()['message'], **{'from': {'id': 1, 'first_name': 'Bot'}})
+    transport.session = Session([HTTPResponse({'ok': True, 'result': result})])
+    sent = transport.send_message(telegram.Chat(42, 'private'), 'You go north.')
+    if strict:
+        assert (sent.message_id, sent.chat.id, sent.user.first_name) == (3, 42, 'Bot')
+    else:
+        assert sent == result
+
+
+def test_decodes_error_responses(strict):
+    transport = telegram.Transport(None, 'token', strict=strict)
+    response = transport.decode_response({
+        'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+        'parameters': {'retry_after': 3}})
+    assert (response.ok, response.error_code, response.parameters) == \
+        (False, 429, {'retry_after': 3})
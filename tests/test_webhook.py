@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+import app
+import bot
+import telegram
+
+
+def make_transport(secret):
+    return telegram.WebhookTransport(None, 'token', secret, consumers=0)
+
+
+def test_check_secret():
+    transport = make_transport('s3cret')
+    assert transport.check_secret('s3cret')
+    assert transport.check_secret(u's3cret', u's3cret')
+    assert not transport.check_secret('other')
+    assert not transport.check_secret('s3cret', 'other')
+
+
+def test_check_secret_rejects_non_ascii():
+    transport = make_transport('s3cret')
+    assert not transport.check_secret(u'sécret')
+    assert not transport.check_secret('s3cret', u'sécret')
+    assert make_transport(u'sécret').check_secret(u'sécret'.encode('utf-8'))
+
+
+UPDATE = {'update_id': 1, 'message': {
+    'message_id': 1, 'date': 0, 'text': 'hi',
+    'chat': {'id': 1, 'type': 'private'},
+    'from': {'id': 1, 'first_name': 'A'}}}
+
+
+@pytest.fixture
+def client():
+    transport = telegram.WebhookTransport(None, 'token', 's3cret', queue_size=1, consumers=0)
+    app.app.config['TELEGRAM_TRANSPORT'] = transport
+    try:
+        yield transport, app.app.test_client()
+    finally:
+        app.app.config.pop('TELEGRAM_TRANSPORT')
+
+
+def post(client, secret='s3cret', header='s3cret', payload=UPDATE):
+    headers = {}
+    if header is not None:
+        headers['X-Telegram-Bot-Api-Secret-Token'] = header
+    return client.post('/telegram/' + secret, data=json.dumps(payload),
+                       content_type='application/json', headers=headers)
+
+
+def test_webhook_enqueues_updates(client):
+    transport, http = client
+    assert post(http).status_code == 200
+    update = transport.queue.get_nowait()
+    assert (update.update_id, update.message.text) == (1, 'hi')
+
+
+def test_webhook_rejects_wrong_secrets(client):
+    transport, http = client
+    assert post(http, secret='other').status_code == 403
+    assert post(http, header='other').status_code == 403
+    assert transport.queue.empty()
+
+
+def test_webhook_rejects_bad_payloads(client):
+    transport, http = client
+    assert post(http, payload={'message': 'no update id'}).status_code == 400
+    assert http.post('/telegram/s3cret', data='not json').status_code == 400
+
+
+def test_webhook_asks_for_redelivery_when_full(client):
+    transport, http = client
+    assert post(http).status_code == 200
+    assert post(http).status_code == 503
+
+
+def test_webhook_without_transport():
+    assert post(app.app.test_client()).status_code == 404
+
+
+def test_run_webhook_deletes_the_webhook_on_exit(monkeypatch):
+    requests = []
+
+    def request(self, endpoint, params=None, timeout=None, retry_flood=True):
+        requests.append(endpoint)
+        return telegram.Response(True, True)
+    monkeypatch.setattr(telegram.WebhookTransport, 'request', request)
+
+    def stop(*args, **kwargs):
+        raise KeyboardInterrupt()
+    monkeypatch.setattr(app.app, 'run', stop)
+    monkeypatch.setitem(app.app.config, 'TELEGRAM_TRANSPORT', None)
+    args = bot.make_parser('token', 'db').parse_args(
+        ['--webhook-url', 'https://example.com', '--outbox'])
+    with pytest.raises(KeyboardInterrupt):
+        bot.run_webhook(None, 'token', args)
+    assert requests == ['setWebhook', 'deleteWebhook']
+    # A sharded ingress doesn't send replies.
+    assert app.app.config['TELEGRAM_TRANSPORT'].outbox is None
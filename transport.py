@@ -7,7 +7,13 @@ class Formatter(object):
     def bold(self, text):
         pass
 
+    @abc.abstractmethod
+    def speech(self, name, phrase):
+        """A line said by the character `name`."""
+
 class User(object):
+    __slots__ = ('id', 'transport', 'first_name', 'last_name', 'username')
+
     def __init__(self, id, transport, first_name, last_name=None, username=None):
         super(User, self).__init__()
         self.id = id
@@ -27,15 +33,19 @@ class User(object):
 
 
 class Chat(object):
-    pass
+    __slots__ = ()
 
 class Message(object):
-    def __init__(self, text, user, chat):
+    __slots__ = ('text', 'user', 'chat', 'update_id')
+
+    def __init__(self, text, user, chat, update_id=None):
         super(Message, self).__init__()
 
         self.text = text
         self.user = user
         self.chat = chat
+        # Id of the update that brought the message, if the transport has one.
+        self.update_id = update_id
 
 class Handler(object):
     __meta__ = abc.ABCMeta
@@ -44,6 +54,11 @@ class Handler(object):
     def on_message(self, transport, message):
         pass
 
+    def on_messages(self, transport, messages):
+        """Handles several messages of one chat sent in a quick burst."""
+        for message in messages:
+            self.on_message(transport, message)
+
 class SerializedTransport(object):
     def __init__(self, mod, cls, *args, **kwargs):
         super(SerializedTransport, self).__init__()
@@ -73,6 +88,9 @@ class Transport(object):
     def send_message(self, chat, text, keyboard=None):
         pass
 
+    def buffered(self):
+        return BufferedTransport(self)
+
     @abc.abstractproperty
     def formatter(self):
         pass
@@ -80,3 +98,60 @@ class Transport(object):
     @abc.abstractmethod
     def keyboard(self, *buttons):
         pass
+
+
+class BufferedTransport(object):
+    """Collects messages sent through a transport until `flush`.
+
+    Sends are grouped by `begin` calls; `flush` sends either every message,
+    only the last group ('last') or all of them merged into one ('merge').
+    Callbacks passed to `defer` run after the sends.
+    """
+
+    def __init__(self, transport):
+        super(BufferedTransport, self).__init__()
+        self.transport = transport
+        self.groups = [[]]
+        self.deferred = []
+
+    @property
+    def formatter(self):
+        return self.transport.formatter
+
+    def keyboard(self, *buttons):
+        return self.transport.keyboard(*buttons)
+
+    def begin(self):
+        if self.groups[-1]:
+            self.groups.append([])
+
+    def send_message(self, chat, text, **kwargs):
+        self.groups[-1].append((chat, text, kwargs))
+
+    def defer(self, callback):
+        self.deferred.append(callback)
+
+    def discard(self):
+        self.groups = [[]]
+        self.deferred = []
+
+    def flush(self, mode='all'):
+        groups, self.groups = self.groups, [[]]
+        if mode == 'last':
+            groups = [group for group in groups if group][-1:]
+        sends = [send for group in groups for send in group]
+        if mode == 'merge' and len(sends) > 1:
+            chat = sends[-1][0]
+            kwargs = {}
+            for _, _, send_kwargs in sends:
+                kwargs.update(send_kwargs)
+            # Only the newest keyboard is still relevant.
+            kwargs['keyboard'] = next(
+                (send_kwargs['keyboard'] for _, _, send_kwargs in reversed(sends)
+                 if send_kwargs.get('keyboard')), None)
+            sends = [(chat, '\n\n'.join(text for _, text, _ in sends), kwargs)]
+        for chat, text, kwargs in sends:
+            self.transport.send_message(chat, text, **kwargs)
+        deferred, self.deferred = self.deferred, []
+        for callback in deferred:
+            callback()